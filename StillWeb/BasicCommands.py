@@ -3,6 +3,7 @@
 # Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
 
 import os
+import errno
 
 from StillWeb.sw_util import TypicalPaths
 
@@ -24,7 +25,12 @@ class BasicCommandsPlugin:
             p = os.path.join(root_dir, *pathtuple[:i])
             if not os.path.exists(p):
                 print("Creating directory %s" % (p,))
-                os.mkdir(p)
+                try:
+                    os.mkdir(p)
+                except EnvironmentError as exc:
+                    # Another 'make' worker might have just created it.
+                    if exc.errno != errno.EEXIST or not os.path.isdir(p):
+                        raise
 
     def handle_mkdir(self, target_url):
         """Make a directory if it does not already exist.
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# BuildManifest.py - Content-hash based freshness checking
+# Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
+
+import os
+import errno
+import hashlib
+import pickle
+
+from StillWeb.sw_util import ensure_path, write_file_atomically
+
+class BuildManifest:
+    """Persistent record of the inputs used to build each output file.
+
+    For every output file, the manifest stores the content hash of the output
+    and of each of its input files.  An output is fresh if it still exists
+    unmodified and the contents of its inputs are unchanged, regardless of
+    the files' timestamps (so a "git checkout" or an rsync restore doesn't
+    trigger a rebuild).
+
+    Content hashes are cached along with each file's mtime and size, so an
+    unchanged file is never re-hashed.
+
+    Only files are recorded, not the results of placeholder callbacks: a
+    result can't be checked without invoking the callback, so plugins
+    instead declare the files the results come from (see
+    PageGenerator.add_dependency), or force a rebuild from a
+    'check_freshness' filter when their own records say the page is stale.
+    """
+
+    # Bump this if the format of the manifest file changes
+    VERSION = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._outputs = {}  # map output filename -> (output digest, {input filename: digest})
+        self._digests = {}  # map filename -> (st_mtime_ns, st_size, digest)
+        self._changed_outputs = {}
+        self._changed_digests = {}
+        self.load()
+
+    def load(self):
+        try:
+            f = open(self.filename, "rb")
+        except EnvironmentError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            return
+        try:
+            (version, outputs, digests) = pickle.load(f)
+        finally:
+            f.close()
+        if version != self.VERSION:
+            return  # Discard old manifests
+        self._outputs = outputs
+        self._digests = digests
+
+    def save(self):
+        """Write the manifest to disk (if it was modified)"""
+        if not self._changed_outputs and not self._changed_digests:
+            return
+        ensure_path(os.path.dirname(self.filename))
+        write_file_atomically(self.filename, pickle.dumps((self.VERSION, self._outputs, self._digests)))
+        self._changed_outputs = {}
+        self._changed_digests = {}
+
+    def file_digest(self, filename):
+        """Return the content hash of the given file, or None if it doesn't exist."""
+        try:
+            st = os.stat(filename)
+        except EnvironmentError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            return None
+
+        # Cheap pre-check: Don't re-hash files whose mtime and size are unchanged.
+        cached = self._digests.get(filename)
+        if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+            return cached[2]
+
+        h = hashlib.sha1()
+        f = open(filename, "rb")
+        try:
+            while True:
+                data = f.read(65536)
+                if not data:
+                    break
+                h.update(data)
+        finally:
+            f.close()
+        digest = h.hexdigest()
+
+        self._digests[filename] = self._changed_digests[filename] = (st.st_mtime_ns, st.st_size, digest)
+        return digest
+
+    def is_fresh(self, output_filename, input_filenames):
+        """Return True if output_filename was built from the current contents of input_filenames"""
+        record = self._outputs.get(output_filename)
+        if record is None:
+            return False
+        (output_digest, input_digests) = record
+
+        # The output must exist, and must not have been modified since it was built.
+        if output_digest is None or self.file_digest(output_filename) != output_digest:
+            return False
+
+        # The set of inputs must be the same, and none of them may have changed.
+        if set(input_filenames) != set(input_digests):
+            return False
+        for filename in input_filenames:
+            digest = self.file_digest(filename)
+            if digest is None or digest != input_digests[filename]:
+                return False
+        return True
+
+    def get_inputs(self, output_filename):
+        """Return the set of input filenames recorded when output_filename was last built"""
+        record = self._outputs.get(output_filename)
+        if record is None:
+            return frozenset()
+        return frozenset(record[1])
+
+    def record(self, output_filename, input_filenames):
+        """Record that output_filename was just built from input_filenames"""
+        input_digests = dict((filename, self.file_digest(filename)) for filename in input_filenames)
+        record = (self.file_digest(output_filename), input_digests)
+        self._outputs[output_filename] = self._changed_outputs[output_filename] = record
+
+    #
+    # Parallel 'make' support
+    #
+    def export_changes(self):
+        """Return (and forget) the changes made since the last call to export_changes or save"""
+        changes = (self._changed_outputs, self._changed_digests)
+        self._changed_outputs = {}
+        self._changed_digests = {}
+        return changes
+
+    def merge_changes(self, changes):
+        """Merge changes returned by export_changes (in another process)"""
+        (outputs, digests) = changes
+        self._outputs.update(outputs)
+        self._changed_outputs.update(outputs)
+        self._digests.update(digests)
+        self._changed_digests.update(digests)
+
+# vim:set ts=4 sw=4 sts=4 expandtab:
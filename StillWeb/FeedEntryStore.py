@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+# FeedEntryStore.py - Indexed storage for Atom feed entries
+# Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
+
+import os
+import hashlib
+import sqlite3
+
+class FeedEntryStore:
+    """Indexed store of the feed entries collected by FeedGeneratorPlugin.
+
+    There is one row for each page that has been processed, keyed by the
+    page's "root word".  Pages without an <atom:entry> have NULL entry
+    columns.
+
+    Whenever an entry changes (i.e. when the content hash of its fields
+    changes), it is given a new stamp (a counter), and the store remembers
+    the largest stamp issued so far.  Each feed records the largest stamp at
+    the time it was built, so checking whether a feed is up-to-date takes one
+    lookup, no matter how many entries there are.  Each feed also records the
+    earliest publication date of the entries that were left out because they
+    were in the future, so that the feed can be rebuilt once that date has
+    passed.
+    """
+
+    # Bump this if the schema changes
+    VERSION = 1
+
+    # Entry fields, in column order.  ('categories' holds the terms of the
+    # entry's <atom:category> elements, separated by newlines.)
+    ENTRY_FIELDS = ('id', 'published', 'published_key', 'updated', 'title', 'atom:entry',
+        'source_filename', 'output_filename', 'categories')
+    _ENTRY_COLUMNS = ('id', 'published', 'published_key', 'updated', 'title', 'atom_entry',
+        'source_filename', 'output_filename', 'categories')
+
+    _SCHEMA = [
+        "DROP TABLE IF EXISTS entries",
+        "DROP TABLE IF EXISTS feeds",
+        "DROP TABLE IF EXISTS meta",
+        """CREATE TABLE entries (
+            rootword TEXT PRIMARY KEY,
+            stamp INTEGER NOT NULL,
+            id TEXT,
+            published TEXT,
+            published_key TEXT,
+            updated TEXT,
+            title TEXT,
+            atom_entry TEXT,
+            source_filename TEXT,
+            output_filename TEXT,
+            digest TEXT,
+            categories TEXT
+        )""",
+        "CREATE INDEX entries_published_key ON entries (published_key)",
+        "CREATE INDEX entries_id ON entries (id)",
+        """CREATE TABLE feeds (
+            output_filename TEXT PRIMARY KEY,
+            stamp INTEGER NOT NULL,
+            next_publish TEXT,
+            digest TEXT,
+            category TEXT
+        )""",
+        """CREATE TABLE meta (
+            name TEXT PRIMARY KEY,
+            value
+        )""",
+        "INSERT INTO meta (name, value) VALUES ('max_stamp', 0)",
+    ]
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._conn = None
+        self._pid = None
+        self._inherited_conns = []
+
+    def _connection(self):
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+
+        if self._conn is not None:
+            # We're in a child process (e.g. a parallel 'make' worker).  SQLite
+            # connections must not be used across fork(), so open a new one.
+            # (Keep the inherited one referenced, so that it isn't closed here.)
+            self._inherited_conns.append(self._conn)
+
+        conn = sqlite3.connect(self.filename, timeout=60)
+        if conn.execute("PRAGMA user_version").fetchone()[0] != self.VERSION:
+            # Create the schema, discarding any data stored by a different
+            # version.  (The pages are then rebuilt, since the store doesn't
+            # know about them.)  Several processes might try to do this at
+            # once, so check again after locking the database.
+            conn.execute("BEGIN EXCLUSIVE")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != self.VERSION:
+                for statement in self._SCHEMA:
+                    conn.execute(statement)
+                conn.execute("PRAGMA user_version = %d" % (self.VERSION,))
+            conn.commit()
+        self._conn = conn
+        self._pid = os.getpid()
+        return conn
+
+    def commit(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.commit()
+
+    def close(self):
+        self.commit()
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+        self._inherited_conns = []
+
+    #
+    # Stamps
+    #
+    def get_max_stamp(self):
+        """Return the stamp of the most recent change to any entry"""
+        (stamp,) = self._connection().execute("SELECT value FROM meta WHERE name = 'max_stamp'").fetchone()
+        return stamp
+
+    def _new_stamp(self):
+        conn = self._connection()
+        conn.execute("UPDATE meta SET value = value + 1 WHERE name = 'max_stamp'")
+        return self.get_max_stamp()
+
+    def get_feed_stamp(self, output_filename):
+        """Return the max stamp at the time the given feed was built (or None)"""
+        row = self._connection().execute("SELECT stamp FROM feeds WHERE output_filename = ?", (output_filename,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get_feed_next_publish(self, output_filename):
+        """Return the earliest publication date of the future entries that
+        were left out of the given feed when it was built (or None)
+        """
+        row = self._connection().execute("SELECT next_publish FROM feeds WHERE output_filename = ?", (output_filename,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get_feed_digest(self, output_filename):
+        """Return the digest recorded when the given feed was built (or None).
+
+        The digest identifies what the feed was built from, in cases that
+        the stamp doesn't cover (e.g. which entries an archive page holds).
+        """
+        row = self._connection().execute("SELECT digest FROM feeds WHERE output_filename = ?", (output_filename,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_feed_stamp(self, output_filename, stamp, next_publish=None, digest=None, category=None):
+        self._connection().execute("""INSERT OR REPLACE INTO feeds (output_filename, stamp, next_publish, digest, category)
+            VALUES (?, ?, ?, ?, ?)""", (output_filename, stamp, next_publish, digest, category))
+
+    def get_feed_category(self, output_filename):
+        """Return the category of the given feed (or None if it isn't a per-category feed)"""
+        row = self._connection().execute("SELECT category FROM feeds WHERE output_filename = ?", (output_filename,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get_category_feeds(self):
+        """Return (output_filename, category) for each of the recorded
+        per-category feeds (see set_feed_stamp)
+        """
+        return self._connection().execute("SELECT output_filename, category FROM feeds WHERE category IS NOT NULL").fetchall()
+
+    def remove_feed(self, output_filename):
+        """Forget the given feed"""
+        self._connection().execute("DELETE FROM feeds WHERE output_filename = ?", (output_filename,))
+
+    #
+    # Pages and entries
+    #
+    def has_page(self, rootword):
+        """Return True if the page has been processed (whether or not it has an entry)"""
+        row = self._connection().execute("SELECT 1 FROM entries WHERE rootword = ?", (rootword,)).fetchone()
+        return row is not None
+
+    def touch_page(self, rootword):
+        """Record that the page has been processed"""
+        self._connection().execute("INSERT OR IGNORE INTO entries (rootword, stamp) VALUES (?, 0)", (rootword,))
+
+    def clear_entry(self, rootword):
+        """Remove the page's entry (if any)"""
+        conn = self._connection()
+        row = conn.execute("SELECT atom_entry IS NULL FROM entries WHERE rootword = ?", (rootword,)).fetchone()
+        if row is None or row[0]:
+            return
+        conn.execute("UPDATE entries SET stamp = ?, digest = NULL, %s WHERE rootword = ?" % (
+            ", ".join("%s = NULL" % (c,) for c in self._ENTRY_COLUMNS),), (self._new_stamp(), rootword))
+
+    def write_entry(self, rootword, entry):
+        """Store the page's entry.
+
+        `entry` is a dictionary containing the keys listed in ENTRY_FIELDS.
+        The entry's stamp is only changed if the entry's content hash is
+        different from that of the entry already stored.
+        """
+        values = tuple(entry[k] for k in self.ENTRY_FIELDS)
+        digest = hashlib.sha1(repr(values).encode('UTF-8')).hexdigest()
+        conn = self._connection()
+        row = conn.execute("SELECT digest FROM entries WHERE rootword = ?", (rootword,)).fetchone()
+        if row is not None and row[0] == digest:
+            return  # unchanged
+        conn.execute("INSERT OR REPLACE INTO entries (rootword, stamp, digest, %s) VALUES (?, ?, ?, %s)" % (
+            ", ".join(self._ENTRY_COLUMNS), ", ".join("?" * len(self._ENTRY_COLUMNS))),
+            (rootword, self._new_stamp(), digest) + values)
+
+    def _query_entries(self, where, args=()):
+        rows = self._connection().execute("SELECT %s FROM entries WHERE atom_entry IS NOT NULL AND %s" % (
+            ", ".join(self._ENTRY_COLUMNS), where), args)
+        return [dict(zip(self.ENTRY_FIELDS, row)) for row in rows]
+
+    def get_published_entries(self, now, limit=None, category=None):
+        """Return the entries published at or before `now` (a UTC Atom
+        datetime), newest first.
+
+        If `limit` is given, at most that many entries are returned.  If
+        `category` is given, only entries in that category are returned.
+        """
+        if limit is None:
+            limit = -1
+        if category is None:
+            return self._query_entries("published <= ? ORDER BY published_key DESC, rootword LIMIT ?", (now, limit))
+        return self._query_entries("""published <= ? AND instr(char(10) || categories || char(10), char(10) || ? || char(10)) > 0
+            ORDER BY published_key DESC, rootword LIMIT ?""", (now, category, limit))
+
+    def iter_published_entry_xml(self, now, limit=None):
+        """Yield the serialized <atom:entry> elements of the entries
+        published at or before `now`, as UTF-8 encoded bytes, in the same
+        order as get_published_entries.
+
+        The rows are read one at a time, so the entries are never all in
+        memory at once.
+        """
+        if limit is None:
+            limit = -1
+        rows = self._connection().execute("""SELECT CAST(atom_entry AS BLOB) FROM entries
+            WHERE atom_entry IS NOT NULL AND published <= ? ORDER BY published_key DESC, rootword LIMIT ?""", (now, limit))
+        for (data,) in rows:
+            yield data
+
+    def get_published_entry_keys(self, now):
+        """Return (rootword, stamp, updated) for each of the entries
+        published at or before `now`, oldest first (i.e. in the reverse
+        order of get_published_entries).
+        """
+        return self._connection().execute("""SELECT rootword, stamp, updated FROM entries
+            WHERE atom_entry IS NOT NULL AND published <= ? ORDER BY published_key, rootword DESC""", (now,)).fetchall()
+
+    def get_published_entry_categories(self, now):
+        """Return (rootword, stamp, updated, categories) for each of the
+        entries published at or before `now`, in the same order as
+        get_published_entries.  categories is a list of category terms.
+        """
+        rows = self._connection().execute("""SELECT rootword, stamp, updated, categories FROM entries
+            WHERE atom_entry IS NOT NULL AND published <= ? ORDER BY published_key DESC, rootword""", (now,))
+        return [(rootword, stamp, updated, [c for c in categories.split("\n") if c])
+            for (rootword, stamp, updated, categories) in rows]
+
+    def iter_entry_xml(self, rootwords):
+        """Yield the serialized <atom:entry> elements of the given pages'
+        entries, as UTF-8 encoded bytes, in the given order.
+        """
+        conn = self._connection()
+        for rootword in rootwords:
+            row = conn.execute("SELECT CAST(atom_entry AS BLOB) FROM entries WHERE rootword = ? AND atom_entry IS NOT NULL",
+                (rootword,)).fetchone()
+            if row is not None:
+                yield row[0]
+
+    def get_unpublished_entries(self, now):
+        """Return the entries whose publication dates are after `now`"""
+        return self._query_entries("published > ? ORDER BY published_key, rootword", (now,))
+
+    def find_duplicate_ids(self):
+        """Return a list of (id, [source_filename, ...]) for ids used by more than one entry"""
+        rows = self._connection().execute("""
+            SELECT id, source_filename FROM entries
+            WHERE id IN (SELECT id FROM entries WHERE atom_entry IS NOT NULL GROUP BY id HAVING COUNT(*) > 1)
+            ORDER BY id, rootword""")
+        result = []
+        for (id, source_filename) in rows:
+            if not result or result[-1][0] != id:
+                result.append((id, []))
+            result[-1][1].append(source_filename)
+        return result
+
+# vim:set ts=4 sw=4 sts=4 expandtab:
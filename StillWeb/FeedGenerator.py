@@ -3,26 +3,29 @@
 # Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
 
 import os
-import fnmatch
-import errno
 import re
 import datetime
 import shutil
 import base64
+import hashlib
 import urllib.parse
-import pickle
 
 from xml.dom import minidom, XMLNS_NAMESPACE, XHTML_NAMESPACE, EMPTY_NAMESPACE
 
 from StillWeb.sw_util import getChildText, replaceChildText, TypicalPaths, createCDATASectionOrText, getChildElementsNS, ensure_path
 from StillWeb.LinkRewriter import rewrite_links, HTML_CRITERIA
 from StillWeb.PageGenerator import NeedsUpdate
+from StillWeb.FeedEntryStore import FeedEntryStore
+from StillWeb.TagSoupToXml import TagSoupToXml
 from StillWeb.NamespaceNormalization import normalize_namespaces, substitute_namespaces
 
 # XML namespace and content type for Atom 1.0 (RFC 4287) documents
 ATOM_NAMESPACE = "http://www.w3.org/2005/Atom"
 ATOM_CONTENT_TYPE = "application/atom+xml"
 
+# XML namespace for Feed Paging and Archiving (RFC 5005)
+FH_NAMESPACE = "http://purl.org/syndication/history/1.0"
+
 # rewrite_links criteria for Atom 1.0 documents
 ATOM_CRITERIA = [
     ((ATOM_NAMESPACE, "category"),     (None, "scheme")),
@@ -124,17 +127,82 @@ class FeedGeneratorPlugin:
     def __init__(self, framework):
         self._framework = framework
 
+        # Entry data changes made in a parallel 'make' worker, waiting to be
+        # applied by the main process.
+        self._worker_entry_ops = []
+
+        # The entry store (see _get_entry_store)
+        self._entry_store = None
+
+        # Results of get_feed_entries, and the entry store's max stamp when
+        # they were computed
+        self._feed_entries_cache = {}
+        self._feed_entries_stamp = None
+
         pg_plugin = self._framework.plugins['StillWeb.PageGenerator']
         pg_plugin.register_filter('check_freshness', self._check_freshness)
         pg_plugin.register_filter('load_content:after', self._load_content)
         pg_plugin.register_filter('generate_page:filter_head', self._filter_head)
         pg_plugin.register_filter('write_output:after', self._write_output)
+        pg_plugin.register_parallel_state(self._export_parallel_state, self._merge_parallel_state)
 
-        framework.plugins['StillWeb.ScriptProcessor'].register_command('make_atom_feed', self.handle_make_atom_feed)
+        script_processor = framework.plugins['StillWeb.ScriptProcessor']
+        script_processor.register_command('make_atom_feed', self.handle_make_atom_feed)
+        script_processor.register_command('make_atom_feeds_by_category', self.handle_make_atom_feeds_by_category)
+        script_processor.register_command('scan_feed_entries', self.handle_scan_feed_entries)
+        script_processor.register_barrier(self._commit_entry_store)
 
     def cleanup(self):
         if self._framework is not None:
+            if self._entry_store is not None:
+                self._entry_store.close()
+                self._entry_store = None
             self._framework = None
+            self._worker_entry_ops = None
+            self._feed_entries_cache = None
+
+    #
+    # Exported API
+    #
+    def get_feed_entries(self, target_url, limit=None):
+        """Return the newest published entries of a feed made by
+        make_atom_feed (or make_atom_feeds_by_category), newest first.
+
+        Each entry is a dictionary with the following keys:
+
+            id, title
+                The entry's id and (plain text) title
+            published, updated
+                The entry's dates (normalized to UTC)
+            href
+                The absolute URL of the entry's page
+            summary
+                The <div> element of the entry's XHTML summary (or None).
+                This belongs to a shared document, so it must be copied
+                (e.g. using importNode), not modified.
+
+        The entries are read from the entry store rather than from the feed
+        document, and at most `limit` of them are loaded.  The results are
+        memoized until the entries change.
+        """
+        tp = TypicalPaths(self._framework, target_url)
+        store = self._get_entry_store()
+        if store.get_feed_stamp(tp.output_filename) is None:
+            raise FGValueError("%s is not a feed made by make_atom_feed" % (target_url,))
+
+        max_stamp = store.get_max_stamp()
+        if max_stamp != self._feed_entries_stamp:
+            self._feed_entries_cache = {}
+            self._feed_entries_stamp = max_stamp
+
+        key = (tp.output_filename, limit)
+        result = self._feed_entries_cache.get(key)
+        if result is None:
+            now = atom_datetime_to_utc(datetime.datetime.utcnow().isoformat() + "Z")
+            category = store.get_feed_category(tp.output_filename)
+            result = [self._parse_stored_entry(entry) for entry in store.get_published_entries(now, limit, category)]
+            self._feed_entries_cache[key] = result
+        return result
 
     #
     # Command
@@ -143,38 +211,35 @@ class FeedGeneratorPlugin:
         """Write the data we've collected so far as an Atom feed
 
         Usage: make-atom-feed TARGET_RELATIVE_URL
+
+        If the 'atom_feed_page_size' variable is set, the feed only contains
+        that many of the newest entries, and the older entries are written
+        to archive documents (see _make_feed_archives).
         """
 
         tp = TypicalPaths(self._framework, target_url)
-        data_dir = self._get_feed_data_dir()
-
-        def is_update_needed():
-            # Check if the feed needs to be updated
-            try:
-                output_mtime = os.lstat(tp.output_filename).st_mtime
-            except EnvironmentError as exc:
-                if exc.errno != errno.ENOENT:
-                    raise
-                # The output file doesn't exist, so an update is needed
-                return True
-
-            # Output file exists.  Check timestamps.
-            source_mtime = os.lstat(tp.source_filename).st_mtime
-            if output_mtime < source_mtime:
-                # The source file was modified, so an update is needed.
-                return True
-
-            for basename in fnmatch.filter(os.listdir(data_dir), "entry-*-stamp"):
-                entry_mtime = os.lstat(os.path.join(data_dir, basename)).st_mtime
-                if output_mtime < entry_mtime:
-                    # one of the entries is newer than the output file, so an update is needed
-                    return True
+        store = self._get_entry_store()
 
-            return False
+        now = atom_datetime_to_utc(datetime.datetime.utcnow().isoformat() + "Z")
 
-        if not is_update_needed():
+        page_size = self._get_feed_page_size()
+        if page_size is None:
+            settings_digest = None
+        else:
+            settings_digest = "page_size=%d" % (page_size,)
+
+        # Check if the feed needs to be updated.  The feed is built from the
+        # source file and the data of every entry, and it also changes when
+        # the publication date of a future entry passes.
+        manifest = self._framework.plugins['StillWeb.PageGenerator'].get_manifest()
+        max_stamp = store.get_max_stamp()
+        next_publish = store.get_feed_next_publish(tp.output_filename)
+        if (manifest.is_fresh(tp.output_filename, [tp.source_filename]) and store.get_feed_stamp(tp.output_filename) == max_stamp
+                and store.get_feed_digest(tp.output_filename) == settings_digest
+                and (next_publish is None or next_publish > now)):
             # No update needed
             print("skipping %s" % (tp.output_filename,))
+            self._report_next_publish(tp, next_publish)
             return
 
         # Make sure the output directory exists
@@ -182,114 +247,143 @@ class FeedGeneratorPlugin:
 
         print("making %s (using %s)" % (tp.output_filename, tp.source_filename))
 
-        # Load the entries
-        entries = []
-        regex = re.compile(r"^entry-([^-.]*)-stamp$")
-        for basename in os.listdir(data_dir):
-            m = regex.search(basename)
-            if not m:
-                continue
-            rootword = m.group(1)
-            filename = os.path.join(data_dir, "entry-%s-data" % (rootword,))
-            try:
-                f = open(filename, "rb")
-                entry = pickle.load(f)
-                f.close()
-            except EnvironmentError as exc:
-                if exc.errno == errno.ENOENT:
-                    continue
-                else:
-                    raise
-            entries.append(entry)
-
         # Check for duplicate ids
-        ids = {}
-        for entry in entries:
-            if entry['id'] in ids:
-                raise FGValueError("Duplicate id %r in %s (already defined in %s)" % (entry['id'], entry['path_info'].source_filename, ids[entry['id']]))
-            ids[entry['id']] = entry['path_info'].source_filename
-
-        # Skip entries whose publication dates are in the future
-        unpublished_entries = []
-        now = atom_datetime_to_utc(datetime.datetime.utcnow().isoformat() + "Z")
-        for i, entry in enumerate(entries):
-            if entry['published'] > now:
-                unpublished_entries.append(i)
-        for i in reversed(unpublished_entries):
-            print("%s: skipping %s ('published' in the future)" % (tp.output_filename, entry['path_info'].output_filename,))
-            del entries[i]
-
-        # Sort the entries by their publication date, newest first.
-        entries.sort(key=lambda entry: atom_datetime_to_sort_key(entry['published']), reverse=True)
+        duplicates = store.find_duplicate_ids()
+        if duplicates:
+            (id, source_filenames) = duplicates[0]
+            raise FGValueError("Duplicate id %r in %s (already defined in %s)" % (id, source_filenames[1], source_filenames[0]))
+
+        # Skip entries whose publication dates are in the future (but
+        # remember when the first of them is due).
+        unpublished_entries = store.get_unpublished_entries(now)
+        for entry in unpublished_entries:
+            print("%s: skipping %s ('published' in the future)" % (tp.output_filename, entry['output_filename'],))
+        if unpublished_entries:
+            next_publish = unpublished_entries[0]['published']
+        else:
+            next_publish = None
 
         # Find the most recent update
-        if not entries:
+        newest_entries = store.get_published_entries(now, limit=1)
+        if not newest_entries:
             raise FGValueError("Refusing to make empty feed")
-        most_recent_update = entries[0]['updated']
-
-        # Load and parse the template file
-        feedDocument = minidom.parseString(open(tp.source_filename, "rb").read())
-        feedElement = feedDocument.documentElement
-        assert (feedElement.namespaceURI, feedElement.localName) == (ATOM_NAMESPACE, "feed")
-
-        # Set <updated> to the newest entry's <updated> (or <published>) field
-        if tuple(getChildElementsNS(feedDocument, ATOM_NAMESPACE, "updated")):
-            raise FGValueError("Template contains auto-generated <updated> field")
-        updatedElement = feedDocument.createElementNS(ATOM_NAMESPACE, 'updated')
-        feedElement.appendChild(updatedElement)
-        replaceChildText(updatedElement, most_recent_update)
-
-        # Create a <link rel="self"> element if one does not already exist.
-        for linkElement in getChildElementsNS(feedElement, ATOM_NAMESPACE, "link"):
-            if linkElement.getAttribute('rel') == 'self':
-                break
-        else:
-            linkElement = feedDocument.createElementNS(ATOM_NAMESPACE, 'link')
-            linkElement.setAttribute('rel', 'self')
-            linkElement.setAttribute('type', ATOM_CONTENT_TYPE)
-            linkElement.setAttribute('href', tp.target_url)
-            feedElement.appendChild(linkElement)
+        most_recent_update = newest_entries[0]['updated']
+
+        # Write the archive documents (if any), and link to the newest one
+        links = []
+        archive_count = self._make_feed_archives(tp, now, page_size)
+        if archive_count:
+            links.append(('prev-archive', self._get_archive_url(tp, archive_count)))
+
+        # Write the feed, streaming the (already serialized) entries from the
+        # entry store, newest first
+        feedDocument = self._create_feed_document(tp, tp.target_url, most_recent_update, links)
+        self._write_feed(tp.output_filename, feedDocument, store.iter_published_entry_xml(now, page_size))
+        feedDocument.unlink()
+
+        # Remember what the feed was built from
+        manifest.record(tp.output_filename, [tp.source_filename])
+        store.set_feed_stamp(tp.output_filename, max_stamp, next_publish, settings_digest)
+        self._report_next_publish(tp, next_publish)
+
+    def handle_make_atom_feeds_by_category(self, target_url, category_url_pattern):
+        """Write an Atom feed of all entries, plus one for each category
+
+        Usage: make_atom_feeds_by_category TARGET_RELATIVE_URL CATEGORY_URL_PATTERN
+
+        The feed of all entries is made as by make_atom_feed.  Then there is
+        one feed for each category term used by a published <atom:entry>.
+        The feed's URL is CATEGORY_URL_PATTERN with "%s" replaced by the
+        (URL-quoted) term, e.g. "/tags/%s.atom".  Category feeds are made
+        from the same template, with the term added to the <title> and
+        <id>, and they are not split into archives.
+
+        The entry data is read once for all of the category feeds.  Only the
+        feeds whose entries have changed are rewritten, and feeds of
+        categories that are no longer used are deleted.
+        """
+        if category_url_pattern.count("%s") != 1:
+            raise FGValueError("CATEGORY_URL_PATTERN must contain %%s exactly once: %r" % (category_url_pattern,))
 
-        # Do URL path substitution
-        rewrite_links(feedElement, ATOM_CRITERIA, tp.target_url, tp.base_url, always_absolute=True)
+        # Make the feed of all entries
+        self.handle_make_atom_feed(target_url)
 
-        # Add the entries
-        for entry in entries:
-            # Create an <entry> element
-            entryElement = feedDocument.importNode(minidom.parseString(entry['atom:entry']).documentElement, True)
-            assert (entryElement.namespaceURI, entryElement.localName) == (ATOM_NAMESPACE, 'entry')
-            feedElement.appendChild(entryElement)
+        tp = TypicalPaths(self._framework, target_url)
+        store = self._get_entry_store()
+        manifest = self._framework.plugins['StillWeb.PageGenerator'].get_manifest()
+        now = atom_datetime_to_utc(datetime.datetime.utcnow().isoformat() + "Z")
 
+        # Group the published entries (newest first) by category
+        categories = {}
+        for (rootword, stamp, updated, terms) in store.get_published_entry_categories(now):
+            for term in terms:
+                categories.setdefault(term, []).append((rootword, stamp, updated))
+
+        # Write the category feeds whose entries have changed
+        output_filenames = set()
+        for (term, entries) in sorted(categories.items()):
+            if "/" in term or term in (".", ".."):
+                raise FGValueError("Category %r can't be used in a file name" % (term,))
+            ctp = TypicalPaths(self._framework, category_url_pattern % (urllib.parse.quote(term, safe=''),))
+            output_filenames.add(ctp.output_filename)
+
+            # A category feed is identified by its entries and their stamps
+            digest = hashlib.sha1(repr([(rootword, stamp) for (rootword, stamp, updated) in entries]).encode('UTF-8')).hexdigest()
+            if manifest.is_fresh(ctp.output_filename, [tp.source_filename]) and store.get_feed_digest(ctp.output_filename) == digest:
+                print("skipping %s" % (ctp.output_filename,))
+                continue
 
-        # Write the feed to the output file
-        if os.path.exists(tp.output_filename):
-            os.unlink(tp.output_filename)
-        output_file = open(tp.output_filename, "wb")
-        try:
-            output_file.write(feedDocument.toxml("UTF-8"))
-        except:
-            os.unlink(tp.output_filename)
-            raise
-        finally:
-            output_file.close()
+            self._framework.plugins['StillWeb.BasicCommands'].ensure_path(ctp.output_dir, ctp.pathtuple[:-1])
+            print("making %s (using %s)" % (ctp.output_filename, tp.source_filename))
+            feedDocument = self._create_feed_document(tp, ctp.target_url, entries[0][2], category=term)
+            self._write_feed(ctp.output_filename, feedDocument,
+                store.iter_entry_xml(rootword for (rootword, stamp, updated) in entries))
+            feedDocument.unlink()
+
+            manifest.record(ctp.output_filename, [tp.source_filename])
+            store.set_feed_stamp(ctp.output_filename, store.get_max_stamp(), None, digest, term)
+
+        # Delete the feeds of categories that are no longer used
+        (prefix, suffix) = TypicalPaths(self._framework, category_url_pattern % ("\0",)).output_filename.split("\0")
+        for (output_filename, term) in store.get_category_feeds():
+            if (output_filename.startswith(prefix) and output_filename.endswith(suffix)
+                    and output_filename not in output_filenames):
+                print("removing %s" % (output_filename,))
+                if os.path.exists(output_filename):
+                    os.unlink(output_filename)
+                store.remove_feed(output_filename)
+
+    def handle_scan_feed_entries(self, *target_urls):
+        """Collect the Atom entries of the given pages without building them
+
+        Only the <head> of each source is parsed, unless it contains an
+        <atom:entry>.  In that case, the page's content is loaded (and its
+        placeholders are processed) to build the entry, but the page isn't
+        rendered or written.
+
+        Usage: scan_feed_entries TARGET_RELATIVE_URL [...]
+        """
+        pg_plugin = self._framework.plugins['StillWeb.PageGenerator']
+        for target_url in target_urls:
+            tp = TypicalPaths(self._framework, target_url)
+            rootword = self._get_rootword_from_url(tp.orig_target_url)
+            print("scanning %s" % (tp.source_filename,))
+            if self._source_has_entry(tp.source_filename):
+                pg_plugin.load_page_content(target_url)
+            else:
+                self._do_clear_entry_data(rootword)
+            self._do_update_entry_timestamp(rootword)
 
     #
     # Filter callbacks
     #
 
     def _check_freshness(self, page_generator):
-        stamp_mtime = self._get_entry_timestamp(page_generator)
-        try:
-            html_output_mtime = os.lstat(page_generator.path_info.output_filename).st_mtime
-        except EnvironmentError as exc:
-            if exc.errno != errno.ENOENT:
-                raise
-            # If one of the files we're looking for doesn't exist, then they need to be updated.
-            raise NeedsUpdate
-
-        # Check if the entry's timestamp file is up-to-date.  If it's missing
-        # or older than the HTML output, then it needs to be updated.
-        if stamp_mtime is None or html_output_mtime > stamp_mtime:
+        # If the entry store doesn't know about the page, then the entry data
+        # needs to be updated.  (The PageGenerator's manifest takes care of
+        # everything else, since the page is recorded in the store before the
+        # page's output is recorded there.)
+        if not self._get_entry_store().has_page(self._get_entry_rootword(page_generator)):
             raise NeedsUpdate
 
     def _load_content(self, page_generator):
@@ -313,27 +407,30 @@ class FeedGeneratorPlugin:
             raise FGValueError("Too many Atom entries in %s" % (page_generator.path_info.source_filename,))
         (entryElement,) = entries
 
-        # Store the <atom:entry> element (with all namespace information included)
+        # Copy the <atom:entry> element (with all namespace information
+        # included) into a new document, where it will be processed.
         dummyDocument = minidom.parseString('<dummy/>')
         new_entryElement = dummyDocument.importNode(entryElement, True)
         dummyDocument.documentElement.appendChild(new_entryElement)
         normalize_namespaces(new_entryElement)
-        current_entry['atom:entry'] = new_entryElement.toxml()
+        dummyDocument.removeChild(dummyDocument.documentElement)
+        dummyDocument.appendChild(new_entryElement)
+        current_entry['atom:entry'] = new_entryElement
 
-        # Find and store the page summary (if any) in the <body> element, and un-set class="feed-summary".
+        # Find and copy the page summary (if any) in the <body> element, and un-set class="feed-summary".
         summaryElements = list(find_elements_with_class(content, "feed-summary", remove=True))
         if len(summaryElements) > 1:
             # There should only be one element with class="feed-summary"
             raise FGValueError('Too many elements have class="feed-summary" in %s' % (page_generator.path_info.source_filename,))
         elif summaryElements:
             # Save the summary
-            current_entry['summary'] = summaryElements[0].toxml()
+            current_entry['summary'] = dummyDocument.importNode(summaryElements[0], True)
         else:
             # Save an empty summary
             current_entry['summary'] = None
 
-        # Save the page body
-        current_entry['body'] = bodyElement.toxml()
+        # Copy the page body
+        current_entry['body'] = dummyDocument.importNode(bodyElement, True)
 
         # Save the page title
         (titleElement,) = getChildElementsNS(headElement, EMPTY_NAMESPACE, 'title')
@@ -345,7 +442,7 @@ class FeedGeneratorPlugin:
         # Perform some early processing
         self._early_process_entry(page_generator, current_entry)
 
-        # Write the entry to disk
+        # Write the entry to the entry store
         self._write_entry_data(page_generator, current_entry)
 
     def _filter_head(self, page_generator, headElement):
@@ -356,6 +453,25 @@ class FeedGeneratorPlugin:
     def _write_output(self, page_generator):
         self._update_entry_timestamp(page_generator)
 
+    #
+    # Parallel 'make' support
+    #
+    def _export_parallel_state(self):
+        (ops, self._worker_entry_ops) = (self._worker_entry_ops, [])
+        return ops
+
+    def _merge_parallel_state(self, ops):
+        # Apply the worker's entry data changes, so that only the main process
+        # ever writes to the feed data directory.
+        for (method_name, args) in ops:
+            getattr(self, method_name)(*args)
+
+        # Commit right away: the other workers read the store while the pages
+        # are being made, and a large uncommitted transaction would lock them
+        # out of the database until the barrier.
+        if ops:
+            self._commit_entry_store()
+
     #
     # Internal functions
     #
@@ -369,54 +485,290 @@ class FeedGeneratorPlugin:
 
     def _get_entry_rootword(self, page_generator):
         """Return the 'root word' of the current entry in the feed_data_dir"""
-        return urllib.parse.quote(page_generator.path_info.orig_target_url, safe='').replace(".", "%2E").replace("-", "%2D")
+        return self._get_rootword_from_url(page_generator.path_info.orig_target_url)
+
+    @staticmethod
+    def _get_rootword_from_url(orig_target_url):
+        return urllib.parse.quote(orig_target_url, safe='').replace(".", "%2E").replace("-", "%2D")
+
+    @staticmethod
+    def _source_has_entry(source_filename):
+        """Return True if the <head> of the given source might contain an <atom:entry>"""
+        source = open(source_filename, "rt", encoding="UTF-8").read()
+        m = re.search(r"</head\s*>", source, re.I)
+        if not m:
+            return True     # Can't tell without parsing the whole page
+        head = source[:m.end()]
+        if ATOM_NAMESPACE not in head:
+            return False
 
-    def _get_entry_timestamp(self, page_generator):
-        stamp_filename = os.path.join(self._get_feed_data_dir(), "entry-%s-stamp" % (self._get_entry_rootword(page_generator),))
+        # Parse only the <head> (TagSoupToXml closes the open elements)
+        p = TagSoupToXml(omit_comments=True, build_tree=True)
+        p.feed(head)
+        p.close()
+        document = p.todocument()
         try:
-            return os.lstat(stamp_filename).st_mtime
-        except EnvironmentError as exc:
-            if exc.errno != errno.ENOENT:
-                raise
+            return bool(document.getElementsByTagNameNS(ATOM_NAMESPACE, 'entry'))
+        finally:
+            document.unlink()
+
+    def _get_feed_page_size(self):
+        """Return the value of the 'atom_feed_page_size' variable (or None if it isn't set)"""
+        page_size = self._framework.plugins['vars'].vars.get('atom_feed_page_size')
+        if not page_size:
             return None
+        page_size = int(page_size)
+        if page_size < 1:
+            raise FGValueError("atom_feed_page_size must be at least 1")
+        return page_size
+
+    @staticmethod
+    def _get_archive_url(tp, number):
+        """Return the target URL of the given archive document of a feed"""
+        (root, ext) = os.path.splitext(tp.orig_target_url)
+        return "%s-archive-%d%s" % (root, number, ext)
+
+    def _make_feed_archives(self, tp, now, page_size):
+        """Write the archive documents of a feed, and return how many there are.
+
+        This implements archived feeds, as described in RFC 5005 section 4.
+        The published entries are divided into pages of page_size entries,
+        starting with the oldest, and each full page becomes an archive
+        document.  The newest entries that don't fill a page are only in the
+        feed itself.  The feed always holds the newest page_size entries, so
+        it overlaps the newest archive (and has the same entries as it if the
+        number of entries is a multiple of page_size).  Each archive links to
+        the previous one, but not to the next one, so an archive never
+        changes unless its entries do, and archives whose entries are
+        unchanged are not rewritten.
+
+        Archives that are no longer needed (e.g. if page_size is None) are
+        deleted.
+        """
+        store = self._get_entry_store()
+        manifest = self._framework.plugins['StillWeb.PageGenerator'].get_manifest()
+        if page_size is None:
+            keys = []
+            archive_count = 0
+        else:
+            keys = store.get_published_entry_keys(now)
+            archive_count = len(keys) // page_size
 
-    def _update_entry_timestamp(self, page_generator):
-        # Make sure the data directory exists
-        feed_data_dir = self._get_feed_data_dir()
+        for number in range(1, archive_count+1):
+            archive_keys = keys[(number-1)*page_size:number*page_size]
+            atp = TypicalPaths(self._framework, self._get_archive_url(tp, number))
 
-        # Touch the timestamp file
-        stamp_filename = os.path.join(feed_data_dir, "entry-%s-stamp" % (self._get_entry_rootword(page_generator),))
-        open(stamp_filename, "ab").close()
-        os.utime(stamp_filename, None)
+            # An archive is identified by its entries and their stamps
+            digest = hashlib.sha1(repr([(rootword, stamp) for (rootword, stamp, updated) in archive_keys]).encode('UTF-8')).hexdigest()
+            if manifest.is_fresh(atp.output_filename, [tp.source_filename]) and store.get_feed_digest(atp.output_filename) == digest:
+                continue
 
-    def _clear_entry_data(self, page_generator):
-        # Remove any existing entry data (needed if we remove an atom:entry element from a document)
-        feed_data_dir = self._get_feed_data_dir()
-        prefix = "entry-%s-" % (self._get_entry_rootword(page_generator),)
+            print("making %s (using %s)" % (atp.output_filename, tp.source_filename))
+            links = [('current', tp.target_url)]
+            if number > 1:
+                links.append(('prev-archive', self._get_archive_url(tp, number-1)))
+            feedDocument = self._create_feed_document(tp, atp.target_url, archive_keys[-1][2], links, archive=True)
+            self._write_feed(atp.output_filename, feedDocument,
+                store.iter_entry_xml(rootword for (rootword, stamp, updated) in reversed(archive_keys)))
+            feedDocument.unlink()
+
+            manifest.record(atp.output_filename, [tp.source_filename])
+            store.set_feed_stamp(atp.output_filename, store.get_max_stamp(), None, digest)
+
+        # Delete old archives
+        number = archive_count + 1
+        while True:
+            atp = TypicalPaths(self._framework, self._get_archive_url(tp, number))
+            if not os.path.exists(atp.output_filename) and store.get_feed_digest(atp.output_filename) is None:
+                break
+            print("removing %s" % (atp.output_filename,))
+            if os.path.exists(atp.output_filename):
+                os.unlink(atp.output_filename)
+            store.remove_feed(atp.output_filename)
+            number += 1
+
+        return archive_count
+
+    def _create_feed_document(self, tp, target_url, most_recent_update, links=(), archive=False, category=None):
+        """Return a new feed document (without any entries) built from the
+        feed template tp.source_filename.
+
+        target_url is the URL of the document (which is different from
+        tp.target_url for archive and category feeds), and links is a list
+        of (rel, target URL) pairs of additional <link> elements.  If archive
+        is True, the document is marked as an archive document (RFC 5005).
+        If category is given, the category term is added to the feed's
+        <title> and <id>.
+        """
+        # Load and parse the template file
+        feedDocument = minidom.parseString(open(tp.source_filename, "rb").read())
+        feedElement = feedDocument.documentElement
+        assert (feedElement.namespaceURI, feedElement.localName) == (ATOM_NAMESPACE, "feed")
+
+        # Give category feeds their own <title> and <id>
+        if category is not None:
+            for titleElement in getChildElementsNS(feedElement, ATOM_NAMESPACE, "title"):
+                if titleElement.getAttribute('type') in ('', 'text'):
+                    replaceChildText(titleElement, "%s: %s" % (getChildText(titleElement).strip(), category))
+            for idElement in getChildElementsNS(feedElement, ATOM_NAMESPACE, "id"):
+                replaceChildText(idElement, "%s/category/%s" % (getChildText(idElement).strip(), urllib.parse.quote(category, safe='')))
+
+        # Mark archive documents
+        if archive:
+            archiveElement = feedDocument.createElementNS(FH_NAMESPACE, 'fh:archive')
+            archiveElement.setAttributeNS(XMLNS_NAMESPACE, 'xmlns:fh', FH_NAMESPACE)
+            feedElement.appendChild(archiveElement)
+
+        # Set <updated> to the newest entry's <updated> (or <published>) field
+        if tuple(getChildElementsNS(feedDocument, ATOM_NAMESPACE, "updated")):
+            raise FGValueError("Template contains auto-generated <updated> field")
+        updatedElement = feedDocument.createElementNS(ATOM_NAMESPACE, 'updated')
+        feedElement.appendChild(updatedElement)
+        replaceChildText(updatedElement, most_recent_update)
+
+        # Create a <link rel="self"> element if one does not already exist.
+        for linkElement in getChildElementsNS(feedElement, ATOM_NAMESPACE, "link"):
+            if linkElement.getAttribute('rel') == 'self':
+                if target_url != tp.target_url:
+                    linkElement.setAttribute('href', target_url)
+                break
+        else:
+            linkElement = feedDocument.createElementNS(ATOM_NAMESPACE, 'link')
+            linkElement.setAttribute('rel', 'self')
+            linkElement.setAttribute('type', ATOM_CONTENT_TYPE)
+            linkElement.setAttribute('href', target_url)
+            feedElement.appendChild(linkElement)
+
+        # Add the other links
+        for (rel, href) in links:
+            linkElement = feedDocument.createElementNS(ATOM_NAMESPACE, 'link')
+            linkElement.setAttribute('rel', rel)
+            linkElement.setAttribute('type', ATOM_CONTENT_TYPE)
+            linkElement.setAttribute('href', href)
+            feedElement.appendChild(linkElement)
+
+        # Do URL path substitution
+        rewrite_links(feedElement, ATOM_CRITERIA, target_url, tp.base_url, always_absolute=True)
+
+        return feedDocument
+
+    @staticmethod
+    def _write_feed(output_filename, feedDocument, entries_xml):
+        """Write a feed to output_filename.
+
+        feedDocument contains the <feed> element without any entries, and
+        entries_xml is an iterable of UTF-8 encoded <atom:entry> elements,
+        which are written at the end of the <feed> element, in order.
+        Only the (small) feed header is serialized by minidom.
+        """
+        # Split the serialized feed before the </feed> tag
+        feed_xml = feedDocument.toxml("UTF-8")
+        i = feed_xml.rindex(b"</")
+        (head, tail) = (feed_xml[:i], feed_xml[i:])
+
+        if os.path.exists(output_filename):
+            os.unlink(output_filename)
+        output_file = open(output_filename, "wb")
         try:
-            listing = os.listdir(feed_data_dir)
-        except EnvironmentError as exc:
-            if exc.errno == errno.ENOENT:
-                pass
-            else:
-                raise
+            output_file.write(head)
+            for entry_xml in entries_xml:
+                output_file.write(entry_xml)
+            output_file.write(tail)
+        except:
+            os.unlink(output_filename)
+            raise
+        finally:
+            output_file.close()
+
+    def _parse_stored_entry(self, entry):
+        # Return the fields of a stored entry (see get_feed_entries)
+        page_content_type = self._framework.plugins['vars'].vars['page_content_type']
+        entryElement = minidom.parseString(entry['atom:entry']).documentElement
+        result = {'id': entry['id'], 'published': entry['published'], 'updated': entry['updated']}
+
+        # Get entry title
+        (titleElement,) = getChildElementsNS(entryElement, ATOM_NAMESPACE, 'title')
+        if titleElement.getAttribute('type') not in ('', 'text'):
+            raise FGValueError("Title of entry %r is not plain text" % (entry['id'],))
+        result['title'] = getChildText(titleElement)
+
+        # Get entry <link rel="alternate" type="text/html">
+        for e in getChildElementsNS(entryElement, ATOM_NAMESPACE, 'link'):
+            if e.getAttribute('rel') == "alternate" and e.getAttribute('type') == page_content_type and not e.getAttribute('hreflang'):
+                result['href'] = e.getAttribute('href')
+                break
+        else:
+            raise FGValueError('Entry %r has no <link rel="alternate" type=%r>' % (entry['id'], page_content_type))
+
+        # Get entry summary
+        result['summary'] = None
+        for summaryElement in getChildElementsNS(entryElement, ATOM_NAMESPACE, 'summary'):
+            assert summaryElement.getAttribute('type') == 'xhtml'
+            (result['summary'],) = (n for n in summaryElement.childNodes if n.nodeType == n.ELEMENT_NODE)
+
+        return result
+
+    @staticmethod
+    def _get_category_terms(entryElement):
+        """Return the terms of the <atom:category> elements of an entry"""
+        return [e.getAttribute('term') for e in getChildElementsNS(entryElement, ATOM_NAMESPACE, 'category')
+            if e.getAttribute('term')]
+
+    def _report_next_publish(self, tp, next_publish):
+        # Tell the user (or cron) when the feed should be rebuilt
+        if next_publish is not None:
+            print("%s: next rebuild due at %s (scheduled entry)" % (tp.output_filename, next_publish))
+
+    def _get_entry_store(self):
+        if self._entry_store is None:
+            self._entry_store = FeedEntryStore(os.path.join(self._get_feed_data_dir(), "entries.sqlite"))
+        return self._entry_store
+
+    def _commit_entry_store(self):
+        if self._entry_store is not None:
+            self._entry_store.commit()
+
+    def _entry_data_op(self, method_name, *args):
+        if self._framework.plugins['StillWeb.PageGenerator'].parallel_worker:
+            # Defer the change to the main process (see _merge_parallel_state)
+            self._worker_entry_ops.append((method_name, args))
         else:
-            for basename in listing:
-                if basename.startswith(prefix):
-                    os.unlink(os.path.join(feed_data_dir, basename))
+            getattr(self, method_name)(*args)
+
+    def _update_entry_timestamp(self, page_generator):
+        self._entry_data_op('_do_update_entry_timestamp', self._get_entry_rootword(page_generator))
+
+    def _clear_entry_data(self, page_generator):
+        self._entry_data_op('_do_clear_entry_data', self._get_entry_rootword(page_generator))
 
     def _write_entry_data(self, page_generator, data):
-        feed_data_dir = self._get_feed_data_dir()
-        filename = os.path.join(feed_data_dir, "entry-%s-data" % (self._get_entry_rootword(page_generator),))
-        f = open(filename, "wb")
-        pickle.dump(data, f)
-        f.close()
+        # Store only the fields we need (not the whole path_info)
+        entry = dict((k, data[k]) for k in ('id', 'published', 'updated', 'title', 'atom:entry'))
+        entry['published_key'] = "%sT%s.%07d" % atom_datetime_to_sort_key(data['published'])
+        entry['categories'] = "\n".join(data['categories'])
+        entry['source_filename'] = page_generator.path_info.source_filename
+        entry['output_filename'] = page_generator.path_info.output_filename
+        self._entry_data_op('_do_write_entry_data', self._get_entry_rootword(page_generator), entry)
+
+    def _do_update_entry_timestamp(self, rootword):
+        self._get_entry_store().touch_page(rootword)
+
+    def _do_clear_entry_data(self, rootword):
+        # Remove any existing entry data (needed if we remove an atom:entry element from a document)
+        self._get_entry_store().clear_entry(rootword)
+
+    def _do_write_entry_data(self, rootword, entry):
+        self._get_entry_store().write_entry(rootword, entry)
 
     def _early_process_entry(self, page_generator, entry):
-        """Perform early in-place processing of an entry."""
+        """Perform early in-place processing of an entry.
 
-        entryDocument = minidom.parseString(entry['atom:entry'])
-        entryElement = entryDocument.documentElement
+        The entry's elements are modified in place, and the finished
+        <atom:entry> element is serialized (once) at the end.
+        """
+
+        entryElement = entry['atom:entry']
+        entryDocument = entryElement.ownerDocument
         page_content_type = self._framework.plugins['vars'].vars['page_content_type']
 
         # Extract the 'id' of the entry
@@ -438,6 +790,9 @@ class FeedGeneratorPlugin:
             entryElement.appendChild(updatedElement)
         entry['updated'] = atom_datetime_to_utc(getChildText(updatedElement).strip())
 
+        # Extract the categories of the entry
+        entry['categories'] = self._get_category_terms(entryElement)
+
         # Create a <title> element if one does not already exist.
         ee = tuple(getChildElementsNS(entryElement, ATOM_NAMESPACE, 'title'))
         if not ee:
@@ -470,10 +825,10 @@ class FeedGeneratorPlugin:
 
         # Add a <summary> element, if applicable
         if entry['summary']:
-            summaryDocument = minidom.parseString(entry['summary'])
+            summaryCopy = entry['summary']
 
             # Rewrite URLs in the summary
-            rewrite_links(summaryDocument.documentElement, HTML_CRITERIA,
+            rewrite_links(summaryCopy, HTML_CRITERIA,
                 entry['path_info'].target_url, entry['path_info'].base_url, always_absolute=True)
 
             # Create Atom <summary> element
@@ -487,24 +842,22 @@ class FeedGeneratorPlugin:
             summaryElement.appendChild(divElement)
 
             # Add data
-            for n in summaryDocument.documentElement.childNodes:
-                divElement.appendChild(divElement.ownerDocument.importNode(n, True))
+            for n in list(summaryCopy.childNodes):
+                divElement.appendChild(n)
 
             # Elements with no namespace become XHTML elements
             substitute_namespaces(divElement, {EMPTY_NAMESPACE: XHTML_NAMESPACE})
 
             # Clean up
-            data = None
-            summaryDocument.unlink()
-            summaryDocument = None
+            summaryCopy = None
             del entry['summary']
 
         # Add a <content> element
         if True:
-            bodyDocument = minidom.parseString(entry['body'])
+            bodyCopy = entry['body']
 
             # Rewrite URLs in the body
-            rewrite_links(bodyDocument.documentElement, HTML_CRITERIA,
+            rewrite_links(bodyCopy, HTML_CRITERIA,
                 entry['path_info'].target_url, entry['path_info'].base_url, always_absolute=True)
 
             # Create Atom <content> element
@@ -518,23 +871,23 @@ class FeedGeneratorPlugin:
             contentElement.appendChild(divElement)
 
             # Add data
-            for n in bodyDocument.documentElement.childNodes:
-                divElement.appendChild(divElement.ownerDocument.importNode(n, True))
+            for n in list(bodyCopy.childNodes):
+                divElement.appendChild(n)
 
             # Elements with no namespace become XHTML elements
             substitute_namespaces(divElement, {EMPTY_NAMESPACE: XHTML_NAMESPACE})
 
             # Clean up
-            data = None
-            bodyDocument.unlink()
-            bodyDocument = None
+            bodyCopy = None
             del entry['body']
 
         # Perform xmlns normalization
-        normalize_namespaces(entryDocument.documentElement, strip_dups=True)
+        normalize_namespaces(entryElement, strip_dups=True)
 
-        # Update the new atom:entry document
-        entry['atom:entry'] = entryDocument.toxml()
+        # Serialize the finished <atom:entry> element.  (It's stored without
+        # an XML declaration, so that it can be spliced into the feed as-is.)
+        entry['atom:entry'] = entryElement.toxml()
+        entryDocument.unlink()
 
 def create_plugin(framework):
     return FeedGeneratorPlugin(framework)
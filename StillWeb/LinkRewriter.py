@@ -2,8 +2,10 @@
 # LinkRewriter.py - Link (URL) rewriting
 # Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
 
-from StillWeb.sw_urllib import rebase_url, rfc3986_urljoin, relative_url
-from StillWeb.sw_util import generate_fake_url, getChildText, replaceChildText
+import collections
+
+from StillWeb.sw_urllib import ParsedURL
+from StillWeb.sw_util import getChildText, replaceChildText
 
 HTML_CRITERIA = [
     (None,                  (None, "href")),
@@ -39,27 +41,71 @@ class LinkRewriter:
         """
         self._criteria = list(match_criteria)
 
-    def match_element(self, node):
-        assert node.nodeType == node.ELEMENT_NODE
-        for criterion in self._criteria:
+        # Compile the criteria into lookup tables, so that matching an element
+        # costs one dictionary lookup (plus one per attribute).  Each table
+        # entry is (index, criterion, element namespaceURI, attribute
+        # namespaceURI); the index is used to report matches in the same
+        # order as the criteria.
+        #
+        #   self._content_index: element localName -> [entry, ...]
+        #   self._attribute_index: element localName -> {attribute localName: [entry, ...]}
+        #
+        # Elements whose localName isn't in the tables use the entries stored
+        # under None (i.e. the criteria that match any element).
+        content_index = {None: []}
+        attribute_index = {None: {}}
+        for (i, criterion) in enumerate(self._criteria):
             (c_elem, c_attr) = criterion
             if c_elem is not None:
-                (namespaceURI, localName) = c_elem
-                if namespaceURI is not None and node.namespaceURI != namespaceURI:
-                    continue
-                if node.localName != localName:
-                    continue
-            if c_attr is None:
-                yield (self.MATCHED_ELEMENT, node, criterion)
+                content_index.setdefault(c_elem[1], [])
+                attribute_index.setdefault(c_elem[1], {})
+        for (i, criterion) in enumerate(self._criteria):
+            (c_elem, c_attr) = criterion
+            if c_elem is None:
+                (elem_ns, elem_names) = (None, list(content_index.keys()))
             else:
-                (namespaceURI, localName) = c_attr
-                for i in range(node.attributes.length):
-                    a = node.attributes.item(i)
-                    if namespaceURI is not None and a.namespaceURI != namespaceURI:
+                (elem_ns, elem_names) = (c_elem[0], [c_elem[1]])
+            for elem_name in elem_names:
+                if c_attr is None:
+                    content_index[elem_name].append((i, criterion, elem_ns, None))
+                else:
+                    attribute_index[elem_name].setdefault(c_attr[1], []).append((i, criterion, elem_ns, c_attr[0]))
+        self._content_index = content_index
+        self._attribute_index = attribute_index
+
+    def match_element(self, node):
+        assert node.nodeType == node.ELEMENT_NODE
+        localName = node.localName
+        content_entries = self._content_index.get(localName)
+        if content_entries is None:
+            content_entries = self._content_index[None]
+            attribute_table = self._attribute_index[None]
+        else:
+            attribute_table = self._attribute_index[localName]
+
+        matches = []    # list of (criterion index, attribute position, match)
+        for (i, criterion, elem_ns, attr_ns) in content_entries:
+            if elem_ns is not None and node.namespaceURI != elem_ns:
+                continue
+            matches.append((i, -1, (self.MATCHED_ELEMENT, node, criterion)))
+        if attribute_table and node.attributes:
+            attributes = node.attributes
+            for pos in range(attributes.length):
+                a = attributes.item(pos)
+                entries = attribute_table.get(a.localName)
+                if entries is None:
+                    continue
+                for (i, criterion, elem_ns, attr_ns) in entries:
+                    if elem_ns is not None and node.namespaceURI != elem_ns:
                         continue
-                    if a.localName != localName:
+                    if attr_ns is not None and a.namespaceURI != attr_ns:
                         continue
-                    yield (self.MATCHED_ATTRIBUTE, (a.namespaceURI, a.localName), criterion)
+                    matches.append((i, pos, (self.MATCHED_ATTRIBUTE, (a.namespaceURI, a.localName), criterion)))
+
+        if len(matches) > 1:
+            matches.sort(key=lambda m: m[:2])
+        for m in matches:
+            yield m[2]
 
     def rewrite_links(self, node, callback_func):
         """Rewrite links inside a document.
@@ -92,27 +138,103 @@ class LinkRewriter:
             if n.nodeType == node.ELEMENT_NODE:
                self.rewrite_links(n, callback_func)
 
-def rewrite_links(node, match_criteria, target_url, base_url, always_absolute=False):
-    # We generate a fake URL so links like <a href="/">...</a> will resolve
-    # to the top-level URL of the *site* rather than of the *server*.
-    fake_base_url = generate_fake_url()
-    fake_current_url = rfc3986_urljoin(fake_base_url, target_url)
-    real_base_url = base_url
-    real_current_url = rebase_url(fake_current_url, fake_base_url, real_base_url)
+# Links are resolved with respect to a fixed fake base URL (rather than a
+# random one), so that the results can be memoized across calls.  The
+# ".invalid" TLD is reserved (RFC 2606), so no real link can point there.
+FAKE_BASE_URL = "http://stillweb.invalid/"
 
-    def cb(url, criterion):
+class URLResolutionCache:
+    """Bounded LRU cache of the link URLs resolved by rewrite_links().
+
+    Entries are keyed by (base_url, directory of the current page, link URL,
+    always_absolute), so the template's navigation links are resolved only
+    once per directory instead of once per page.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()   # map key -> (result URL, absolute path of the link)
+
+    def lookup(self, key, current_path, resolve_func):
+        """Return the resolved URL for `key`, calling resolve_func() if necessary.
+
+        resolve_func() must return (result URL, absolute path of the link).
+        """
+        entry = self._entries.get(key)
+        if entry is not None and not _depends_on_filename(entry[1], current_path):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        entry = resolve_func()
+        if not _depends_on_filename(entry[1], current_path):
+            self._entries[key] = entry
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry[0]
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+def _depends_on_filename(link_path, current_path):
+    """Return True if the link resolved to `link_path` might be rewritten
+    differently on another page in the same directory as `current_path`
+    (i.e. it refers to the current page itself, or to something "inside" it).
+    """
+    return link_path == current_path or link_path.startswith(current_path + "/")
+
+default_url_cache = URLResolutionCache()
+
+# The compiled LinkRewriter for each set of match criteria used by
+# rewrite_links(), so that the criteria are only indexed once
+_link_rewriters = {}
+
+def _get_link_rewriter(match_criteria):
+    """Return a (shared) LinkRewriter for the given match criteria"""
+    key = tuple(match_criteria)
+    link_rewriter = _link_rewriters.get(key)
+    if link_rewriter is None:
+        link_rewriter = _link_rewriters[key] = LinkRewriter(key)
+    return link_rewriter
+
+def rewrite_links(node, match_criteria, target_url, base_url, always_absolute=False, url_cache=None):
+    if url_cache is None:
+        url_cache = default_url_cache
+
+    # We use a fake URL so links like <a href="/">...</a> will resolve
+    # to the top-level URL of the *site* rather than of the *server*.
+    fake_base = ParsedURL.parse(FAKE_BASE_URL)
+    fake_current = fake_base.join(target_url)
+    real_base = ParsedURL.parse(base_url)
+    real_current = fake_current.rebase(fake_base, real_base)
+    fake_current_url = str(fake_current)
+    fake_current_dir = fake_current_url[:fake_current_url.rfind("/")+1]
+
+    def resolve(url):
         # Resolve the link URL with respect to the current (fake) URL
-        link_url = rfc3986_urljoin(fake_current_url, url)
+        link = fake_current.join(url)
 
         # Convert the fake URL into an absolute real URL
-        link_url = rebase_url(link_url, fake_base_url, real_base_url)
+        link = link.rebase(fake_base, real_base)
+        link_path = link.path
 
         if not always_absolute:
             # Convert the absolute URL into a relative URL
-            link_url = relative_url(link_url, real_current_url)
+            link = link.relative_to(real_current)
 
-        return link_url
+        return (str(link), link_path)
+
+    def cb(url, criterion):
+        key = (base_url, fake_current_dir, url, always_absolute)
+        return url_cache.lookup(key, real_current.path, lambda: resolve(url))
 
-    LinkRewriter(match_criteria).rewrite_links(node, cb)
+    _get_link_rewriter(match_criteria).rewrite_links(node, cb)
 
 # vim:set ts=4 sw=4 sts=4 expandtab:
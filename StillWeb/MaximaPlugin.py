@@ -2,22 +2,189 @@
 # MaximaPlugin.py - GNU maxima plugin for StillWeb
 # Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
 
+import os
+import re
+import errno
+import select
+import shutil
+import hashlib
 import subprocess
-import tempfile
+import time
 
 from StillWeb.Placeholders import ReplaceWithHTML, ReplaceWithNode, ReplaceWithNothing, PLACEHOLDERS_NAMESPACE
-from StillWeb.sw_util import getChildText, TypicalPaths, ensure_path
+from StillWeb.sw_util import getChildText, TypicalPaths, ensure_path, write_file_atomically
+
+class MaximaError(RuntimeError):
+    pass
+
+class MaximaTimeoutError(MaximaError):
+    pass
+
+class MaximaSession(object):
+    """A long-lived GNU maxima process that converts expressions to TeX code.
+
+    Each request is written to maxima's standard input, and maxima prints
+    the result between marker lines containing the request's serial number:
+
+        STILLWEB-BEGIN <serial>
+        <TeX code>
+        STILLWEB-END <serial>
+
+    or "STILLWEB-ERROR <serial>" if maxima couldn't evaluate the expression.
+    Anything else maxima prints (warnings, error messages, etc.) is collected
+    and used in error messages.
+
+    If maxima dies, it is restarted and the request is tried once more.  If
+    a request takes longer than `timeout` seconds, maxima is killed (and
+    started again for the next request).
+    """
+
+    # Commands sent to maxima when it starts
+    STARTUP_COMMANDS = "display2d: false$\n"
+
+    def __init__(self, program="maxima", timeout=60):
+        self.program = program
+        self.timeout = timeout
+        self._proc = None
+        self._pid = None
+        self._buffer = b""
+        self._serial = 0
+
+    def start(self):
+        self._proc = subprocess.Popen([self.program, "--very-quiet"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self._pid = os.getpid()
+        self._buffer = b""
+        self._write(self.STARTUP_COMMANDS)
+
+    def close(self):
+        if self._proc is not None and self._pid == os.getpid():
+            try:
+                self._proc.stdin.close()
+            except EnvironmentError:
+                pass
+            try:
+                self._proc.wait(5)
+            except subprocess.TimeoutExpired:
+                self._proc.kill()
+                self._proc.wait()
+            self._proc.stdout.close()
+        # (If we're in a forked child process, the maxima process belongs to
+        # the parent, so it's left alone.)
+        self._proc = None
+
+    def kill(self):
+        if self._proc is not None and self._pid == os.getpid():
+            self._proc.kill()
+            self._proc.wait()
+            self._proc.stdin.close()
+            self._proc.stdout.close()
+        self._proc = None
+
+    def tex(self, maxima_expression):
+        """Return the TeX code for the given maxima expression"""
+        try:
+            return self._request(maxima_expression)
+        except EOFError:
+            # maxima died.  Try again with a new process.
+            self.kill()
+            try:
+                return self._request(maxima_expression)
+            except EOFError as exc:
+                self.kill()
+                raise MaximaError("maxima exited unexpectedly (expression=%r): %s" % (maxima_expression, exc.args[0]))
+
+    def _request(self, maxima_expression):
+        if self._proc is None or self._pid != os.getpid():
+            self.start()
+
+        self._serial += 1
+        serial = self._serial
+        quoted_expression = '"%s"' % (maxima_expression.replace("\\", "\\\\").replace('"', '\\"'),)
+
+        # Forget anything defined by earlier expressions, so that each
+        # expression gets a fresh environment (like a new maxima process).
+        # linel is set after kill(all), since kill(all) resets it.
+        self._write("kill(all)$\n"
+            "linel: 1000000$\n"
+            "block([r: errcatch(tex(eval_string(%s), false))],"
+            " if r = [] then print(\"STILLWEB-ERROR %d\")"
+            " else (print(\"STILLWEB-BEGIN %d\"), print(first(r)), print(\"STILLWEB-END %d\")))$\n" % (
+                quoted_expression, serial, serial, serial))
+
+        # Read the result
+        deadline = time.time() + self.timeout
+        other_lines = []
+        result_lines = None
+        while True:
+            try:
+                line = self._readline(deadline)
+            except MaximaTimeoutError:
+                self.kill()
+                raise MaximaTimeoutError("maxima timed out after %r seconds (expression=%r)" % (self.timeout, maxima_expression))
+            except EOFError:
+                raise EOFError("\n".join(other_lines))
+            # (maxima may pad printed lines with whitespace)
+            marker = line.strip()
+            if result_lines is None:
+                if marker == "STILLWEB-BEGIN %d" % (serial,):
+                    result_lines = []
+                elif marker == "STILLWEB-ERROR %d" % (serial,):
+                    raise MaximaError("maxima could not evaluate expression %r: %s" % (maxima_expression, "\n".join(other_lines).strip()))
+                else:
+                    other_lines.append(line)
+            elif marker == "STILLWEB-END %d" % (serial,):
+                return "\n".join(result_lines)
+            else:
+                result_lines.append(line)
+
+    def _write(self, commands):
+        try:
+            self._proc.stdin.write(commands.encode('UTF-8'))
+            self._proc.stdin.flush()
+        except BrokenPipeError:
+            raise EOFError("broken pipe")
+
+    def _readline(self, deadline):
+        fd = self._proc.stdout.fileno()
+        while b"\n" not in self._buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise MaximaTimeoutError()
+            (readable, writable, exceptional) = select.select([fd], [], [], remaining)
+            if not readable:
+                continue
+            data = os.read(fd, 65536)
+            if not data:
+                raise EOFError()
+            self._buffer += data
+        (line, self._buffer) = self._buffer.split(b"\n", 1)
+        return line.decode('UTF-8', 'replace').rstrip("\r")
+
 
 class MaximaPlugin:
+
+    # Bump this if the way results are generated changes
+    CACHE_FORMAT = 1
+
     def __init__(self, framework):
         self._framework = framework
 
+        # The maxima process (see _get_session)
+        self._session = None
+
+        # The result cache directory (see _get_cache_dir)
+        self._cache_dir = None
+
         # Register the placeholder namespace
         ph_plugin = self._framework.plugins['StillWeb.Placeholders']
         ph_plugin.register_callback(self._handle_maxima_element, PLACEHOLDERS_NAMESPACE, 'maxima')
 
     def cleanup(self):
         if self._framework is not None:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
             self._framework = None
 
     #
@@ -29,25 +196,78 @@ class MaximaPlugin:
     #
     # Exported API
     #
-    def maxima_expression_placeholder(self, maxima_expression):
+    def maxima_expression_placeholder(self, maxima_expression, force_img=False):
         # SECURITY WARNING: This allows execution of arbitrary Maxima code
-        command_file = tempfile.NamedTemporaryFile('w+t', encoding="ascii")
-        output_file = tempfile.NamedTemporaryFile('w+t', encoding="ascii")
-        maxima_command = """tex(%s, "%s");""" % (maxima_expression, output_file.name)
-        command_file.write(maxima_command)
-        command_file.flush()
 
-        # Feed the expression to GNU maxima
-        args = ['maxima', b'--very-quiet', b'--batch=' + command_file.name.encode('ascii')]
-        subprocess.check_call(args)
+        # Look for the TeX code in the cache
+        cache_filename = os.path.join(self._get_cache_dir(),
+            "%s.tex" % (hashlib.md5(maxima_expression.encode('UTF-8')).hexdigest(),))
+        try:
+            tex_code = open(cache_filename, "rt", encoding="UTF-8").read()
+        except EnvironmentError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
 
-        tex_code = output_file.read().strip().strip("$")    # Strip leading and trailing whitespace and dollar-signs
+            # Feed the expression to GNU maxima
+            tex_code = self._get_session().tex(maxima_expression)
+            tex_code = tex_code.strip().strip("$")  # Strip leading and trailing whitespace and dollar-signs
 
-        output_file.close()
-        command_file.close()
+            # Cache the result
+            write_file_atomically(cache_filename, tex_code.encode('UTF-8'))
 
         # Use TeXPlugin to complete the placeholder
-        return self._framework.plugins['StillWeb.TeXPlugin'].math_placeholder(tex_code)
+        return self._framework.plugins['StillWeb.TeXPlugin'].math_placeholder(tex_code, force_img=force_img)
+
+    #
+    # Internal functions
+    #
+    def _get_session(self):
+        vars = self._framework.plugins['vars'].vars
+        program = vars.get('maxima_program', 'maxima')
+        timeout = float(vars.get('maxima_timeout', '60'))
+        if self._session is None or self._session.program != program:
+            if self._session is not None:
+                self._session.close()
+            self._session = MaximaSession(program, timeout)
+        self._session.timeout = timeout
+        return self._session
+
+    def _get_cache_dir(self):
+        """Return the directory containing the cached results for the
+        current version of maxima.
+
+        Results are stored in a subdirectory named after a fingerprint of
+        the maxima program (its real path, size and modification time), so
+        upgrading maxima invalidates the cache without having to start
+        maxima to ask for its version.
+        """
+        vars = self._framework.plugins['vars'].vars
+        program = vars.get('maxima_program', 'maxima')
+        key = (vars['intermediate_data_dir'], program)
+        if self._cache_dir is None or self._cache_dir[0] != key:
+            top_dir = os.path.join(vars['intermediate_data_dir'], "StillWeb.MaximaPlugin")
+
+            fingerprint = [self.CACHE_FORMAT]
+            program_path = shutil.which(program)
+            if program_path is not None:
+                program_path = os.path.realpath(program_path)
+                st = os.stat(program_path)
+                fingerprint += [program_path, st.st_size, st.st_mtime]
+            else:
+                fingerprint += [program]
+            fingerprint = hashlib.md5(repr(fingerprint).encode('UTF-8')).hexdigest()
+            cache_dir = os.path.join(top_dir, fingerprint)
+
+            if not os.path.isdir(cache_dir):
+                # Remove the results from other versions of maxima
+                if os.path.isdir(top_dir):
+                    for basename in os.listdir(top_dir):
+                        if re.search(r"\A[0-9a-f]{32}\Z", basename):
+                            shutil.rmtree(os.path.join(top_dir, basename), ignore_errors=True)
+                ensure_path(cache_dir)
+
+            self._cache_dir = (key, cache_dir)
+        return self._cache_dir[1]
 
 def create_plugin(framework):
     return MaximaPlugin(framework)
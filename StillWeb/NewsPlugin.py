@@ -2,31 +2,107 @@
 # NewsPlugin.py - Generate list of articles from an Atom feed
 # Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
 
-import os
-import errno
+import hashlib
 from xml.dom import minidom
 
-from StillWeb.sw_util import TypicalPaths, getChildElementsNS, getChildText
+from StillWeb.sw_util import TypicalPaths, getChildElementsNS
 from StillWeb.NamespaceNormalization import normalize_namespaces
-from StillWeb.PageGenerator import NeedsUpdate
-from StillWeb.FeedGenerator import ATOM_NAMESPACE, atom_datetime_to_utc
+from StillWeb.FeedGenerator import atom_datetime_to_utc
 from StillWeb.Placeholders import ReplaceWithNode
 
 # XML Namespace for news
 NEWS_NAMESPACE = "tag:dlitz.net,2008:StillWeb.NewsPlugin"
 
+def _format_date(s):
+    return atom_datetime_to_utc(s).replace("T", " ").replace("Z", " UTC")    # HACK FIXME - pretty-print
+
+class NewsTemplate:
+    """A compiled <news:template> element.
+
+    The template is copied once into a private document, with a marker in
+    place of each news:*-here element, and the position of each slot (i.e.
+    marker or news:a element) is recorded as a path of child indexes.  An
+    entry is rendered by importing the copy and filling in the slots, so
+    the template doesn't have to be walked again for every entry.
+    """
+
+    def __init__(self, templateElement):
+        self._document = minidom.parseString("<div/>")
+        self._slots = []    # list of (path, slot name), in document order
+        self._compile(templateElement, self._document.documentElement, ())
+
+    def _compile(self, src, dest, path):
+        for node in src.childNodes:
+            node_path = path + (len(dest.childNodes),)
+            if node.nodeType == node.ELEMENT_NODE and node.namespaceURI == NEWS_NAMESPACE:
+                if node.localName in ('title-here', 'summary-here', 'published-here', 'updated-here'):
+                    dest.appendChild(self._document.createComment(node.localName))
+                    self._slots.append((node_path, node.localName))
+                    continue
+                elif node.localName == 'a':
+                    new_node = self._document.createElement('a')
+
+                    # Import attributes (SECURITY: This is perhaps too liberal)
+                    for i in range(node.attributes.length):
+                        attrNode = node.attributes.item(i)
+                        new_node.setAttributeNode(self._document.importNode(attrNode, deep=True))
+
+                    self._slots.append((node_path, 'a'))
+                else:
+                    raise ValueError("Illegal element name: %r" % (node.tagName,))
+            else:
+                new_node = self._document.importNode(node, deep=False)
+            dest.appendChild(new_node)
+
+            # Recurse
+            if node.nodeType == node.ELEMENT_NODE:
+                self._compile(node, new_node, node_path)
+
+    def render(self, document, entry):
+        """Return a new <div> element (owned by `document`) for the given
+        entry (see FeedGeneratorPlugin.get_feed_entries)
+        """
+        divElement = document.importNode(self._document.documentElement, True)
+
+        # Fill in the slots, last first (so that removing a marker doesn't
+        # change the paths of the slots that haven't been filled yet)
+        for (path, name) in reversed(self._slots):
+            node = divElement
+            for i in path:
+                node = node.childNodes[i]
+            if name == 'a':
+                node.setAttribute('href', entry['href'])
+                continue
+            elif name == 'title-here':
+                new_node = document.createTextNode(entry['title'])
+            elif name == 'summary-here':
+                if entry['summary'] is None:
+                    node.parentNode.removeChild(node)
+                    continue
+                new_node = document.importNode(entry['summary'], deep=True)
+            elif name == 'published-here':
+                new_node = document.createTextNode(_format_date(entry['published']))
+            elif name == 'updated-here':
+                new_node = document.createTextNode(_format_date(entry['updated']))
+            node.parentNode.replaceChild(new_node, node)
+        return divElement
+
+
 class NewsPlugin:
     def __init__(self, framework):
         self._framework = framework
         self._feed_url = None
         self._feed_path_info = None
 
+        # Compiled templates, keyed by the hash of the <news:template> element
+        self._templates = {}
+
         pg_plugin = self._framework.plugins['StillWeb.PageGenerator']
         pg_plugin.register_filter('check_freshness', self._check_freshness)
 
         # Register the placeholder namespace
         ph_plugin = self._framework.plugins['StillWeb.Placeholders']
-        ph_plugin.register_callback(self._handle_news_element, NEWS_NAMESPACE, 'news')
+        ph_plugin.register_callback(self._handle_news_element, NEWS_NAMESPACE, 'news', memoize=self._news_element_dependencies)
 
         framework.plugins['StillWeb.ScriptProcessor'].register_command('set_news_feed', self.handle_set_news_feed)
 
@@ -35,6 +111,7 @@ class NewsPlugin:
             self._framework = None
             self._feed_url = None
             self._feed_path_info = None
+            self._templates = None
 
     #
     # Commands
@@ -47,21 +124,31 @@ class NewsPlugin:
     #
     # Placeholder callback(s)
     #
+    def _news_element_dependencies(self, page_generator, c_newsElement):
+        # The result of _handle_news_element only changes when the feed does.
+        if self._feed_url is None:
+            return None
+        page_generator.add_dependency(self._feed_path_info.output_filename)
+        return (self._feed_url, page_generator.manifest.file_digest(self._feed_path_info.output_filename),
+            self._framework.plugins['vars'].vars['page_content_type'])
+
     def _handle_news_element(self, page_generator, c_newsElement):
         if self._feed_url is None:
             raise ValueError("news-here element found before set_news_feed called")
 
-        # Find the template element
+        # Find and compile the template element (unless the same template has
+        # already been compiled)
         (c_templateElement,) = getChildElementsNS(c_newsElement, NEWS_NAMESPACE, 'template')
+        key = hashlib.sha1(c_templateElement.toxml().encode('UTF-8')).hexdigest()
+        template = self._templates.get(key)
+        if template is None:
+            template = self._templates[key] = NewsTemplate(c_templateElement)
 
         # Create the result document
         result_doc = minidom.parseString("<div/>")
 
-        # Load the Atom feed
-        feed = minidom.parseString(open(self._feed_path_info.output_filename, "rb").read())
-
-        # Get the content-type of page links
-        page_content_type = self._framework.plugins['vars'].vars['page_content_type']
+        # The page needs to be rebuilt if the contents of the feed change.
+        page_generator.add_dependency(self._feed_path_info.output_filename)
 
         # Get the maximum number of entries (if any)
         limit = c_newsElement.getAttribute('limit')
@@ -70,46 +157,12 @@ class NewsPlugin:
         else:
             limit = int(limit)
 
-        for i, f_entryElement in enumerate(getChildElementsNS(feed.documentElement, ATOM_NAMESPACE, 'entry')):
-            # Don't output more than the specified number of articles
-            if limit is not None and i >= limit:
-                break
-
-            params = {}
-
-            # Get entry title
-            (f_titleElement,) = getChildElementsNS(f_entryElement, ATOM_NAMESPACE, 'title')
-            assert f_titleElement.getAttribute('type') == 'text'
-            params['title'] = getChildText(f_titleElement)
-
-            # Get entry publication/update dates
-            params['published'] = getChildText(tuple(getChildElementsNS(f_entryElement, ATOM_NAMESPACE, 'published'))[0])
-            params['updated'] = getChildText(tuple(getChildElementsNS(f_entryElement, ATOM_NAMESPACE, 'updated'))[0])
-
-            # Get entry <link rel="alternate" type="text/html">
-            ee = getChildElementsNS(f_entryElement, ATOM_NAMESPACE, 'link')
-            for e in ee:
-                rel = e.getAttribute('rel')
-                type = e.getAttribute('type')
-                hreflang = e.getAttribute('hreflang')
-                if rel == "alternate" and type == page_content_type and not hreflang:
-                    params['href'] = e.getAttribute('href')
-                    break
-            else:
-                raise RuntimeError("link not found")
-
-            # Get entry summary
-            (f_summaryElement,) = getChildElementsNS(f_entryElement, ATOM_NAMESPACE, 'summary')
-            assert f_summaryElement.getAttribute('type') == 'xhtml'
-            (f_summaryDiv,) = (n for n in f_summaryElement.childNodes if n.nodeType == n.ELEMENT_NODE)
-            params['summaryDiv'] = f_summaryDiv
-
-            # Create per-entry <div> element
-            r_divElement = result_doc.createElement('div')
-            result_doc.documentElement.appendChild(r_divElement)
+        # Get the newest entries of the feed (without parsing the whole feed)
+        entries = self._framework.plugins['StillWeb.FeedGenerator'].get_feed_entries(self._feed_url, limit)
 
-            # Copy the template to the result
-            self.__copy_template_to_result(c_templateElement, r_divElement, params)
+        # Create a <div> element for each entry
+        for entry in entries:
+            result_doc.documentElement.appendChild(template.render(result_doc, entry))
 
         # Namespace normalization
         normalize_namespaces(result_doc.documentElement)
@@ -117,36 +170,6 @@ class NewsPlugin:
         # Replace the placeholder
         raise ReplaceWithNode(result_doc.documentElement)
 
-    def __copy_template_to_result(self, src, dest, params):
-        for node in src.childNodes:
-            if node.nodeType == node.ELEMENT_NODE and node.namespaceURI == NEWS_NAMESPACE:
-                if node.localName == 'title-here':
-                    new_node = dest.ownerDocument.createTextNode(params['title'])
-                elif node.localName == 'summary-here':
-                    new_node = dest.ownerDocument.importNode(params['summaryDiv'], deep=True)
-                elif node.localName == 'published-here':
-                    new_node = dest.ownerDocument.createTextNode(atom_datetime_to_utc(params['published']).replace("T", " ").replace("Z", " UTC")) # HACK FIXME - pretty-print
-                elif node.localName == 'updated-here':
-                    new_node = dest.ownerDocument.createTextNode(atom_datetime_to_utc(params['updated']).replace("T", " ").replace("Z", " UTC")) # HACK FIXME - pretty-print
-                elif node.localName == 'a':
-                    new_node = dest.ownerDocument.createElement('a')
-
-                    # Import attributes (SECURITY: This is perhaps too liberal)
-                    for i in range(node.attributes.length):
-                        attrNode = node.attributes.item(i)
-                        new_node.setAttributeNode(dest.ownerDocument.importNode(attrNode, deep=True))
-
-                    new_node.setAttribute('href', params['href'])
-                else:
-                    raise ValueError("Illegal element name: %r" % (node.tagName,))
-            else:
-                new_node = dest.ownerDocument.importNode(node, deep=False)
-            dest.appendChild(new_node)
-
-            # Recurse
-            if node.nodeType == node.ELEMENT_NODE:
-                self.__copy_template_to_result(node, new_node, params)
-
     #
     # Filter callbacks
     #
@@ -154,17 +177,12 @@ class NewsPlugin:
         if self._feed_url is None:
             return
 
-        try:
-            feed_mtime = os.lstat(self._feed_path_info.output_filename).st_mtime
-            output_mtime = os.lstat(page_generator.path_info.output_filename).st_mtime
-        except EnvironmentError as exc:
-            if exc.errno != errno.ENOENT:
-                raise
-            # If one of the files we're looking for doesn't exist, then they need to be updated.
-            raise NeedsUpdate
-
-        if feed_mtime > output_mtime:
-            raise NeedsUpdate
+        # Only pages that contained a news placeholder when they were last
+        # built depend on the feed.  (If a placeholder is added to a page, the
+        # page's source changes, so it gets rebuilt anyway.)
+        feed_filename = self._feed_path_info.output_filename
+        if feed_filename in page_generator.manifest.get_inputs(page_generator.path_info.output_filename):
+            page_generator.add_dependency(feed_filename)
 
 
 def create_plugin(framework):
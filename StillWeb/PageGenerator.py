@@ -3,23 +3,54 @@
 # Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
 
 import os
-import errno
+import sys
+import multiprocessing
 from xml.dom import minidom, XHTML_NAMESPACE, EMPTY_NAMESPACE
 
-from StillWeb.TagSoupToXml import TagSoupToXml
+from StillWeb.TagSoupToXml import TagSoupToXml, parse_xhtml
+from StillWeb.BuildManifest import BuildManifest
 from StillWeb.sw_util import TypicalPaths
 from StillWeb.NamespaceNormalization import substitute_namespaces, normalize_namespaces
 
 class NeedsUpdate(Exception):
     """Raised by a 'check_freshness' filter when a page needs to be re-generated."""
 
+class TemplateCache:
+    """Cache of parsed page templates, keyed by filename.
+
+    Each template is parsed once (and again only if its mtime or size
+    changes); every page gets its own deep copy of the parsed Document.
+    """
+
+    def __init__(self):
+        self._documents = {}    # map filename -> (st_mtime_ns, st_size, document)
+
+    def clear(self):
+        for (mtime, size, document) in self._documents.values():
+            document.unlink()
+        self._documents = {}
+
+    def load(self, filename):
+        """Return a new copy of the parsed template"""
+        st = os.stat(filename)
+        cached = self._documents.get(filename)
+        if cached is None or cached[:2] != (st.st_mtime_ns, st.st_size):
+            cached = self._documents[filename] = (st.st_mtime_ns, st.st_size, minidom.parse(filename))
+        return cached[2].cloneNode(True)
+
+
 class PageGenerator:
     # NB: This is not the PageGeneratorPlugin.  A new PageGenerator is
     # instantiated every time the script command 'make' is invoked.
 
-    def __init__(self, path_info, template_filename):
+    def __init__(self, path_info, template_filename, manifest, template_cache=None, xhtml_fast_path=False):
         self.path_info = path_info
         self.template_filename = template_filename
+        self.manifest = manifest
+        self.template_cache = template_cache
+        self.xhtml_fast_path = xhtml_fast_path
+        self.dependencies = [template_filename, path_info.source_filename]
+        self.content_only = False   # True if the page is only loaded, not built (see load_page_content)
         self._filters = {
             'check_freshness': [],
             'init_page:before': [],
@@ -39,6 +70,9 @@ class PageGenerator:
 
     def cleanup(self):
         self.path_info = None
+        self.manifest = None
+        self.template_cache = None
+        self.dependencies = None
         self.page = None
         self.content = None
         self._filters = None
@@ -55,39 +89,66 @@ class PageGenerator:
         for callback in self._filters[stage]:
             callback(self, *args, **kwargs)
 
+    def add_dependency(self, filename):
+        """Declare that the output depends on the contents of the given file.
+
+        'check_freshness' filters should call this for any file (other than
+        the template and the source file) that the page is built from.
+
+        This may also be called while the page is being built, for inputs
+        that are only discovered then.  The dependency is recorded in the
+        manifest, and 'check_freshness' filters can find it again using
+        manifest.get_inputs().
+        """
+        if filename not in self.dependencies:
+            self.dependencies.append(filename)
+
     def check_freshness(self):
-        template_mtime = os.stat(self.template_filename).st_mtime
-        source_mtime = os.stat(self.path_info.source_filename).st_mtime
-        try:
-            output_mtime = os.lstat(self.path_info.output_filename).st_mtime
-        except EnvironmentError as exc:
-            if exc.errno == errno.ENOENT:
-                raise NeedsUpdate
-            else:
-                raise
-        if max([template_mtime, source_mtime, output_mtime]) != output_mtime:
+        # Run every filter, even after one of them raises NeedsUpdate, so
+        # that all of the page's dependencies get declared.
+        needs_update = False
+        for callback in self._filters['check_freshness']:
+            try:
+                callback(self)
+            except NeedsUpdate:
+                needs_update = True
+        if needs_update:
             raise NeedsUpdate
 
-        self.invoke_filters('check_freshness')
+        # Compare the content hashes of the inputs to the ones recorded when
+        # the output was last built.
+        if not self.manifest.is_fresh(self.path_info.output_filename, self.dependencies):
+            raise NeedsUpdate
 
     def init_page(self):
         self.invoke_filters('init_page:before')
 
         # The page starts as a template, which we modify until it's suitable for output.
-        self.page = minidom.parse(self.template_filename)
+        if self.template_cache is not None:
+            self.page = self.template_cache.load(self.template_filename)
+        else:
+            self.page = minidom.parse(self.template_filename)
 
         self.invoke_filters('init_page:after')
 
     def load_content(self):
         self.invoke_filters('load_content:before')
 
-        # Convert HTML tag soup to XML
-        p = TagSoupToXml(omit_comments=True)  # Omit commented-out parts in the final output
-        p.feed(open(self.path_info.source_filename, "rt", encoding="UTF-8").read())   # TODO: support other encodings? (is that safe?)
-        p.close()
+        source = open(self.path_info.source_filename, "rt", encoding="UTF-8").read()   # TODO: support other encodings? (is that safe?)
+
+        # If enabled, sources that are already well-formed XHTML are parsed
+        # directly by expat, which is much faster than TagSoupToXml.
+        self.content = None
+        if self.xhtml_fast_path:
+            self.content = parse_xhtml(source)
+        if self.content is None:
+            # Convert HTML tag soup to XML
+            p = TagSoupToXml(omit_comments=True, build_tree=True)  # Omit commented-out parts in the final output
+            p.feed(source)
+            p.close()
 
-        # Return a DOM URL
-        self.content = p.todocument()
+            # Return a DOM URL
+            self.content = p.todocument()
 
         # Drop any "http://www.w3.org/1999/xhtml" namespace declarations
         substitute_namespaces(self.content.documentElement, {XHTML_NAMESPACE: EMPTY_NAMESPACE})
@@ -119,16 +180,50 @@ class PageGenerator:
         self.invoke_filters('write_output:after')
 
 
+# The PageGeneratorPlugin instance used by forked 'make' workers.
+_parallel_plugin = None
+
+def _parallel_make(target_url):
+    # Runs in a worker process (see PageGeneratorPlugin.flush_pending)
+    _parallel_plugin.parallel_worker = True
+    try:
+        _parallel_plugin.make_page(target_url)
+    except Exception:
+        print("Error making %s:" % (target_url,), file=sys.stderr)
+        raise
+    return _parallel_plugin._export_parallel_state()
+
 class PageGeneratorPlugin:
 
     def __init__(self, framework):
         self._framework = framework
-        self._framework.plugins['StillWeb.ScriptProcessor'].register_command('make', self.handle_make)
+        script_processor = self._framework.plugins['StillWeb.ScriptProcessor']
+        script_processor.register_command('make', self.handle_make, deferrable=True)
+        script_processor.register_barrier(self.flush_pending)
+        script_processor.register_barrier(self.save_manifest)
         self._filters = []
+        self._parallel_state = []
+        self._pending = []     # list of (target_url, script location) queued by 'make'
+        self._manifest = None
+        self._template_cache = TemplateCache()
+
+        # True inside a worker process started by flush_pending (part of the
+        # exported API)
+        self.parallel_worker = False
+
+        self.register_parallel_state(self._export_manifest_changes, self._merge_manifest_changes)
 
     def cleanup(self):
+        if self._framework is not None:
+            self.save_manifest()
         self._framework = None
         self._filters = None
+        self._parallel_state = None
+        self._pending = None
+        self._manifest = None
+        if self._template_cache is not None:
+            self._template_cache.clear()
+            self._template_cache = None
 
     #
     # Exported API
@@ -136,16 +231,41 @@ class PageGeneratorPlugin:
     def register_filter(self, stage, callback):
         self._filters.append((stage, callback))
 
-    #
-    # Commands
-    #
-
-    def handle_make(self, target_url):
+    def register_parallel_state(self, export_callback, merge_callback):
+        """Register callbacks for merging plugin state from 'make' workers.
+
+        When pages are built in parallel (see the 'make_jobs' variable),
+        export_callback is invoked in the worker process after each page is
+        built, and must return a picklable object describing the state
+        changes made while building that page.  merge_callback is then
+        invoked with that object in the main process.  Pages are merged in
+        script order.
+        """
+        self._parallel_state.append((export_callback, merge_callback))
+
+    def get_manifest(self):
+        """Return the BuildManifest used for content-hash freshness checks.
+
+        The manifest is stored in the intermediate_data_dir.
+        """
+        if self._manifest is None:
+            filename = os.path.join(self._framework.plugins['vars'].vars['intermediate_data_dir'],
+                "StillWeb.PageGenerator", "manifest")
+            self._manifest = BuildManifest(filename)
+        return self._manifest
+
+    def save_manifest(self):
+        if self._manifest is not None:
+            self._manifest.save()
+
+    def make_page(self, target_url):
+        """Build a single page (if it needs to be re-generated)"""
         tp = TypicalPaths(self._framework, target_url)
         template_filename = self._framework.plugins['vars'].vars['template']
 
         # Create the PageGenerator instance for this page
-        pg = PageGenerator(tp, template_filename)
+        pg = PageGenerator(tp, template_filename, self.get_manifest(), self._template_cache,
+                           self.get_xhtml_fast_path())
 
         try:
             # Register filters
@@ -179,9 +299,126 @@ class PageGeneratorPlugin:
             # Write the output file
             pg.write_output()
 
+            # Remember what the output was built from
+            pg.manifest.record(tp.output_filename, pg.dependencies)
+
         finally:
             pg.cleanup()
 
+    def load_page_content(self, target_url):
+        """Load a page's content (running the 'load_content' filters)
+        without building the page.
+
+        This lets plugins collect data from pages quickly (see the
+        'scan_feed_entries' command).  The page generator's content_only
+        attribute is set, so that filters can skip anything that is only
+        finished when the page is written.
+        """
+        tp = TypicalPaths(self._framework, target_url)
+        template_filename = self._framework.plugins['vars'].vars['template']
+        pg = PageGenerator(tp, template_filename, self.get_manifest(), self._template_cache,
+                           self.get_xhtml_fast_path())
+        pg.content_only = True
+        try:
+            for (stage, callback) in self._filters:
+                pg.register_filter(stage, callback)
+            pg.load_content()
+        finally:
+            pg.cleanup()
+
+    def flush_pending(self):
+        """Build any pages queued by the 'make' command.
+
+        This is registered as a ScriptProcessor barrier, so it runs before
+        any command that might depend on the output of earlier 'make'
+        commands (e.g. make_atom_feed or set_news_feed).
+        """
+        global _parallel_plugin
+
+        if not self._pending:
+            return
+        (pending, self._pending) = (self._pending, [])
+
+        # Worker processes are forked, so they inherit the state of every
+        # plugin (variables, news feed settings, etc.) as of this barrier.
+        # Load the manifest and the template first, so that the workers
+        # don't each have to.
+        self.get_manifest()
+        self._template_cache.load(self._framework.plugins['vars'].vars['template'])
+        _parallel_plugin = self
+        try:
+            ctx = multiprocessing.get_context('fork')
+            pool = ctx.Pool(min(self.get_make_jobs(), len(pending)))
+            n = 0
+            try:
+                for exported_state in pool.imap(_parallel_make, [target_url for (target_url, location) in pending], chunksize=1):
+                    self._merge_parallel_state(exported_state)
+                    n += 1
+                pool.close()
+            except:
+                pool.terminate()
+                # Report the 'make' command that queued the failed page
+                if n < len(pending) and pending[n][1] is not None:
+                    (target_url, (filename, lineno)) = pending[n]
+                    print("Error in %s, line %d (make %s):" % (filename, lineno, target_url), file=sys.stderr)
+                raise
+            finally:
+                pool.join()
+        finally:
+            _parallel_plugin = None
+
+    #
+    # Commands
+    #
+
+    def handle_make(self, target_url):
+        """Generate a page from the template and the page source
+
+        Usage: make TARGET_RELATIVE_URL
+
+        If the 'make_jobs' variable is set to a number greater than 1 (or to
+        "auto"), the page is queued and built later by a pool of that many
+        worker processes.
+        """
+        if self.get_make_jobs() > 1:
+            location = self._framework.plugins['StillWeb.ScriptProcessor'].get_location()
+            self._pending.append((target_url, location))
+        else:
+            self.make_page(target_url)
+
+    def get_make_jobs(self):
+        """Return the number of parallel jobs set by the 'make_jobs' variable"""
+        jobs = self._framework.plugins['vars'].vars.get('make_jobs', '1')
+        if jobs == 'auto':
+            return os.cpu_count() or 1
+        return int(jobs)
+
+    def get_xhtml_fast_path(self):
+        """Return True if the 'xhtml_fast_path' variable is set
+
+        When it is, sources that are well-formed XHTML are parsed with expat
+        instead of TagSoupToXml.  (Usage: set xhtml_fast_path yes)
+        """
+        value = self._framework.plugins['vars'].vars.get('xhtml_fast_path', 'no')
+        return value.lower() in ('yes', 'true', 'on', '1')
+
+    #
+    # Internal functions
+    #
+
+    def _export_parallel_state(self):
+        return [export_callback() for (export_callback, merge_callback) in self._parallel_state]
+
+    def _merge_parallel_state(self, exported_state):
+        for ((export_callback, merge_callback), state) in zip(self._parallel_state, exported_state):
+            merge_callback(state)
+
+    def _export_manifest_changes(self):
+        return self.get_manifest().export_changes()
+
+    def _merge_manifest_changes(self, changes):
+        self.get_manifest().merge_changes(changes)
+
 
 def create_plugin(framework):
     return PageGeneratorPlugin(framework)
@@ -2,7 +2,8 @@
 # Placeholders.py - Placeholder-plugin support
 # Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
 
-from xml.dom import minidom, EMPTY_NAMESPACE, XHTML_NAMESPACE
+from collections import OrderedDict
+from xml.dom import minidom, EMPTY_NAMESPACE, XHTML_NAMESPACE, XMLNS_NAMESPACE
 
 from StillWeb.TagSoupToXml import TagSoupToXml
 from StillWeb.NamespaceNormalization import substitute_namespaces, normalize_namespaces
@@ -63,12 +64,37 @@ class ReplaceWithHTML(BaseReplaceException):
         self.html = html
         self.omit_comments = omit_comments
 
+def _canonical_key(node):
+    """Return a hashable representation of a DOM node and its descendants.
+
+    Nodes that are equivalent get equal keys, regardless of the order of
+    their attributes, or of their namespace prefixes and declarations.
+    """
+    if node.nodeType == node.ELEMENT_NODE:
+        attributes = tuple(sorted((a.namespaceURI or '', a.localName, a.value)
+            for a in node.attributes.values() if a.namespaceURI != XMLNS_NAMESPACE))
+        return (node.namespaceURI, node.localName, attributes, tuple(_canonical_key(n) for n in node.childNodes))
+    elif node.nodeType in (node.TEXT_NODE, node.CDATA_SECTION_NODE):
+        return node.data
+    else:
+        return (node.nodeType, node.toxml())
+
 class PlaceholdersPlugin:
+
+    # Maximum number of memoized replacements (the least recently used are
+    # forgotten first)
+    MEMO_SIZE = 256
+
     def __init__(self, framework):
         self._framework = framework
         self._namespace_callbacks = {}
         self._element_callbacks = {}
 
+        # Memoized replacements (see register_callback), and the private
+        # document that owns their nodes
+        self._memo = OrderedDict()
+        self._memo_document = minidom.parseString("<memo/>")
+
         # Register the placeholder namespace
         pg_plugin = self._framework.plugins['StillWeb.PageGenerator']
         pg_plugin.register_filter('load_content:after', self._process_placeholders)
@@ -78,11 +104,15 @@ class PlaceholdersPlugin:
             self._framework = None
             self._namespace_callbacks = None
             self._element_callbacks = None
+            self._memo = None
+            if self._memo_document is not None:
+                self._memo_document.unlink()
+                self._memo_document = None
 
     #
     # Exported API
     #
-    def register_callback(self, callback, element_namespaceURI, element_localName=None):
+    def register_callback(self, callback, element_namespaceURI, element_localName=None, memoize=None):
         """Register a callback function associated with the specified element.
 
         If element_localName is unspecified, then this callback function is
@@ -90,16 +120,28 @@ class PlaceholdersPlugin:
 
         When a callback function is invoked, it is passed the current
         PageGenerator instance and the matching DOM Element node.
+
+        If memoize is given, the callback's most recently used results (up to
+        MEMO_SIZE of them) are remembered for the rest of the run, so that an identical placeholder on another page
+        gets a copy of the same replacement without invoking the callback.
+        memoize is a function that is passed the same arguments as the
+        callback, and returns the placeholder's other dependencies (any
+        hashable value, such as the digest of a file that the callback
+        reads).  A result is only reused if both the placeholder element
+        (compared by _canonical_key) and its dependencies are the same.
+        memoize is called every time the placeholder is found, so it should
+        also do anything the callback would have done to the page_generator
+        (e.g. add_dependency).
         """
         if element_localName is not None:
             k = (element_namespaceURI, element_localName)
             if k in self._element_callbacks:
                 raise ValueError("callback already assigned for element %r" % (k,))
-            self._element_callbacks[k] = callback
+            self._element_callbacks[k] = (callback, memoize)
         else:
             if element_namespaceURI in self._namespace_callbacks:
                 raise ValueError("callback already assigned for namespace %r" % (element_namespaceURI,))
-            self._namespace_callbacks[namespaceURI] = namespaceURI
+            self._namespace_callbacks[element_namespaceURI] = (callback, memoize)
 
     #
     # Filter callback(s)
@@ -109,31 +151,70 @@ class PlaceholdersPlugin:
 
     def __recurse_placeholders(self, page_generator, element):
         # Try element-specific callback
-        callback = self._element_callbacks.get((element.namespaceURI, element.localName))
-        if callback is not None:
-            return self.__invoke_callback(page_generator, element, callback)
+        callbacks = self._element_callbacks.get((element.namespaceURI, element.localName))
+        if callbacks is not None:
+            return self.__invoke_callback(page_generator, element, *callbacks)
 
         # Try (wildcard) namespace callback
-        callback = self._namespace_callbacks.get(element.namespaceURI)
-        if callback is not None:
-            return self.__invoke_callback(page_generator, element, callback)
+        callbacks = self._namespace_callbacks.get(element.namespaceURI)
+        if callbacks is not None:
+            return self.__invoke_callback(page_generator, element, *callbacks)
 
         # Fall back: Recurse into child nodes
         for node in element.childNodes:
             if node.nodeType == node.ELEMENT_NODE:
                 self.__recurse_placeholders(page_generator, node)
 
-    def __invoke_callback(self, page_generator, element, callback):
-        try:
-            callback(page_generator, element)
-        except ReplaceWithNothing as exc:
+    def __invoke_callback(self, page_generator, element, callback, memoize):
+        if memoize is None:
+            try:
+                callback(page_generator, element)
+            except BaseReplaceException as exc:
+                self.__replace(element, exc)
+            return
+
+        # Look for a memoized result
+        key = (callback, _canonical_key(element), memoize(page_generator, element))
+        replacement = self._memo.get(key)
+        if replacement is not None:
+            self._memo.move_to_end(key)
+        else:
+            try:
+                callback(page_generator, element)
+            except BaseReplaceException as exc:
+                replacement = self.__make_memo(exc)
+            else:
+                return  # The callback didn't replace the placeholder, so there's nothing to remember
+            self._memo[key] = replacement
+            if len(self._memo) > self.MEMO_SIZE:
+                self._memo.popitem(last=False)
+
+        self.__replace(element, replacement)
+
+    def __make_memo(self, exc):
+        # Return a copy of a replacement that can be used on any page (and
+        # that doesn't keep the exception's traceback alive).  Nodes are
+        # copied into the memo document, and HTML is parsed only once.
+        if isinstance(exc, ReplaceWithNothing):
+            return ReplaceWithNothing()
+        elif isinstance(exc, ReplaceWithText):
+            return ReplaceWithText(exc.text)
+        elif isinstance(exc, ReplaceWithNode):
+            return ReplaceWithNode(self._memo_document.importNode(exc.node, True), exc.fix_namespaces)
+        elif isinstance(exc, ReplaceWithHTML):
+            return ReplaceWithNode(self.__parse_html(exc.html, exc.omit_comments, self._memo_document), fix_namespaces=False)
+        else:
+            raise TypeError("unknown replacement %r" % (exc,))
+
+    def __replace(self, element, exc):
+        if isinstance(exc, ReplaceWithNothing):
             # Remove the element
             element.parentNode.removeChild(element)
-        except ReplaceWithText as exc:
+        elif isinstance(exc, ReplaceWithText):
             # Replace the element with the given text
             text_node = element.ownerDocument.createTextNode(exc.text)
             element.parentNode.replaceChild(text_node, element)
-        except ReplaceWithNode as exc:
+        elif isinstance(exc, ReplaceWithNode):
             # Replace the element with the given node
             new_node = exc.node
             if new_node.ownerDocument is not element.ownerDocument:
@@ -143,37 +224,44 @@ class PlaceholdersPlugin:
                 # page_generator.content uses HTML without specifying a namespace
                 substitute_namespaces(new_node, {XHTML_NAMESPACE: EMPTY_NAMESPACE})
                 normalize_namespaces(new_node, strip_dups=True)
-        except ReplaceWithHTML as exc:
-            #
+        elif isinstance(exc, ReplaceWithHTML):
             # Replace the element with the given HTML code
-            #
-
-            # Parse with TagSoupToXml
-            p = TagSoupToXml(omit_comments=exc.omit_comments)
-            p.feed(exc.html)
-            p.close()
-
-            # Get a DOM document
-            doc = p.todocument()
-
-            # Find the <body> element
-            for node in doc.documentElement.childNodes:
-                if node.nodeType != node.ELEMENT_NODE:
-                    continue
-                if node.localName == 'body':
-                    bodyElement = node
-                    break
-            else:
-                raise AssertionError("<body> element not found")
+            fragment = self.__parse_html(exc.html, exc.omit_comments, element.ownerDocument)
+            element.parentNode.replaceChild(fragment, element)
+        else:
+            raise TypeError("unknown replacement %r" % (exc,))
 
-            # At this stage, HTML code doesn't have a namespace assigned yet.
-            assert bodyElement.namespaceURI == EMPTY_NAMESPACE
+    def __parse_html(self, html, omit_comments, document):
+        """Return a DocumentFragment (owned by the given document) containing
+        the children of the <body> element of the given HTML code.
+        """
+        # Parse with TagSoupToXml
+        p = TagSoupToXml(omit_comments=omit_comments, build_tree=True)
+        p.feed(html)
+        p.close()
 
-            # Replace the placeholder element with the children of the <body> node.
-            for node in bodyElement.childNodes:
-                new_node = element.ownerDocument.importNode(node, True)
-                element.parentNode.insertBefore(new_node, element)
-            element.parentNode.removeChild(element)
+        # Get a DOM document
+        doc = p.todocument()
+
+        # Find the <body> element
+        for node in doc.documentElement.childNodes:
+            if node.nodeType != node.ELEMENT_NODE:
+                continue
+            if node.localName == 'body':
+                bodyElement = node
+                break
+        else:
+            raise AssertionError("<body> element not found")
+
+        # At this stage, HTML code doesn't have a namespace assigned yet.
+        assert bodyElement.namespaceURI == EMPTY_NAMESPACE
+
+        # Copy the children of the <body> node.
+        fragment = document.createDocumentFragment()
+        for node in bodyElement.childNodes:
+            fragment.appendChild(document.importNode(node, True))
+        doc.unlink()
+        return fragment
 
 
 def create_plugin(framework):
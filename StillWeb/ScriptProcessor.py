@@ -18,6 +18,9 @@ class ScriptProcessor:
         self._framework = framework
 
         self._commands = {}
+        self._deferrable_commands = set()
+        self._barriers = []
+        self._locations = []    # stack of [filename, lineno] of the scripts being run
 
         # Add built-in commands
         self.register_command('.load_plugin', self.handle_load_plugin)
@@ -26,6 +29,9 @@ class ScriptProcessor:
     def cleanup(self):
         if self._framework is not None:
             self._commands = None
+            self._deferrable_commands = None
+            self._barriers = None
+            self._locations = None
             self._framework = None
 
     #
@@ -34,6 +40,8 @@ class ScriptProcessor:
     def process_script(self, filename, file=None):
         if file is None:
             file = open(filename, "rt", encoding="UTF-8")
+        location = [filename, 0]
+        self._locations.append(location)
         try:
             lineno = 0
             while True:
@@ -41,6 +49,7 @@ class ScriptProcessor:
                 lineno += 1
                 if not line:
                     break
+                location[1] = lineno
                 try:
                     rawargs = shlex.split(line, comments=True)
                     if not rawargs:
@@ -49,7 +58,12 @@ class ScriptProcessor:
                 except Exception as exc:
                     print("Error in %s, line %d:" % (filename, lineno), file=sys.stderr)
                     raise
+
+            # Run any deferred work before returning from the top-level script
+            if len(self._locations) == 1:
+                self.sync()
         finally:
+            self._locations.pop()
             file.close()
 
     def exec_command(self, *rawargs):
@@ -59,12 +73,47 @@ class ScriptProcessor:
             handler = self._commands[cmd]
         except KeyError:
             raise UnknownCommandError("Unknown command: %r" % (cmd,))
+        if cmd not in self._deferrable_commands:
+            self.sync()
         handler(*args)
 
-    def register_command(self, command_name, handler):
+    def get_location(self):
+        """Return (filename, lineno) of the script command being run (or None)
+
+        Deferrable commands can save this, so that errors in the deferred
+        work can be reported against the command that queued it.
+        """
+        if not self._locations:
+            return None
+        return tuple(self._locations[-1])
+
+    def register_command(self, command_name, handler, deferrable=False):
+        """Register a script command.
+
+        Commands are normally barriers:  Before a command is run, all of the
+        barrier callbacks are invoked, so that any deferred work (e.g. queued
+        'make' commands) is finished first.  If `deferrable` is true, the
+        command is assumed not to depend on the results of earlier commands,
+        and no barrier is invoked before it.
+        """
         if command_name in self._commands:
             raise ValueError("command %r already added" % (command_name,))
         self._commands[command_name] = handler
+        if deferrable:
+            self._deferrable_commands.add(command_name)
+
+    def register_barrier(self, callback):
+        """Register a callback that finishes any deferred work.
+
+        The callback is invoked (with no arguments) before every command that
+        is not deferrable, and at the end of the top-level script.
+        """
+        self._barriers.append(callback)
+
+    def sync(self):
+        """Invoke the barrier callbacks"""
+        for callback in self._barriers:
+            callback()
 
     #
     # Built-in commands
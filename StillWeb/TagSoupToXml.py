@@ -5,10 +5,40 @@
 import html.parser
 import html.entities
 import re
-from xml.dom import minidom
+import xml.parsers.expat
+from xml.dom import minidom, XML_NAMESPACE, XMLNS_NAMESPACE, EMPTY_NAMESPACE
 
 # TagSoupToXml - Based on phpTagSoup-0.2/TagSoup/ToXML.php (which I wrote)
 
+# Initial namespace prefixes in an XML document
+_initial_prefixes = {None: EMPTY_NAMESPACE, 'xml': XML_NAMESPACE, 'xmlns': XMLNS_NAMESPACE}
+
+# Stand-in namespace for attributes whose prefix isn't bound yet (followed by
+# the prefix, so that the attributes remain distinct until they're resolved)
+_unbound_namespace = "tag:dlitz.net,2008:StillWeb.TagSoupToXml:unbound:"
+
+# Normalization performed by an XML parser (see XML 1.0 sections 2.11 and 3.3.3)
+_newline_regex = re.compile(r'\r\n?')
+_attribute_whitespace_regex = re.compile(r'[\t\n]')
+
+def _normalize_text(data):
+    if "\r" not in data:
+        return data
+    return _newline_regex.sub("\n", data)
+
+def _normalize_attribute_value(value):
+    if "\r" in value:
+        value = _newline_regex.sub("\n", value)
+    if "\t" in value or "\n" in value:
+        value = _attribute_whitespace_regex.sub(" ", value)
+    return value
+
+def _xml_error(message, detail=None):
+    """Return the ExpatError that an XML parser would raise for the same problem"""
+    exc = xml.parsers.expat.ExpatError(message if detail is None else "%s: %s" % (message, detail))
+    exc.code = xml.parsers.expat.errors.codes[message]
+    return exc
+
 class TagSoupToXml(html.parser.HTMLParser):
     # Elements that are always empty, according to the HTML4 spec:
     #  http://www.w3.org/TR/html4/index/elements.html
@@ -33,9 +63,16 @@ class TagSoupToXml(html.parser.HTMLParser):
         'dt': set(('dl')),
     };
 
-    def __init__(self, omit_comments=False):
-        super().__init__()
+    def __init__(self, omit_comments=False, build_tree=False):
+        """Create a TagSoupToXml parser.
+
+        If `build_tree` is true, the parser builds the document tree directly
+        as it goes, instead of generating XML code that todocument() has to
+        parse again.  The resulting DOM is the same either way.
+        """
         self.omit_comments = omit_comments
+        self.build_tree = build_tree
+        super().__init__()
 
     def reset(self):
         super().reset()
@@ -50,6 +87,17 @@ class TagSoupToXml(html.parser.HTMLParser):
         self.body_tag = None
         self.body_content = None
 
+        # Used only in tree-builder mode
+        if self.build_tree:
+            self.document = minidom.getDOMImplementation().createDocument(None, None, None)
+        self.node_stack = []
+        self.prefixes_stack = []
+        self.html_attributes = None
+        self.head_attributes = None
+        self.body_attributes = None
+        self.html_prefixes = self.head_prefixes = self.body_prefixes = _initial_prefixes
+        self.namespaces_changed = False
+
     def close(self):
         super().close()
         self.handle_finish()
@@ -64,19 +112,63 @@ class TagSoupToXml(html.parser.HTMLParser):
         else:
             self.body_content.append(text)
 
+    def add_node(self, node):
+        # Tree-builder equivalent of add_output
+        if self.node_stack:
+            self.node_stack[-1].appendChild(node)
+        elif self.body_content is None:
+            if self.head_content is None:
+                self.head_content = []
+            self.head_content.append(node)
+        else:
+            self.body_content.append(node)
+
+    def add_text(self, data):
+        # Merge adjacent text, like an XML parser would.
+        if self.node_stack:
+            childNodes = self.node_stack[-1].childNodes
+            last = childNodes and childNodes[-1]
+        elif self.body_content is None:
+            last = self.head_content and self.head_content[-1]
+        else:
+            last = self.body_content and self.body_content[-1]
+        if last and last.nodeType == last.TEXT_NODE:
+            last.data += data
+        else:
+            self.add_node(self.document.createTextNode(data))
+
+    def close_tag(self):
+        # Close the most-recently-opened tag
+        tn = self.tagstack.pop()
+        if self.build_tree:
+            self.node_stack.pop()
+            self.prefixes_stack.pop()
+        else:
+            self.add_output("</%s>" % (tn,))
+        return tn
+
     def handle_data(self, data):
-        self.add_output(html.escape(data))
+        if self.build_tree:
+            self.add_text(_normalize_text(data))
+        else:
+            self.add_output(html.escape(data))
 
     def handle_charref(self, name):
         if name.lower().startswith("x"):
             c = int(name[1:], 16)
         else:
             c = int(name)
-        self.add_output("&#x%X;" % (c,))
+        if self.build_tree:
+            self.add_text(chr(c))
+        else:
+            self.add_output("&#x%X;" % (c,))
 
     def handle_entityref(self, name):
         c = html.entities.name2codepoint[name]
-        self.add_output("&#x%X;" % (c,))
+        if self.build_tree:
+            self.add_text(chr(c))
+        else:
+            self.add_output("&#x%X;" % (c,))
 
     def handle_starttag(self, tagname, attributes=None):
         # Lowercase the tag name
@@ -90,33 +182,37 @@ class TagSoupToXml(html.parser.HTMLParser):
             attr_list.sort()
 
         # Ignore duplicate HTML, HEAD, and BODY tags
-        if ((tagname == "html" and self.html_tag is not None) or
-                (tagname == "head" and self.head_tag is not None) or
-                (tagname == "body" and self.body_tag is not None)):
+        if self.build_tree:
+            (html_tag, head_tag, body_tag) = (self.html_attributes, self.head_attributes, self.body_attributes)
+        else:
+            (html_tag, head_tag, body_tag) = (self.html_tag, self.head_tag, self.body_tag)
+        if ((tagname == "html" and html_tag is not None) or
+                (tagname == "head" and head_tag is not None) or
+                (tagname == "body" and body_tag is not None)):
             return
 
         # Handle elements that shouldn't be parents of themselves
         if tagname in self.forbidden_parents and self.tagstack and self.tagstack[-1] == tagname:
-            tn = self.tagstack.pop()
-            self.add_output("</%s>" % (tn,))
+            self.close_tag()
 
         # Handle tags that should have specific parents
-        for (child, parents) in self.mandatory_parents.items():
-            if tagname != child:    # li should have ul or ol as a parent
-                continue
+        parents = self.mandatory_parents.get(tagname)   # li should have ul or ol as a parent
+        if parents is not None:
             for i in range(len(self.tagstack)-1, -1, -1):
                 if self.tagstack[i] not in parents:
                     continue
                 for j in range(len(self.tagstack)-i-1):
-                    tn = self.tagstack.pop()
-                    self.add_output("</%s>" % (tn,))
+                    self.close_tag()
                 break
-            break
 
-        if tagname in ("html", "head"):
-            self.output_buffer = []
-        elif tagname == "body":
+        if tagname == "body":
             self.handle_endtag("head")
+
+        if self.build_tree:
+            self.build_starttag(tagname, attr_list)
+            return
+
+        if tagname in ("html", "head", "body"):
             self.output_buffer = []
 
         self.add_output("<%s" % (tagname,))
@@ -141,6 +237,43 @@ class TagSoupToXml(html.parser.HTMLParser):
             if self.body_content is None:
                 self.body_content = []
 
+    def build_starttag(self, tagname, attr_list):
+        # Tree-builder part of handle_starttag
+        if attr_list:
+            attr_list = [(k, _normalize_attribute_value(v)) for (k, v) in attr_list]
+        if tagname in ("html", "head", "body"):
+            # These might declare namespaces that apply to content we've
+            # already seen.  If so, namespaces will be re-resolved later.
+            if self._has_namespace_declarations(attr_list) and self._has_elements(self.head_content, self.body_content):
+                self.namespaces_changed = True
+            if tagname == "html":
+                self.html_attributes = attr_list
+                self.html_prefixes = self._get_prefixes(attr_list, _initial_prefixes)
+                self.head_prefixes = self._get_prefixes(self.head_attributes or [], self.html_prefixes)
+                self.body_prefixes = self._get_prefixes(self.body_attributes or [], self.html_prefixes)
+            elif tagname == "head":
+                self.head_attributes = attr_list
+                self.head_prefixes = self._get_prefixes(attr_list, self.html_prefixes)
+            else:
+                self.body_attributes = attr_list
+                self.body_prefixes = self._get_prefixes(attr_list, self.html_prefixes)
+                if self.body_content is None:
+                    self.body_content = []
+            return
+
+        if self.prefixes_stack:
+            prefixes = self.prefixes_stack[-1]
+        elif self.body_content is None:
+            prefixes = self.head_prefixes
+        else:
+            prefixes = self.body_prefixes
+        (element, prefixes) = self._create_element(tagname, attr_list, prefixes)
+        self.add_node(element)
+        if tagname not in self.forbidden_endtags:
+            self.tagstack.append(tagname)
+            self.node_stack.append(element)
+            self.prefixes_stack.append(prefixes)
+
     def handle_endtag(self, tagname):
         # Lowercase the tag name
         tagname = tagname.lower()
@@ -148,8 +281,7 @@ class TagSoupToXml(html.parser.HTMLParser):
         # Don't close HTML, HEAD, or BODY tags here, but close everything else.
         if tagname in ("html", "head", "body"):
             while self.tagstack:
-                tn = self.tagstack.pop()
-                self.add_output("</%s>" % (tn,))
+                self.close_tag()
             return
 
         # If the tag wasn't opened, don't close it.
@@ -158,14 +290,12 @@ class TagSoupToXml(html.parser.HTMLParser):
 
         # Force proper nesting of tags
         while self.tagstack[-1] != tagname:
-            tn = self.tagstack.pop()
-            self.add_output("</%s>" % (tn,))
+            self.close_tag()
         assert self.tagstack
 
         # Close the tag
-        tn = self.tagstack.pop()
+        tn = self.close_tag()
         assert tn == tagname
-        self.add_output("</%s>" % (tn,))
 
     def handle_comment(self, data):
         if self.omit_comments:
@@ -180,7 +310,11 @@ class TagSoupToXml(html.parser.HTMLParser):
         if data.endswith("-"):
             data += " "
 
-        self.add_output("<!--%s-->" % (data,));
+        if self.build_tree:
+            node = self.document.createComment(_normalize_text(data))
+            self.add_node(node)
+        else:
+            self.add_output("<!--%s-->" % (data,));
 
     def handle_decl(self, decl):
         return;     # Omit SGML declarations
@@ -188,8 +322,21 @@ class TagSoupToXml(html.parser.HTMLParser):
     def handle_finish(self):
         # Close all open tags
         while self.tagstack:
-            tn = self.tagstack.pop()
-            self.add_output("</%s>" % (tn,))
+            self.close_tag()
+
+        if self.build_tree:
+            if self.html_attributes is None:
+                self.html_attributes = []
+            if self.head_attributes is None:
+                self.head_attributes = []
+            if self.body_attributes is None:
+                self.body_attributes = []
+                self.body_content = self.head_content
+                self.head_content = []
+                if self.head_prefixes is not self.body_prefixes and self._has_elements(self.body_content):
+                    # The content was moved out of the scope of the <head> element's namespace declarations.
+                    self.namespaces_changed = True
+            return
 
         if self.html_tag is None:
             self.html_tag = "<html>"
@@ -201,6 +348,8 @@ class TagSoupToXml(html.parser.HTMLParser):
             self.head_content = []
 
     def toxml(self):
+        if self.build_tree:
+            return self.prologue + self.todocument().documentElement.toxml()
         self.close()
         return "".join(
             [self.prologue, self.html_tag, self.head_tag] +
@@ -210,7 +359,339 @@ class TagSoupToXml(html.parser.HTMLParser):
             ["</body></html>"])
 
     def todocument(self):
-        return minidom.parseString('<?xml version="1.0" encoding="UTF-8"?>' + self.toxml())
+        if not self.build_tree:
+            return minidom.parseString('<?xml version="1.0" encoding="UTF-8"?>' + self.toxml())
+
+        self.close()
+        document = self.document
+        (htmlElement, prefixes) = self._create_element("html", self.html_attributes, _initial_prefixes)
+        for (tagname, attr_list, content) in (("head", self.head_attributes, self.head_content),
+                                              ("body", self.body_attributes, self.body_content)):
+            (element, dummy) = self._create_element(tagname, attr_list, prefixes)
+            for node in content or ():
+                element.appendChild(node)
+            htmlElement.appendChild(element)
+        document.appendChild(htmlElement)
+
+        if self.namespaces_changed:
+            self._resolve_namespaces(htmlElement, _initial_prefixes)
+
+        return document
+
+    #
+    # Tree-builder helper functions.  These check the namespace constraints
+    # that an XML parser would check, and raise the same errors.
+    #
+    @staticmethod
+    def _has_namespace_declarations(attr_list):
+        for (k, v) in attr_list:
+            if k == "xmlns" or k.startswith("xmlns:"):
+                return True
+        return False
+
+    @staticmethod
+    def _has_elements(*node_lists):
+        for node_list in node_lists:
+            for node in node_list or ():
+                if node.nodeType == node.ELEMENT_NODE:
+                    return True
+        return False
+
+    @staticmethod
+    def _get_prefixes(attr_list, prefixes):
+        """Return the namespace prefixes in scope after applying the declarations in attr_list"""
+        new_prefixes = prefixes
+        for (k, v) in attr_list:
+            if k == "xmlns" or k.startswith("xmlns:"):
+                prefix = k[6:] or None
+                if prefix == "xml":
+                    if v != XML_NAMESPACE:
+                        raise _xml_error("reserved prefix (xml) must not be undeclared or bound to another namespace name")
+                elif prefix == "xmlns":
+                    raise _xml_error("reserved prefix (xmlns) must not be declared or undeclared")
+                elif v in (XML_NAMESPACE, XMLNS_NAMESPACE):
+                    raise _xml_error("prefix must not be bound to one of the reserved namespace names")
+                elif not v and prefix is not None:
+                    raise _xml_error("must not undeclare prefix", repr(prefix))
+                if new_prefixes is prefixes:
+                    new_prefixes = prefixes.copy()
+                new_prefixes[prefix] = v or EMPTY_NAMESPACE
+        return new_prefixes
+
+    def _create_element(self, tagname, attr_list, prefixes):
+        """Create a DOM element, resolving XML namespace prefixes the same way
+        a namespace-aware XML parser would.
+
+        Return the element, and the namespace prefixes in scope for its children.
+        """
+        has_declarations = attr_list and self._has_namespace_declarations(attr_list)
+        if has_declarations:
+            prefixes = self._get_prefixes(attr_list, prefixes)
+        (prefix, localName) = self._split_qname(tagname)
+        element = self.document.createElementNS(self._resolve_prefix(prefix, prefixes), tagname)
+
+        if attr_list:
+            # Namespace declarations come first, as with expat.
+            if has_declarations:
+                attr_list = sorted(attr_list, key=lambda a: not (a[0] == "xmlns" or a[0].startswith("xmlns:")))
+            self._set_attributes(element, attr_list, prefixes)
+
+        return (element, prefixes)
+
+    def _set_attributes(self, element, attr_list, prefixes, strict=False):
+        """Add attributes to an element, resolving their namespace prefixes"""
+        names = set()
+        for (k, v) in attr_list:
+            (prefix, localName) = self._split_qname(k)
+            if k == "xmlns" or prefix == "xmlns":
+                namespaceURI = XMLNS_NAMESPACE
+            elif prefix is None:
+                # Un-prefixed attributes have no namespace
+                namespaceURI = EMPTY_NAMESPACE
+            elif prefix in prefixes:
+                namespaceURI = prefixes[prefix]
+            else:
+                self._resolve_prefix(prefix, prefixes, strict)
+                namespaceURI = _unbound_namespace + prefix
+
+            # Attribute names must be unique, even after resolving prefixes
+            if (namespaceURI, localName) in names:
+                raise _xml_error("duplicate attribute", repr(k))
+            names.add((namespaceURI, localName))
+
+            a = self.document.createAttributeNS(namespaceURI, k)
+            a.value = v
+            element.setAttributeNodeNS(a)
+
+    @staticmethod
+    def _split_qname(qualified_name):
+        if ":" in qualified_name:
+            (prefix, localName) = qualified_name.split(":", 1)
+            if not prefix or not localName or ":" in localName:
+                raise _xml_error("not well-formed (invalid token)", repr(qualified_name))
+            return (prefix, localName)
+        return (None, qualified_name)
+
+    def _resolve_prefix(self, prefix, prefixes, strict=False):
+        try:
+            return prefixes[prefix]
+        except KeyError:
+            if strict:
+                raise _xml_error("unbound prefix", repr(prefix))
+            # The prefix might still be declared on the <html>, <head>, or
+            # <body> element.
+            self.namespaces_changed = True
+            return EMPTY_NAMESPACE
+
+    def _resolve_namespaces(self, element, prefixes):
+        """Re-resolve the XML namespaces of an element and its descendants"""
+        attr_list = [(a.name, a.value) for a in element.attributes.values()]
+        prefixes = self._get_prefixes(attr_list, prefixes)
+        namespaceURI = self._resolve_prefix(element.prefix, prefixes, strict=True)
+        if element.namespaceURI != namespaceURI:
+            element = self.document.renameNode(element, namespaceURI, element.tagName)
+        for (k, v) in attr_list:
+            (prefix, localName) = self._split_qname(k)
+            if prefix is not None and prefix != "xmlns":
+                if element.getAttributeNode(k).namespaceURI != self._resolve_prefix(prefix, prefixes, strict=True):
+                    break
+        else:
+            attr_list = None
+        if attr_list is not None:
+            # Re-create the attributes (in the same order)
+            for (k, v) in attr_list:
+                element.removeAttribute(k)
+            self._set_attributes(element, attr_list, prefixes, strict=True)
+        for node in element.childNodes:
+            if node.nodeType == node.ELEMENT_NODE:
+                self._resolve_namespaces(node, prefixes)
+
+
+#
+# Fast path for sources that are already well-formed XHTML
+#
+
+# Things that can appear before or after the root element of an XML document
+_xml_misc_regex = re.compile(r'[ \t\r\n]+|<\?.*?\?>|<!--.*?-->', re.S)
+_xml_doctype_regex = re.compile(r'<!DOCTYPE[^\[>]*>')
+_xml_root_end_regex = re.compile(r'</html[ \t\r\n]*>')
+
+# Text that html.parser would not have passed through unchanged (e.g.
+# character references to C1 control characters, which HTML remaps)
+_xml_special_text_regex = re.compile('[\x80-\x9f\r]')
+_xml_special_attribute_regex = re.compile('[\x80-\x9f\t\n\r]')
+
+class _NotTagSoupEquivalent(Exception):
+    pass
+
+def _xml_misc_text(source, pos, allow_doctype=False):
+    """Return (text, pos), where text is the character data (i.e. whitespace)
+    that TagSoupToXml would find among the comments, processing instructions,
+    and DOCTYPE declaration starting at `pos`.
+    """
+    text = []
+    while True:
+        m = _xml_misc_regex.match(source, pos)
+        if not m and allow_doctype:
+            m = _xml_doctype_regex.match(source, pos)
+        if not m:
+            return (_normalize_text("".join(text)), pos)
+        if not m.group().startswith("<"):
+            text.append(m.group())
+        pos = m.end()
+
+def _check_xhtml_element(element, ancestors):
+    """Make sure that TagSoupToXml would build `element` the same way.
+
+    Comments and processing instructions are removed, and attributes are
+    sorted the way TagSoupToXml sorts them.
+    """
+    tagname = element.tagName
+    if tagname != tagname.lower() or tagname in ("html", "head", "body"):
+        raise _NotTagSoupEquivalent
+    if element.childNodes and (tagname in TagSoupToXml.forbidden_endtags or
+            tagname in html.parser.HTMLParser.CDATA_CONTENT_ELEMENTS):
+        raise _NotTagSoupEquivalent
+
+    # Check the nesting rules that TagSoupToXml enforces
+    if ancestors:
+        if tagname in TagSoupToXml.forbidden_parents and ancestors[-1] == tagname:
+            raise _NotTagSoupEquivalent
+        parents = TagSoupToXml.mandatory_parents.get(tagname)
+        if parents is not None:
+            for i in range(len(ancestors)-1, -1, -1):
+                if ancestors[i] in parents:
+                    if i != len(ancestors)-1:
+                        raise _NotTagSoupEquivalent
+                    break
+
+    _sort_xhtml_attributes(element)
+    _check_xhtml_children(element, ancestors + [tagname])
+
+def _sort_xhtml_attributes(element):
+    """Check the attributes of an element, and sort them the way TagSoupToXml
+    does (namespace declarations first).
+    """
+    attributes = element.attributes
+    if not attributes:
+        return
+    names = []
+    for (k, v) in attributes.items():
+        if k != k.lower() or _xml_special_attribute_regex.search(v):
+            raise _NotTagSoupEquivalent
+        names.append(k)
+    sorted_names = sorted(names, key=lambda k: (not (k == "xmlns" or k.startswith("xmlns:")), k))
+    if names != sorted_names:
+        attrNodes = [element.getAttributeNode(k) for k in sorted_names]
+        for attrNode in attrNodes:
+            element.removeAttributeNode(attrNode)
+        for attrNode in attrNodes:
+            element.setAttributeNodeNS(attrNode)
+
+def _check_xhtml_children(element, ancestors, recurse=True):
+    for node in list(element.childNodes):
+        if node.nodeType == node.ELEMENT_NODE:
+            if recurse:
+                _check_xhtml_element(node, ancestors)
+        elif node.nodeType == node.TEXT_NODE:
+            if _xml_special_text_regex.search(node.data):
+                raise _NotTagSoupEquivalent
+        elif node.nodeType in (node.COMMENT_NODE, node.PROCESSING_INSTRUCTION_NODE):
+            # Remove the node, merging the text around it.
+            prev = node.previousSibling
+            next = node.nextSibling
+            element.removeChild(node)
+            if (prev is not None and next is not None and
+                    prev.nodeType == next.nodeType == node.TEXT_NODE):
+                prev.data += next.data
+                element.removeChild(next)
+                next.unlink()
+            node.unlink()
+        else:
+            # e.g. CDATA sections, which html.parser drops
+            raise _NotTagSoupEquivalent
+
+def _insert_text(element, text, at_start):
+    if not text:
+        return
+    node = element.firstChild if at_start else element.lastChild
+    if node is not None and node.nodeType == node.TEXT_NODE:
+        node.data = (text + node.data) if at_start else (node.data + text)
+    else:
+        node = element.ownerDocument.createTextNode(text)
+        element.insertBefore(node, element.firstChild if at_start else None)
+
+def parse_xhtml(source):
+    """Parse well-formed XHTML using expat.
+
+    Return the same DOM that TagSoupToXml(omit_comments=True) would return
+    for the same source, or None if the source can't be parsed as XML (or
+    uses constructs that TagSoupToXml would treat differently), in which
+    case the caller should fall back to TagSoupToXml.
+    """
+    if "<![CDATA[" in source:
+        return None
+
+    # Find the whitespace before and after the root element, which
+    # TagSoupToXml puts at the start of the <head> and the end of the <body>.
+    (leading_text, pos) = _xml_misc_text(source, 0, allow_doctype=True)
+    if not source.startswith("<html", pos):
+        return None
+    m = None
+    for m in _xml_root_end_regex.finditer(source, pos):
+        pass
+    if m is None:
+        return None
+    (trailing_text, pos) = _xml_misc_text(source, m.end())
+    if pos != len(source):
+        return None
+
+    try:
+        document = minidom.parseString(source)
+    except xml.parsers.expat.ExpatError:
+        return None
+
+    try:
+        # Remove the DOCTYPE, and any comments or processing instructions around the root element
+        for node in list(document.childNodes):
+            if node is not document.documentElement:
+                document.removeChild(node)
+                node.unlink()
+
+        # The root element must contain <head>, then <body>.
+        htmlElement = document.documentElement
+        if htmlElement.tagName != "html":
+            raise _NotTagSoupEquivalent
+        _check_xhtml_children(htmlElement, [], recurse=False)
+        elements = [n for n in htmlElement.childNodes if n.nodeType == n.ELEMENT_NODE]
+        if [e.tagName for e in elements] != ["head", "body"]:
+            raise _NotTagSoupEquivalent
+        (headElement, bodyElement) = elements
+        for element in (htmlElement, headElement, bodyElement):
+            _sort_xhtml_attributes(element)
+
+        # Move text from the <html> element into <head> and <body>, like TagSoupToXml does.
+        html_text = [[], [], []]    # before <head>, between <head> and <body>, after <body>
+        i = 0
+        for node in list(htmlElement.childNodes):
+            if node.nodeType == node.ELEMENT_NODE:
+                i += 1
+            else:
+                html_text[i].append(node.data)
+                htmlElement.removeChild(node)
+                node.unlink()
+
+        _check_xhtml_children(headElement, [])
+        _check_xhtml_children(bodyElement, [])
+        _insert_text(headElement, leading_text + "".join(html_text[0]), at_start=True)
+        _insert_text(headElement, "".join(html_text[1]), at_start=False)
+        _insert_text(bodyElement, "".join(html_text[2]) + trailing_text, at_start=False)
+
+    except _NotTagSoupEquivalent:
+        document.unlink()
+        return None
+
+    return document
 
 if __name__ == '__main__':
     p = TagSoupToXml()
@@ -2,18 +2,22 @@
 # TeXPlugin.py - TeX (texvc) plugin for StillWeb
 # Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
 
+from StillWeb.PageGenerator import NeedsUpdate
 from StillWeb.Placeholders import ReplaceWithHTML, ReplaceWithNode, ReplaceWithNothing, PLACEHOLDERS_NAMESPACE
-from StillWeb.sw_util import getChildText, TypicalPaths, ensure_path
+from StillWeb.sw_util import getChildText, TypicalPaths, ensure_path, parse_size
 from StillWeb.sw_urllib import rfc3986_urljoin
+from StillWeb.TagSoupToXml import TagSoupToXml, parse_xhtml
+from StillWeb.TexCache import TexCache
 
 import os
 import errno
 import tempfile
+import concurrent.futures
+import re
+import time
 import subprocess
 import hashlib
-import pickle
 import urllib
-import binascii
 from xml.dom import minidom
 
 class TexvcResultParseError(ValueError):
@@ -142,18 +146,234 @@ class TeXPlugin:
     def __init__(self, framework):
         self._framework = framework
 
+        # The texvc result index (see _get_cache)
+        self._cache = None
+
+        # Filenames in the output directory (see _have_output)
+        self._output_files = None
+
+        # Paths computed from the current variables (see _get_texvc_outdir
+        # and _get_my_intermediate_dir)
+        self._outdir = None
+        self._intermediate_dir = None
+
+        # Output filenames of the pages made (or found to be up-to-date) in
+        # this run, and the formulas used by the page being made (see tex_gc)
+        self._seen_pages = set()
+        self._page_formulas = None
+        self._start_time = time.time()
+
         # Register the placeholder namespace
         ph_plugin = self._framework.plugins['StillWeb.Placeholders']
-        ph_plugin.register_callback(self._handle_math_element, PLACEHOLDERS_NAMESPACE, 'math')
-        ph_plugin.register_callback(self._handle_math_element, PLACEHOLDERS_NAMESPACE, 'm')
+        ph_plugin.register_callback(self._handle_math_element, PLACEHOLDERS_NAMESPACE, 'math', memoize=self._math_element_dependencies)
+        ph_plugin.register_callback(self._handle_math_element, PLACEHOLDERS_NAMESPACE, 'm', memoize=self._math_element_dependencies)
+
+        pg_plugin = self._framework.plugins['StillWeb.PageGenerator']
+        pg_plugin.register_filter('check_freshness', self._check_freshness)
+        pg_plugin.register_filter('load_content:before', self._start_page)
+        pg_plugin.register_filter('write_output:after', self._finish_page)
+        pg_plugin.register_parallel_state(self._export_parallel_state, self._merge_parallel_state)
+
+        script_processor = framework.plugins['StillWeb.ScriptProcessor']
+        script_processor.register_command('prefetch_tex', self.handle_prefetch_tex)
+        script_processor.register_command('tex_gc', self.handle_tex_gc)
+        script_processor.register_barrier(self._commit_cache)
 
     def cleanup(self):
         if self._framework is not None:
+            if self._cache is not None:
+                self._cache.close()
+                self._cache = None
             self._framework = None
+            self._seen_pages = None
+
+    #
+    # Commands
+    #
+    def handle_prefetch_tex(self, *target_urls):
+        """Generate the output for every TeX formula used in the given pages
+        (or in every file under source_dir), using several texvc processes
+        at once, so that rendering the pages only hits the cache.
+
+        The number of texvc processes is set by the 'make_jobs' variable.
+
+        Usage: prefetch_tex [TARGET_URL ...]
+        """
+        if target_urls:
+            source_filenames = [TypicalPaths(self._framework, target_url).source_filename for target_url in target_urls]
+        else:
+            source_filenames = []
+            for (dirpath, dirnames, filenames) in os.walk(self._framework.plugins['vars'].vars['source_dir']):
+                dirnames.sort()
+                source_filenames += [os.path.join(dirpath, basename) for basename in sorted(filenames)]
+
+        # Find the distinct formulas
+        formulas = set()
+        for source_filename in source_filenames:
+            formulas.update(self._find_formulas(source_filename))
+        formulas = sorted(formulas)
+
+        cache = self._get_cache()
+        texvc = self._create_texvc()
+        jobs = self._framework.plugins['StillWeb.PageGenerator'].get_make_jobs()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        try:
+            # Find the canonical MD5 sums of the formulas (running texvc_tex for
+            # the ones that aren't cached).  Only this thread uses the cache.
+            orig_md5s = dict((latex_code, self._get_orig_md5(latex_code)) for latex_code in formulas)
+            known = cache.get_canonical_md5s(orig_md5s.values())
+            def hash_code(latex_code):
+                try:
+                    return texvc.hash_code(latex_code).hexdigest()
+                except (TexvcCodeParseError, TexvcRuntimeError) as exc:
+                    # Leave the error to be reported when the page is rendered.
+                    print("TeXPlugin warning: prefetch failed: %s" % (exc,))
+                    return None
+            unknown = [latex_code for latex_code in formulas if orig_md5s[latex_code] not in known]
+            for (latex_code, canonical_md5) in zip(unknown, executor.map(hash_code, unknown)):
+                if canonical_md5 is not None:
+                    cache.set_canonical_md5(orig_md5s[latex_code], canonical_md5)
+                    known[orig_md5s[latex_code]] = canonical_md5
+
+            # Run texvc once for each formula whose output hasn't been generated
+            canonical = {}  # map canonical MD5 -> LaTeX code
+            for latex_code in formulas:
+                if orig_md5s[latex_code] in known:
+                    canonical.setdefault(known[orig_md5s[latex_code]], latex_code)
+            def generate(canonical_md5):
+                try:
+                    return self._run_texvc(Texvc(texvc.program_dir, texvc.output_dir), canonical[canonical_md5], canonical_md5)
+                except (TexvcError, TexvcResultParseError, TexvcRuntimeError) as exc:
+                    print("TeXPlugin warning: prefetch failed: %s" % (exc,))
+                    return None
+            uncached = [canonical_md5 for canonical_md5 in sorted(canonical) if not self._have_result(canonical_md5)]
+            print("prefetching TeX: %d formulas, %d to generate" % (len(formulas), len(uncached)))
+            for (canonical_md5, result) in zip(uncached, executor.map(generate, uncached)):
+                if result is not None:
+                    self._store_result(canonical_md5, result)
+        finally:
+            executor.shutdown()
+        cache.commit()
+
+    def handle_tex_gc(self, max_size=None):
+        """Remove TeX images and cache entries that are no longer used.
+
+        A formula is in use if it is on a page that still exists in the
+        output directory (as recorded when the page was last made).  Pages
+        should be made before running tex_gc, so that formulas removed from
+        a page are no longer counted.  If no pages have been recorded,
+        nothing is removed.  Without MAX_SIZE, every other formula is
+        removed.  With MAX_SIZE (a number of bytes, optionally followed by K,
+        M or G), unused formulas are kept for later, except that the least
+        recently used ones are removed until the images take up at most
+        MAX_SIZE bytes.
+
+        Usage: tex_gc [MAX_SIZE]
+        """
+        if max_size is not None:
+            max_size = parse_size(max_size)
+
+        cache = self._get_cache()
+        cache.commit()
+
+        # Without any page records (e.g. if the cache was just created, or
+        # before any pages are made), every formula would look unused.
+        if not cache.get_pages() and not self._seen_pages:
+            print("TeXPlugin warning: tex_gc: no pages have been recorded; not removing anything")
+            return
+
+        # Find the formulas that are in use.  Pages that weren't made in this
+        # run still count (their output may be deployed), unless their output
+        # file is gone, in which case their records are dropped.
+        in_use = set()
+        old_pages = []
+        for output_filename in cache.get_pages():
+            if output_filename in self._seen_pages or os.path.exists(output_filename):
+                in_use.update(cache.get_page_formulas(output_filename))
+            else:
+                old_pages.append(output_filename)
+
+        # Find the images
+        (output_dir_url, output_dir) = self._get_texvc_outdir()
+        image_sizes = {}    # map canonical_md5 -> size in bytes
+        if os.path.isdir(output_dir):
+            for basename in os.listdir(output_dir):
+                m = re.search(r"\A([0-9a-f]{32})\.png\Z", basename)
+                if m:
+                    image_sizes[m.group(1)] = os.path.getsize(os.path.join(output_dir, basename))
+
+        # Choose the formulas to remove, least recently used first
+        unused = set(cache.get_results()).union(image_sizes).difference(in_use)
+        unused = sorted(unused, key=lambda canonical_md5: (cache.get_last_used(canonical_md5), canonical_md5))
+        if max_size is not None:
+            total_size = sum(image_sizes.values())
+            n = 0
+            while n < len(unused) and total_size > max_size:
+                total_size -= image_sizes.get(unused[n], 0)
+                n += 1
+            unused = unused[:n]
+
+        # Remove them
+        removed_size = 0
+        for canonical_md5 in unused:
+            if canonical_md5 in image_sizes:
+                (output_filename, output_url) = self._get_output_paths(canonical_md5)
+                os.unlink(output_filename)
+                removed_size += image_sizes[canonical_md5]
+                if self._output_files is not None:
+                    self._output_files.discard(self._get_output_basename(canonical_md5))
+        cache.remove(unused, old_pages)
+
+        # Remove the files used by older versions of this plugin
+        intermediate_dir = self._get_my_intermediate_dir()
+        for basename in os.listdir(intermediate_dir):
+            if basename.startswith("texvc-original-") or basename.startswith("texvc-canonical-"):
+                os.unlink(os.path.join(intermediate_dir, basename))
+
+        print("tex_gc: removed %d formulas (%d bytes of images); %d in use" % (len(unused), removed_size, len(in_use)))
+
+    #
+    # Filters
+    #
+    def _check_freshness(self, page_generator):
+        # The page is part of the site, so its formulas are in use.
+        output_filename = page_generator.path_info.output_filename
+        self._seen_pages.add(output_filename)
+        cache = self._get_cache()
+        if not cache.has_page(output_filename):
+            # We don't know which formulas are on the page, so make it again.
+            raise NeedsUpdate
+        cache.touch(cache.get_page_formulas(output_filename), self._start_time)
+
+    def _start_page(self, page_generator):
+        # Pages that are only scanned (see scan_feed_entries) aren't written,
+        # so _finish_page won't be called, and their formulas aren't recorded.
+        if page_generator.content_only:
+            return
+        self._page_formulas = set()
+
+    def _finish_page(self, page_generator):
+        self._get_cache().set_page_formulas(page_generator.path_info.output_filename, self._page_formulas)
+        self._page_formulas = None
 
     #
     # Namespace callback(s)
     #
+    def _math_element_dependencies(self, page_generator, element):
+        # The result of _handle_math_element depends on the formula's texvc
+        # result and on where the images are.  (If the canonical MD5 sum isn't
+        # known yet, the callback is invoked, and finds it.)
+        latex_code = getChildText(element).strip()
+        if not latex_code:
+            return None
+        canonical_md5 = self._get_cache().get_canonical_md5(self._get_orig_md5(latex_code))
+        if canonical_md5 is not None:
+            # Remember that the formula is in use (as math_placeholder does)
+            self._get_cache().touch([canonical_md5], self._start_time)
+            if self._page_formulas is not None:
+                self._page_formulas.add(canonical_md5)
+        return (canonical_md5, self._get_texvc_outdir()[0])
+
     def _handle_math_element(self, page_generator, element):
         self.math_placeholder(getChildText(element), force_img=(element.getAttribute('force') == 'img'))
 
@@ -169,82 +389,33 @@ class TeXPlugin:
         if not latex_code:
             raise ReplaceWithNothing()
 
-        # Find the texvc executable
-        texvc_program_dir = self._framework.plugins['vars'].vars['texvc_program_dir']
-
-        # Find the output directory
-        (output_dir_url, output_dir) = self._get_texvc_outdir()
-        intermediate_dir = self._get_my_intermediate_dir()
-
-        # Quietly make sure both directories exist
-        ensure_path(output_dir)
-        ensure_path(intermediate_dir)
-
-        # Create a Texvc instance
-        texvc = Texvc(texvc_program_dir, output_dir)
+        cache = self._get_cache()
+        texvc = self._create_texvc()
 
         # Two MD5 sums are calculated:
         #   1. The "original" checksum of the code actually found in the page
         #   2. The "canonical" checksum that texvc generates
         # These might be identical, or they might be different.  We cache them both.
-        orig_md5 = hashlib.md5(latex_code.encode('UTF-8')).hexdigest()
-        orig_md5_filename = os.path.join(intermediate_dir, "texvc-original-%s-sum" % (orig_md5,))
-
-        # Try to read the canonical MD5 sum from the cache file.  Generate it if it's not cached.
-        try:
-            f = open(orig_md5_filename, "rt")
-            canonical_md5 = binascii.b2a_hex(binascii.a2b_hex(f.read().strip().encode('ascii'))).decode('ascii')    # make sure it's hexadecimal
-            assert len(canonical_md5) == 32     # 32 hexadecimal digits
-            f.close()
-        except EnvironmentError as exc:
-            if exc.errno != errno.ENOENT:
-                raise
-
+        orig_md5 = self._get_orig_md5(latex_code)
+        canonical_md5 = cache.get_canonical_md5(orig_md5)
+        if canonical_md5 is None:
             # Generate the MD5 sum of the *canonical* code (i.e. of texvc_tex's output)
             canonical_md5 = texvc.hash_code(latex_code).hexdigest()
-
-            # Cache the generated MD5 sum for future reference
-            f = open(orig_md5_filename, "wt", encoding="UTF-8")
-            f.write(canonical_md5)
-            f.close()
+            cache.set_canonical_md5(orig_md5, canonical_md5)
 
         # Check if we've already generated the output
-        stamp_filename = os.path.join(intermediate_dir, "texvc-canonical-%s-stamp" % (canonical_md5,))
-        result_filename = os.path.join(intermediate_dir, "texvc-canonical-%s-result" % (canonical_md5,))
-        output_basename = "%s.png" % (canonical_md5,)
-        output_filename = os.path.join(output_dir, output_basename)
-        output_url = rfc3986_urljoin(output_dir_url, output_basename)
-        if os.path.exists(stamp_filename) and os.path.exists(output_filename):
+        (output_filename, output_url) = self._get_output_paths(canonical_md5)
+        if self._have_result(canonical_md5):
             print("skipping TeX %s" % (output_filename,))
-
-            # Use the cached result
-            result = pickle.load(open(result_filename, "rb"))
-
-            # Check the hash result - this should never fail unless the cache file is corrupt
-            if result['md5'] != canonical_md5:
-                raise AssertionError("corrupt file: %r" % (result_filename,))
-
+            result = cache.get_result(canonical_md5)
         else:
-            print("generating TeX %s" % (output_filename,))
-
-            # Parse texvc result and check for errors
-            result = texvc.run_texvc(latex_code)
-
-            # Check the hash result - our caching here breaks if we get this wrong.
-            if result['md5'] != canonical_md5:
-                raise AssertionError("texvc md5 sum mismatch (code=%r, my_md5=%r, texvc_md5=%r)" % (
-                    latex_code, canonical_md5, result['md5']))
-
-            # Check that the output file was created
-            if not os.path.exists(output_filename):
-                raise TexvcRuntimeError("texvc didn't create output file %r (canonical_md5=%r, code=%r)" % (output_filename, canonical_md5, latex_code))
-
-            # Save the result for future use
-            pickle.dump(result, open(result_filename, "wb"))
+            result = self._run_texvc(texvc, latex_code, canonical_md5)
+            self._store_result(canonical_md5, result)
 
-            # Write the canonical MD5 sum to the timestamp file (and update its timestamp)
-            open(stamp_filename, "ab").close()
-            os.utime(stamp_filename, None)     # should be unnecessary if we're writing to the file
+        # Remember that the formula is in use
+        cache.touch([canonical_md5], self._start_time)
+        if self._page_formulas is not None:
+            self._page_formulas.add(canonical_md5)
 
         # If texvc gave us some HTML code (of moderate or conservative strictness), use that.
         if not force_img and result['html'] is not None and result['html_strictness'] > 0:
@@ -259,26 +430,172 @@ class TeXPlugin:
         imgElement.setAttribute('alt', latex_code)
         raise ReplaceWithNode(imgElement)
 
+    #
+    # Parallel 'make' support
+    #
+    def _export_parallel_state(self):
+        # Pass any new cache entries to the main process, so that only the
+        # main process writes to the index.
+        (seen_pages, self._seen_pages) = (self._seen_pages, set())
+        if self._cache is None:
+            return (seen_pages, None)
+        return (seen_pages, self._cache.export_changes())
+
+    def _merge_parallel_state(self, state):
+        (seen_pages, changes) = state
+        self._seen_pages.update(seen_pages)
+        if changes is not None:
+            self._get_cache().merge_changes(changes)
+            if self._output_files is not None:
+                for (canonical_md5, result) in changes[1]:
+                    self._output_files.add(self._get_output_basename(canonical_md5))
+
     #
     # Internal functions
     #
+    def _get_cache(self):
+        if self._cache is None:
+            intermediate_dir = self._get_my_intermediate_dir()
+            ensure_path(intermediate_dir)
+            self._cache = TexCache(os.path.join(intermediate_dir, "texvc-cache.sqlite"))
+            self._cache.load()
+        return self._cache
+
+    def _commit_cache(self):
+        if self._cache is not None:
+            self._cache.commit()
+
+    def _create_texvc(self):
+        texvc_program_dir = self._framework.plugins['vars'].vars['texvc_program_dir']
+        (output_dir_url, output_dir) = self._get_texvc_outdir()
+        return Texvc(texvc_program_dir, output_dir)
+
+    @staticmethod
+    def _get_orig_md5(latex_code):
+        return hashlib.md5(latex_code.encode('UTF-8')).hexdigest()
+
+    @staticmethod
+    def _get_output_basename(canonical_md5):
+        return "%s.png" % (canonical_md5,)
+
+    def _get_output_paths(self, canonical_md5):
+        """Return (output_filename, output_url) of the PNG image for the given canonical MD5 sum"""
+        (output_dir_url, output_dir) = self._get_texvc_outdir()
+        output_basename = self._get_output_basename(canonical_md5)
+        return (os.path.join(output_dir, output_basename), rfc3986_urljoin(output_dir_url, output_basename))
+
+    def _have_output(self, canonical_md5):
+        """Return True if the PNG image for the given canonical MD5 sum exists"""
+        if self._output_files is None:
+            # List the output directory once, rather than checking for each file
+            (output_dir_url, output_dir) = self._get_texvc_outdir()
+            try:
+                self._output_files = set(os.listdir(output_dir))
+            except EnvironmentError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+                self._output_files = set()
+        output_basename = self._get_output_basename(canonical_md5)
+        if output_basename in self._output_files:
+            return True
+
+        # The file might have been created by a parallel 'make' worker
+        (output_filename, output_url) = self._get_output_paths(canonical_md5)
+        if os.path.exists(output_filename):
+            self._output_files.add(output_basename)
+            return True
+        return False
+
+    def _have_result(self, canonical_md5):
+        """Return True if the given formula has already been generated"""
+        return self._get_cache().get_result(canonical_md5) is not None and self._have_output(canonical_md5)
+
+    def _store_result(self, canonical_md5, result):
+        self._get_cache().set_result(canonical_md5, result)
+        if self._output_files is not None:
+            self._output_files.add(self._get_output_basename(canonical_md5))
+
+    def _run_texvc(self, texvc, latex_code, canonical_md5):
+        """Run texvc on the given LaTeX code, and return the result.
+
+        This doesn't touch the cache, so it can be called from several threads at once.
+        """
+        (output_filename, output_url) = self._get_output_paths(canonical_md5)
+
+        print("generating TeX %s" % (output_filename,))
+
+        # Quietly make sure the output directory exists
+        ensure_path(texvc.output_dir)
+
+        # Parse texvc result and check for errors
+        result = texvc.run_texvc(latex_code)
+
+        # Check the hash result - our caching here breaks if we get this wrong.
+        if result['md5'] != canonical_md5:
+            raise AssertionError("texvc md5 sum mismatch (code=%r, my_md5=%r, texvc_md5=%r)" % (
+                latex_code, canonical_md5, result['md5']))
+
+        # Check that the output file was created
+        if not os.path.exists(output_filename):
+            raise TexvcRuntimeError("texvc didn't create output file %r (canonical_md5=%r, code=%r)" % (output_filename, canonical_md5, latex_code))
+
+        return result
+
+    def _find_formulas(self, source_filename):
+        """Return the LaTeX code of every math placeholder in the given source file"""
+        try:
+            source = open(source_filename, "rt", encoding="UTF-8").read()
+        except UnicodeDecodeError:
+            return []   # Not a page (e.g. an image)
+
+        # Don't bother parsing pages that contain no placeholders
+        if PLACEHOLDERS_NAMESPACE not in source:
+            return []
+
+        # Parse the page the same way PageGenerator does
+        document = None
+        if self._framework.plugins['StillWeb.PageGenerator'].get_xhtml_fast_path():
+            document = parse_xhtml(source)
+        if document is None:
+            p = TagSoupToXml(omit_comments=True, build_tree=True)
+            p.feed(source)
+            p.close()
+            document = p.todocument()
+
+        formulas = []
+        for localName in ('math', 'm'):
+            for element in document.getElementsByTagNameNS(PLACEHOLDERS_NAMESPACE, localName):
+                latex_code = getChildText(element).strip()
+                if latex_code:
+                    formulas.append(latex_code)
+        document.unlink()
+        return formulas
+
     def _get_texvc_outdir(self):
-        outdir_url = self._framework.plugins['vars'].vars['texvc_outdir_url']
+        # (The result is remembered until the variables it depends on change.)
+        vars = self._framework.plugins['vars'].vars
+        key = (vars['texvc_outdir_url'], vars.get('output_dir'), vars.get('base_url'))
+        if self._outdir is None or self._outdir[0] != key:
+            outdir_url = vars['texvc_outdir_url']
 
-        # Make sure there is a trailing slash after outdir_url
-        (u_scheme, u_netloc, u_path, u_params, u_query, u_fragment) = urllib.parse.urlparse(outdir_url)
-        u_path = u_path.rstrip("/") + "/"
-        outdir_url = urllib.parse.urlunparse((u_scheme, u_netloc, u_path, u_params, u_query, u_fragment))
+            # Make sure there is a trailing slash after outdir_url
+            (u_scheme, u_netloc, u_path, u_params, u_query, u_fragment) = urllib.parse.urlparse(outdir_url)
+            u_path = u_path.rstrip("/") + "/"
+            outdir_url = urllib.parse.urlunparse((u_scheme, u_netloc, u_path, u_params, u_query, u_fragment))
 
-        # Figure out the absolute path to the directory
-        out_tp = TypicalPaths(self._framework, outdir_url)
-        outdir_path = out_tp.output_filename
+            # Figure out the absolute path to the directory
+            out_tp = TypicalPaths(self._framework, outdir_url)
+            outdir_path = out_tp.output_filename
 
-        return (outdir_url, outdir_path)
+            self._outdir = (key, (outdir_url, outdir_path))
+        return self._outdir[1]
 
     def _get_my_intermediate_dir(self):
-        im_dir = os.path.join(self._framework.plugins['vars'].vars['intermediate_data_dir'], "StillWeb.TeXPlugin")
-        return os.path.realpath(im_dir)
+        intermediate_data_dir = self._framework.plugins['vars'].vars['intermediate_data_dir']
+        if self._intermediate_dir is None or self._intermediate_dir[0] != intermediate_data_dir:
+            im_dir = os.path.join(intermediate_data_dir, "StillWeb.TeXPlugin")
+            self._intermediate_dir = (intermediate_data_dir, os.path.realpath(im_dir))
+        return self._intermediate_dir[1]
 
 def create_plugin(framework):
     return TeXPlugin(framework)
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+# TexCache.py - Index of texvc results
+# Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
+
+import os
+import sqlite3
+
+class TexCache:
+    """Index of the results of texvc, stored in a single SQLite database.
+
+    Three mappings are stored:
+
+        originals
+            MD5 sum of the LaTeX code found in a page -> MD5 sum of the
+            canonical code (i.e. of texvc_tex's output)
+
+        results
+            canonical MD5 sum -> parsed texvc result (see Texvc.parse_result),
+            and the time the formula was last used
+
+        pages
+            output filename -> canonical MD5 sums of the formulas on the page
+            (for every page made since the page was last built)
+
+    The whole index is read into memory the first time it is used, so
+    looking up a formula doesn't touch the disk.  Changes are kept in memory
+    until commit() is called, and are then written in a single transaction.
+    """
+
+    # Bump this if the schema changes
+    VERSION = 1
+
+    # Result fields, in column order ('md5' is the key)
+    RESULT_FIELDS = ('code', 'html', 'html_strictness', 'mathml')
+
+    _SCHEMA = [
+        "DROP TABLE IF EXISTS originals",
+        "DROP TABLE IF EXISTS results",
+        "DROP TABLE IF EXISTS pages",
+        "DROP TABLE IF EXISTS page_formulas",
+        """CREATE TABLE originals (
+            orig_md5 TEXT PRIMARY KEY,
+            canonical_md5 TEXT NOT NULL
+        )""",
+        """CREATE TABLE results (
+            canonical_md5 TEXT PRIMARY KEY,
+            code TEXT NOT NULL,
+            html TEXT,
+            html_strictness INTEGER,
+            mathml TEXT,
+            last_used REAL
+        )""",
+        """CREATE TABLE pages (
+            output_filename TEXT PRIMARY KEY
+        )""",
+        """CREATE TABLE page_formulas (
+            output_filename TEXT NOT NULL,
+            canonical_md5 TEXT NOT NULL,
+            PRIMARY KEY (output_filename, canonical_md5)
+        )""",
+    ]
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._conn = None
+        self._pid = None
+        self._originals = None  # map orig_md5 -> canonical_md5
+        self._results = None    # map canonical_md5 -> result
+        self._last_used = None  # map canonical_md5 -> time
+        self._pages = None      # map output_filename -> frozenset of canonical_md5
+        self._new_originals = []
+        self._new_results = []
+        self._new_pages = {}
+        self._new_last_used = {}
+
+    def _connection(self):
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+
+        # (If we're in a forked child process, the inherited connection
+        # must not be used, so it's left alone.)
+        conn = sqlite3.connect(self.filename, timeout=60)
+        if conn.execute("PRAGMA user_version").fetchone()[0] != self.VERSION:
+            conn.execute("BEGIN EXCLUSIVE")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != self.VERSION:
+                for statement in self._SCHEMA:
+                    conn.execute(statement)
+                conn.execute("PRAGMA user_version = %d" % (self.VERSION,))
+            conn.commit()
+        self._conn = conn
+        self._pid = os.getpid()
+        return conn
+
+    def load(self):
+        """Read the index into memory (if it hasn't been read already)"""
+        if self._originals is not None:
+            return
+        conn = self._connection()
+        self._originals = dict(conn.execute("SELECT orig_md5, canonical_md5 FROM originals"))
+        self._results = {}
+        self._last_used = {}
+        for row in conn.execute("SELECT canonical_md5, last_used, %s FROM results" % (", ".join(self.RESULT_FIELDS),)):
+            result = dict(zip(self.RESULT_FIELDS, row[2:]))
+            result['md5'] = row[0]
+            self._results[row[0]] = result
+            self._last_used[row[0]] = row[1] or 0
+        pages = dict((output_filename, set()) for (output_filename,) in conn.execute("SELECT output_filename FROM pages"))
+        for (output_filename, canonical_md5) in conn.execute("SELECT output_filename, canonical_md5 FROM page_formulas"):
+            pages[output_filename].add(canonical_md5)
+        self._pages = dict((output_filename, frozenset(md5s)) for (output_filename, md5s) in pages.items())
+
+    def commit(self):
+        """Write any changes to the database"""
+        if not (self._new_originals or self._new_results or self._new_pages or self._new_last_used):
+            return
+        conn = self._connection()
+        conn.executemany("INSERT OR REPLACE INTO originals (orig_md5, canonical_md5) VALUES (?, ?)", self._new_originals)
+        conn.executemany("INSERT OR REPLACE INTO results (canonical_md5, last_used, %s) VALUES (?, ?, %s)" % (
+            ", ".join(self.RESULT_FIELDS), ", ".join("?" * len(self.RESULT_FIELDS))),
+            [(md5, self._last_used.get(md5)) + tuple(result[k] for k in self.RESULT_FIELDS) for (md5, result) in self._new_results])
+        conn.executemany("UPDATE results SET last_used = ? WHERE canonical_md5 = ?",
+            [(t, md5) for (md5, t) in self._new_last_used.items()])
+        for (output_filename, md5s) in self._new_pages.items():
+            conn.execute("INSERT OR IGNORE INTO pages (output_filename) VALUES (?)", (output_filename,))
+            conn.execute("DELETE FROM page_formulas WHERE output_filename = ?", (output_filename,))
+            conn.executemany("INSERT INTO page_formulas (output_filename, canonical_md5) VALUES (?, ?)",
+                [(output_filename, md5) for md5 in md5s])
+        conn.commit()
+        self._new_originals = []
+        self._new_results = []
+        self._new_pages = {}
+        self._new_last_used = {}
+
+    def close(self):
+        self.commit()
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+    def export_changes(self):
+        """Return (and forget) the uncommitted changes.
+
+        This is used by parallel 'make' workers, which pass their changes to
+        the main process instead of writing to the database.
+        """
+        changes = (self._new_originals, self._new_results, self._new_pages, self._new_last_used)
+        self._new_originals = []
+        self._new_results = []
+        self._new_pages = {}
+        self._new_last_used = {}
+        return changes
+
+    def merge_changes(self, changes):
+        """Apply changes returned by export_changes()"""
+        (new_originals, new_results, new_pages, new_last_used) = changes
+        for (orig_md5, canonical_md5) in new_originals:
+            self.set_canonical_md5(orig_md5, canonical_md5)
+        for (canonical_md5, result) in new_results:
+            self.set_result(canonical_md5, result)
+        for (output_filename, md5s) in new_pages.items():
+            self.set_page_formulas(output_filename, md5s)
+        for (canonical_md5, t) in new_last_used.items():
+            self.touch([canonical_md5], t)
+
+    #
+    # Lookups
+    #
+    def get_canonical_md5(self, orig_md5):
+        """Return the canonical MD5 sum for the given original MD5 sum (or None)"""
+        self.load()
+        return self._originals.get(orig_md5)
+
+    def get_canonical_md5s(self, orig_md5s):
+        """Return a dictionary mapping each of the given original MD5 sums
+        that is in the index to its canonical MD5 sum.
+        """
+        self.load()
+        originals = self._originals
+        return dict((orig_md5, originals[orig_md5]) for orig_md5 in orig_md5s if orig_md5 in originals)
+
+    def get_result(self, canonical_md5):
+        """Return the texvc result for the given canonical MD5 sum (or None)"""
+        self.load()
+        return self._results.get(canonical_md5)
+
+    def set_canonical_md5(self, orig_md5, canonical_md5):
+        self.load()
+        if self._originals.get(orig_md5) != canonical_md5:
+            self._originals[orig_md5] = canonical_md5
+            self._new_originals.append((orig_md5, canonical_md5))
+
+    def set_result(self, canonical_md5, result):
+        assert result['md5'] == canonical_md5
+        self.load()
+        result = dict((k, result[k]) for k in ('md5',) + self.RESULT_FIELDS)
+        if self._results.get(canonical_md5) != result:
+            self._results[canonical_md5] = result
+            self._new_results.append((canonical_md5, result))
+            self._last_used.setdefault(canonical_md5, 0)
+
+    #
+    # Usage tracking
+    #
+    def get_results(self):
+        """Return the canonical MD5 sums of all of the stored results"""
+        self.load()
+        return list(self._results.keys())
+
+    def get_last_used(self, canonical_md5):
+        """Return the time the formula was last used (0 if unknown)"""
+        self.load()
+        return self._last_used.get(canonical_md5, 0)
+
+    def touch(self, canonical_md5s, t):
+        """Record that the given formulas were used at time `t`"""
+        self.load()
+        for canonical_md5 in canonical_md5s:
+            if self._last_used.get(canonical_md5, 0) < t:
+                self._last_used[canonical_md5] = t
+                self._new_last_used[canonical_md5] = t
+
+    def get_pages(self):
+        """Return the output filenames of the recorded pages"""
+        self.load()
+        return list(self._pages.keys())
+
+    def has_page(self, output_filename):
+        """Return True if the formulas on the given page have been recorded"""
+        self.load()
+        return output_filename in self._pages
+
+    def get_page_formulas(self, output_filename):
+        """Return the canonical MD5 sums of the formulas on the given page"""
+        self.load()
+        return self._pages.get(output_filename, frozenset())
+
+    def set_page_formulas(self, output_filename, canonical_md5s):
+        self.load()
+        canonical_md5s = frozenset(canonical_md5s)
+        if self._pages.get(output_filename) != canonical_md5s:
+            self._pages[output_filename] = canonical_md5s
+            self._new_pages[output_filename] = canonical_md5s
+
+    def remove(self, canonical_md5s, output_filenames):
+        """Remove the given results (and the originals that map to them)
+        and the records of the given pages, and commit.
+        """
+        self.commit()
+        self.load()
+        canonical_md5s = set(canonical_md5s)
+        conn = self._connection()
+        conn.executemany("DELETE FROM pages WHERE output_filename = ?", [(f,) for f in output_filenames])
+        conn.executemany("DELETE FROM page_formulas WHERE output_filename = ?", [(f,) for f in output_filenames])
+        conn.executemany("DELETE FROM results WHERE canonical_md5 = ?", [(md5,) for md5 in canonical_md5s])
+        conn.executemany("DELETE FROM originals WHERE canonical_md5 = ?", [(md5,) for md5 in canonical_md5s])
+        conn.commit()
+        for output_filename in output_filenames:
+            self._pages.pop(output_filename, None)
+        for canonical_md5 in canonical_md5s:
+            self._results.pop(canonical_md5, None)
+            self._last_used.pop(canonical_md5, None)
+        self._originals = dict((orig_md5, canonical_md5) for (orig_md5, canonical_md5) in self._originals.items()
+            if canonical_md5 not in canonical_md5s)
+
+# vim:set ts=4 sw=4 sts=4 expandtab:
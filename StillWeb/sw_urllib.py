@@ -4,21 +4,286 @@
 
 import urllib.parse
 
-def remove_dot_segments(url):
-    """Remove "." and ".." segments from an URL.
+from urllib.parse import uses_netloc, uses_params, uses_relative
 
-    This function works with both absolute and relative URLs.
+class ParsedURL:
+    """An immutable parsed URL.
 
-    This function removes double slashes (empty path segments) from the path
-    part of an URL.
+    The components are the same as those returned by urllib.parse.urlparse()
+    (scheme, netloc, path, params, query, fragment), and `segments` is the
+    path split on "/".  Operations return new ParsedURL objects, so a chain
+    of them (e.g. rebase_url) parses each input only once.
+
+    Objects created by the operations below are always in the form that
+    urlparse() would return for str(obj), so the operations give exactly the
+    same results as the corresponding string functions.
     """
 
-    (scheme, netloc, path, params, query, fragment) = urllib.parse.urlparse(url)
+    __slots__ = ('scheme', 'netloc', 'path', 'params', 'query', 'fragment', 'segments', '_empty', '_url', '_rawpath')
+
+    def __new__(cls, scheme, netloc, path, params='', query='', fragment=''):
+        return _new_url(scheme, netloc, path, params, query, fragment)
+
+    @classmethod
+    def parse(cls, url):
+        """Parse an URL string (see urllib.parse.urlparse)"""
+        (scheme, netloc, path, params, query, fragment) = urllib.parse.urlparse(url)
+        result = _new_url(scheme, netloc, path, params, query, fragment, not url)
+        if ';' in url:
+            _set_rawpath(result, urllib.parse.urlsplit(url).path)
+        return result
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ParsedURL objects are immutable")
+
+    __delattr__ = __setattr__
+
+    def __str__(self):
+        url = self._url
+        if url is None:
+            # Same as urllib.parse.urlunparse
+            (scheme, netloc, url, params, query, fragment) = (self.scheme, self.netloc,
+                self.path, self.params, self.query, self.fragment)
+            if params:
+                url = "%s;%s" % (url, params)
+            if netloc or (scheme and scheme in uses_netloc and url[:2] != '//'):
+                if url and url[:1] != '/':
+                    url = '/' + url
+                url = '//' + netloc + url
+            if scheme:
+                url = scheme + ':' + url
+            if query:
+                url = url + '?' + query
+            if fragment:
+                url = url + '#' + fragment
+            _set_url(self, url)
+        return url
+
+    geturl = __str__
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, str(self))
+
+    def _components(self):
+        return (self.scheme, self.netloc, self.path, self.params, self.query, self.fragment)
+
+    def __eq__(self, other):
+        if not isinstance(other, ParsedURL):
+            return NotImplemented
+        return self._components() == other._components()
+
+    def __ne__(self, other):
+        if not isinstance(other, ParsedURL):
+            return NotImplemented
+        return self._components() != other._components()
+
+    def __hash__(self):
+        return hash(self._components())
+
+    def _is_canonical(self):
+        """Return True if this is the same object that _make_url() would return for our components"""
+        components = self._components()
+        return (self._url is None and self._rawpath is None and
+            self._empty == (not any(components)) and _round_trips(*components))
+
+    def remove_dot_segments(self):
+        """Remove "." and ".." segments (see remove_dot_segments)"""
+        path = _remove_dot_segments_from_path(self.path, self.segments)
+        if path == self.path and self._is_canonical():
+            return self     # Nothing to do
+        return _make_url(self.scheme, self.netloc, path, self.params, self.query, self.fragment)
+
+    def join(self, url):
+        """Resolve `url` (a string or ParsedURL) against this URL (see rfc3986_urljoin)"""
+        if isinstance(url, str):
+            url = ParsedURL.parse(url)
+        if self._empty:
+            return url.remove_dot_segments()
+        if url._empty:
+            return self.remove_dot_segments()
+
+        # Same as urllib.parse.urljoin, followed by remove_dot_segments
+        (scheme, netloc, path, params, query, fragment) = url._components()
+        if not scheme:
+            scheme = self.scheme
+        if scheme != self.scheme or scheme not in uses_relative:
+            return url.remove_dot_segments()
+        if scheme not in uses_params and not url.scheme:
+            # urljoin parses `url` using the base's scheme, so it doesn't split params.
+            if url._rawpath is not None:
+                path = url._rawpath
+            elif params:
+                path = "%s;%s" % (path, params)
+            params = ''
+        if scheme in uses_netloc:
+            if netloc:
+                return _make_url_without_dot_segments(scheme, netloc, path, params, query, fragment)
+            netloc = self.netloc
+
+        if not path and not params:
+            if not query:
+                query = self.query
+            return _make_url_without_dot_segments(scheme, netloc, self.path, self.params, query, fragment)
+
+        base_parts = list(self.segments)
+        if base_parts[-1] != '':
+            # the last item is not a directory, so will not be taken into account
+            # in resolving the relative path
+            del base_parts[-1]
+
+        if path[:1] == '/':
+            segments = path.split('/')
+        else:
+            segments = base_parts + path.split('/')
+            # filter out elements that would cause redundant slashes on re-joining
+            # the resolved_path
+            segments[1:-1] = filter(None, segments[1:-1])
+
+        resolved_path = []
+        for seg in segments:
+            if seg == '..':
+                if resolved_path:
+                    resolved_path.pop()
+            elif seg == '.':
+                continue
+            else:
+                resolved_path.append(seg)
 
-    # Strip leading and trailing slash(es) and split into path segments
-    path_segments = path.strip("/").split("/")
+        if segments[-1] in ('.', '..'):
+            # if the last segment was a relative dir, then we need to append the trailing '/'
+            resolved_path.append('')
+
+        return _make_url_without_dot_segments(scheme, netloc, '/'.join(resolved_path) or '/', params, query, fragment)
+
+    def relative_to(self, base, allow_empty=False, allow_net=False):
+        """Return the relative representation of this URL, using the ParsedURL
+        `base` as a starting point (see relative_url).
+        """
+        t = base.join(self)
+        (t_scheme, t_netloc, t_path, t_params, t_query, t_fragment) = t._components()
+
+        for dummy in [0]:   # Run once
+            if t_scheme != base.scheme:
+                break
+            if allow_net:
+                t_scheme = ''
+
+            if t_netloc != base.netloc:
+                break
+            t_scheme = ''
+            t_netloc = ''
+
+            if t_path == base.path:
+                p = t.segments
+                if allow_empty:
+                    t_path = ''
+                else:
+                    if not p or not p[-1]:
+                        t_path = "./"
+                    else:
+                        t_path = p[-1]
+
+                if t_query != base.query:
+                    break
+                t_query = ''
+
+                if t_fragment != base.fragment:
+                    break
+                t_fragment = ''
+                break
+
+            tp = t.segments     # target path
+            bp = base.segments  # base path
+
+            tp_depth = len(tp)-1
+            bp_depth = len(bp)-1
+
+            n = min(len(tp), len(bp))
+            dcp_depth = 0
+            for i in range(1, n):
+                if tp[i] != bp[i]:
+                    break
+                dcp_depth = i
+
+            go_up = bp_depth - dcp_depth - 1
+            if go_up > 0:
+                relpath = "../" * go_up
+            else:
+                relpath = ""
+
+            relpath += "/".join(tp[dcp_depth+1:])
+
+            if not relpath:
+                relpath = "./"
+
+            t_path = relpath
+
+        return _make_url(t_scheme, t_netloc, t_path, t_params, t_query, t_fragment)
+
+    def rebase(self, src, dest, must_rebase=False):
+        """Re-base this URL from the ParsedURL `src` to the ParsedURL `dest` (see rebase_url)"""
+        t = src.join(self)
+        r = t.relative_to(src)
+        if r.scheme or r.netloc or r.path.startswith("../"):
+            if must_rebase:
+                raise ValueError("Couldn't rebase URL")
+            return t
+        return dest.join(r)
+
+_new = object.__new__
+_set_scheme = ParsedURL.scheme.__set__
+_set_netloc = ParsedURL.netloc.__set__
+_set_path = ParsedURL.path.__set__
+_set_params = ParsedURL.params.__set__
+_set_query = ParsedURL.query.__set__
+_set_fragment = ParsedURL.fragment.__set__
+_set_segments = ParsedURL.segments.__set__
+_set_empty = ParsedURL._empty.__set__
+_set_url = ParsedURL._url.__set__
+_set_rawpath = ParsedURL._rawpath.__set__
+
+def _new_url(scheme, netloc, path, params, query, fragment, empty=None):
+    # This is called a lot, so it uses the slot descriptors directly, rather
+    # than object.__setattr__.
+    result = _new(ParsedURL)
+    _set_scheme(result, scheme)
+    _set_netloc(result, netloc)
+    _set_path(result, path)
+    _set_params(result, params)
+    _set_query(result, query)
+    _set_fragment(result, fragment)
+    _set_segments(result, tuple(path.split("/")))
+    if empty is None:
+        empty = not (scheme or netloc or path or params or query or fragment)
+    _set_empty(result, empty)   # True if this is the empty URL reference ("")
+    _set_url(result, None)      # cached string representation
+    _set_rawpath(result, None)  # path (including params) as found in the source string, if it was parsed
+    return result
+
+def _make_url(scheme, netloc, path, params, query, fragment):
+    """Return a ParsedURL for the URL that urlunparse() would build from the given components"""
+    if _round_trips(scheme, netloc, path, params, query, fragment):
+        return _new_url(scheme, netloc, path, params, query, fragment)
+    # Rare case (e.g. a relative path that looks like it has a scheme): Re-parse
+    url = urllib.parse.urlunparse((scheme, netloc, path, params, query, fragment))
+    result = ParsedURL.parse(url)
+    _set_url(result, url)
+    return result
+
+def _make_url_without_dot_segments(scheme, netloc, path, params, query, fragment):
+    """Same as _make_url(...).remove_dot_segments(), but without creating the intermediate object"""
+    if _round_trips(scheme, netloc, path, params, query, fragment):
+        path = _remove_dot_segments_from_path(path, path.split("/"))
+        return _make_url(scheme, netloc, path, params, query, fragment)
+    return _make_url(scheme, netloc, path, params, query, fragment).remove_dot_segments()
+
+def _remove_dot_segments_from_path(path, path_segments):
+    # Shortcut: No dot segments or double slashes
+    if "." not in path_segments and ".." not in path_segments and "" not in path_segments[1:-1]:
+        return path
+
+    path_segments = list(path_segments)
 
-    # Strip "." and "" segments and resolve ".." segments.
     i = len(path_segments)-1
     to_remove = 0
     while path_segments and i >= 0:
@@ -35,31 +300,52 @@ def remove_dot_segments(url):
             to_remove -= 1
         i -= 1
 
-    # Restore leading slash, if present.
     if path.startswith("/"):
         path_segments.insert(0, '')
 
-    # Restore trailing slash, if present.  (Also treat /. and /.. as trailing a slash.)
     if path.endswith("/") or path.endswith("/.") or path.endswith("/.."):
         path_segments.append('')
 
-    # Reassemble the path
-    path = "/".join(path_segments)
+    return "/".join(path_segments)
+
+def _round_trips(scheme, netloc, path, params, query, fragment):
+    """Return True if urlparse(urlunparse(components)) == components"""
+    url = "%s;%s" % (path, params) if params else path
+    if url:
+        if url[:2] == '//' and not netloc:
+            return False    # would be parsed as a netloc
+        if url[0] != '/' and (netloc or (scheme and scheme in uses_netloc)):
+            return False    # urlunparse would insert a slash
+        if not scheme and not netloc:
+            if url[0] <= ' ' or ':' in url.split('/', 1)[0]:
+                return False    # would be stripped, or would look like a scheme
+    if scheme in uses_params:
+        if ';' in path[path.rfind('/')+1:]:
+            return False    # would be parsed as params
+    elif params:
+        return False
+    return True
+
+#
+# String interface
+#
 
-    # Return the reassembled URL
-    return urllib.parse.urlunparse((scheme, netloc, path, params, query, fragment))
+def remove_dot_segments(url):
+    """Remove "." and ".." segments from an URL.
 
+    This function works with both absolute and relative URLs.
 
-def rfc3986_urljoin(base, url, allow_fragments=True):
-    """RFC 3986 compliant urljoin() function"""
-    # Join the URLs using Python's URL joiner
-    joined_url = urllib.parse.urljoin(base, url, allow_fragments)
+    This function removes double slashes (empty path segments) from the path
+    part of an URL.
+    """
+    return str(ParsedURL.parse(url).remove_dot_segments())
 
-    # Remove dot segments so we don't return stuff like http://a/../../c
-    joined_url = remove_dot_segments(joined_url)
 
-    # Return the result
-    return joined_url
+def rfc3986_urljoin(base, url, allow_fragments=True):
+    """RFC 3986 compliant urljoin() function"""
+    if not allow_fragments:
+        return remove_dot_segments(urllib.parse.urljoin(base, url, allow_fragments))
+    return str(ParsedURL.parse(base).join(url))
 
 
 def relative_url(url, base_url, allow_empty=False, allow_net=False):
@@ -72,96 +358,7 @@ def relative_url(url, base_url, allow_empty=False, allow_net=False):
     Unless `allow_net` is set, network URIs (e.g. "//www.example.com/foo") are
     never returned.
     """
-
-    # Make the target URL an absolute URL
-    url = rfc3986_urljoin(base_url, url)
-
-    # Parse the target URL
-    (t_scheme, t_netloc, t_path, t_params, t_query, t_fragment) = urllib.parse.urlparse(url)
-
-    # Parse the base URL
-    (b_scheme, b_netloc, b_path, b_params, b_query, b_fragment) = urllib.parse.urlparse(base_url)
-
-    for dummy in [0]:   # Run once
-        # scheme
-        if t_scheme != b_scheme:
-            break
-        if allow_net:
-            t_scheme = ''
-
-        # netloc
-        if t_netloc != b_netloc:
-            break
-        t_scheme = ''
-        t_netloc = ''
-
-        # Path
-        if t_path == b_path:
-            # Take just the basename of the path
-            p = t_path.split("/")
-            if allow_empty:
-                t_path = ''
-            else:
-                if not p or not p[-1]:
-                    t_path = "./"
-                else:
-                    t_path = p[-1]
-
-            # query
-            if t_query != b_query:
-                break
-            t_query = ''
-
-            # fragment
-            if t_fragment != b_fragment:
-                break
-            t_fragment = ''
-            break
-
-        # Relative path calculation algorithm:
-        # We have two paths, the target path (where we want to go) and the base
-        # path (where we are coming from).  We need to:
-        # 1. Find the deepest common parent between the two paths
-        # 2. Determine how many instances of "../" we need to get from the base
-        #    path to the common parent.
-        # 3. Determine the relative path of the target with respect to the
-        #    common parent, and append this to the "../" sequence.
-
-        # Break down the path
-        tp = t_path.split("/")   # target path
-        bp = b_path.split("/")  # base path
-
-        # Determine the tree depth of each of the paths
-        tp_depth = len(tp)-1
-        bp_depth = len(bp)-1
-
-        # 1. Find the depth of the deepest common parent (DCP) path, noting
-        # that the final path element is not a directory.
-        n = min(len(tp), len(bp))
-        dcp_depth = 0
-        for i in range(1, n):
-            if tp[i] != bp[i]:
-                break
-            dcp_depth = i
-
-        # 2. Determine the number of "../"s needed to get from the base path to
-        # the DCP path.
-        go_up = bp_depth - dcp_depth - 1
-        if go_up > 0:
-            relpath = "../" * go_up
-        else:
-            relpath = ""
-
-        # 3. Determine the relative path of the destination with respect to the
-        # DCP path, and add it.
-        relpath += "/".join(tp[dcp_depth+1:])
-
-        if not relpath:
-            relpath = "./"
-
-        t_path = relpath
-
-    return urllib.parse.urlunparse((t_scheme, t_netloc, t_path, t_params, t_query, t_fragment))
+    return str(ParsedURL.parse(url).relative_to(ParsedURL.parse(base_url), allow_empty, allow_net))
 
 def rebase_url(url, src, dest, must_rebase=False):
     """Re-base an URL.
@@ -170,23 +367,6 @@ def rebase_url(url, src, dest, must_rebase=False):
 
     This function raises ValueError if `url` cannot be rebased and `must_rebase` is true.
     """
-
-    # Convert the target URL into an absolute URL (removing dot segments, e.g. "." and "..")
-    t_url = rfc3986_urljoin(src, url)
-
-    # Convert the target URL into a relative URL
-    r_url = relative_url(t_url, src)
-
-    # Parse the relative URL
-    (r_scheme, r_netloc, r_path, r_params, r_query, r_fragment) = urllib.parse.urlparse(r_url)
-
-    # Check if the relative URL is actually relative
-    if r_scheme or r_netloc or r_path.startswith("../"):
-        # We have an absolute URL.  Therefore the URL can't be rebased.
-        if must_rebase:
-            raise ValueError("Couldn't rebase URL")
-        return t_url
-
-    return rfc3986_urljoin(dest, r_url)
+    return str(ParsedURL.parse(url).rebase(ParsedURL.parse(src), ParsedURL.parse(dest), must_rebase))
 
 # vim:set ts=4 sw=4 sts=4 expandtab:
@@ -7,6 +7,7 @@ import os
 import re
 import random
 import errno
+import tempfile
 
 from StillWeb.sw_urllib import rebase_url, rfc3986_urljoin, relative_url
 
@@ -73,6 +74,31 @@ def ensure_path(path):
             return
         raise   # Something went wrong, raise the error.
 
+def write_file_atomically(filename, data):
+    """Replace the contents of `filename` with `data` (bytes).
+
+    The data is written to a temporary file which is then renamed, so other
+    processes never see a partially-written file.
+    """
+    (fd, temp_filename) = tempfile.mkstemp(prefix=os.path.basename(filename) + ".", dir=os.path.dirname(filename))
+    try:
+        f = os.fdopen(fd, "wb")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(temp_filename, filename)
+    except:
+        os.unlink(temp_filename)
+        raise
+
+def parse_size(s):
+    """Parse a size in bytes, optionally followed by K, M or G (powers of 1024)"""
+    m = re.search(r"\A\s*(\d+)\s*([KMG]?)B?\s*\Z", s, re.I)
+    if not m:
+        raise ValueError("invalid size: %r" % (s,))
+    return int(m.group(1)) * 1024 ** " KMG".index(m.group(2).upper() or " ")
+
 class TypicalPaths:
     """Return an object containing commonly-used paths based on the given framework and target URL
 
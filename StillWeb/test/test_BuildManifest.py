@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# test_BuildManifest.py - test cases for BuildManifest.py
+# Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from StillWeb.BuildManifest import BuildManifest
+
+class Test_BuildManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.manifest_filename = os.path.join(self.tempdir, "manifest")
+        self.source = self.write("source", "hello")
+        self.template = self.write("template", "<html/>")
+        self.output = self.write("output", "<html>hello</html>")
+        self.manifest = BuildManifest(self.manifest_filename)
+        self.manifest.record(self.output, [self.source, self.template])
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, name, content):
+        filename = os.path.join(self.tempdir, name)
+        with open(filename, "wt") as f:
+            f.write(content)
+        return filename
+
+    def touch(self, filename):
+        st = os.stat(filename)
+        os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    def test_touch(self):
+        """Touching an input without changing its content keeps the output fresh"""
+        self.touch(self.source)
+        self.touch(self.output)
+        self.assertTrue(self.manifest.is_fresh(self.output, [self.source, self.template]))
+
+    def test_changed_input(self):
+        """Changing an input's content makes the output stale"""
+        self.write("source", "goodbye")
+        self.assertFalse(self.manifest.is_fresh(self.output, [self.source, self.template]))
+
+    def test_changed_output(self):
+        """A modified or missing output is stale"""
+        self.write("output", "edited by hand")
+        self.assertFalse(self.manifest.is_fresh(self.output, [self.source, self.template]))
+        os.unlink(self.output)
+        self.assertFalse(self.manifest.is_fresh(self.output, [self.source, self.template]))
+
+    def test_input_set(self):
+        """The set of inputs must match the recorded one"""
+        extra = self.write("extra", "")
+        self.assertFalse(self.manifest.is_fresh(self.output, [self.source]))
+        self.assertFalse(self.manifest.is_fresh(self.output, [self.source, self.template, extra]))
+        self.assertEqual(self.manifest.get_inputs(self.output), frozenset([self.source, self.template]))
+
+    def test_save(self):
+        """Records survive a save and reload"""
+        self.manifest.save()
+        self.touch(self.source)
+        manifest = BuildManifest(self.manifest_filename)
+        self.assertTrue(manifest.is_fresh(self.output, [self.source, self.template]))
+
+    def test_merge_changes(self):
+        """Changes exported by one manifest can be merged into another"""
+        other = BuildManifest(self.manifest_filename)
+        other.merge_changes(self.manifest.export_changes())
+        self.assertTrue(other.is_fresh(self.output, [self.source, self.template]))
+        self.assertEqual(self.manifest.export_changes(), ({}, {}))
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:set ts=4 sw=4 sts=4 expandtab:
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# test_FeedEntryStore.py - test cases for FeedEntryStore.py
+# Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from StillWeb.FeedEntryStore import FeedEntryStore
+
+def make_entry(name, published, categories=()):
+    return {
+        'id': "tag:example.com,2008:%s" % (name,),
+        'published': published,
+        'published_key': published,
+        'updated': published,
+        'title': name,
+        'atom:entry': "<entry><title>%s</title></entry>" % (name,),
+        'source_filename': "/src/%s.html" % (name,),
+        'output_filename': "/out/%s.html" % (name,),
+        'categories': "\n".join(categories),
+    }
+
+class Test_FeedEntryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, "entries.sqlite")
+        self.store = FeedEntryStore(self.filename)
+        self.store.write_entry("a", make_entry("a", "2008-01-01T00:00:00Z", ["news", "tech"]))
+        self.store.write_entry("b", make_entry("b", "2008-02-01T00:00:00Z", ["news"]))
+        self.store.write_entry("c", make_entry("c", "2008-03-01T00:00:00Z"))
+        self.store.write_entry("future", make_entry("future", "2099-01-01T00:00:00Z", ["news"]))
+        self.store.touch_page("no-entry")
+        self.now = "2008-06-01T00:00:00Z"
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tempdir)
+
+    def reopen(self):
+        self.store.close()
+        self.store = FeedEntryStore(self.filename)
+
+    def test_entries(self):
+        """Entries are stored and returned newest first, published only"""
+        self.reopen()
+        entries = self.store.get_published_entries(self.now)
+        self.assertEqual([e['title'] for e in entries], ["c", "b", "a"])
+        self.assertEqual(entries[2], make_entry("a", "2008-01-01T00:00:00Z", ["news", "tech"]))
+        self.assertEqual([e['title'] for e in self.store.get_published_entries(self.now, limit=2)], ["c", "b"])
+        self.assertEqual([e['title'] for e in self.store.get_unpublished_entries(self.now)], ["future"])
+        self.assertEqual(list(self.store.iter_entry_xml(["b", "no-entry"])), [b"<entry><title>b</title></entry>"])
+        self.assertTrue(self.store.has_page("no-entry"))
+        self.assertFalse(self.store.has_page("unknown"))
+
+    def test_categories(self):
+        """Entries can be selected by category"""
+        self.reopen()
+        self.assertEqual([e['title'] for e in self.store.get_published_entries(self.now, category="news")], ["b", "a"])
+        self.assertEqual([e['title'] for e in self.store.get_published_entries(self.now, category="new")], [])
+        self.assertEqual([(rootword, categories) for (rootword, stamp, updated, categories)
+            in self.store.get_published_entry_categories(self.now)], [("c", []), ("b", ["news"]), ("a", ["news", "tech"])])
+
+    def test_stamps(self):
+        """The max stamp only changes when an entry changes"""
+        stamp = self.store.get_max_stamp()
+        self.store.write_entry("a", make_entry("a", "2008-01-01T00:00:00Z", ["news", "tech"]))
+        self.assertEqual(self.store.get_max_stamp(), stamp)
+        self.store.write_entry("a", make_entry("a", "2008-01-01T00:00:00Z", ["news"]))
+        self.assertEqual(self.store.get_max_stamp(), stamp + 1)
+        self.store.clear_entry("a")
+        self.store.clear_entry("a")
+        self.assertEqual(self.store.get_max_stamp(), stamp + 2)
+        self.assertEqual([e['title'] for e in self.store.get_published_entries(self.now)], ["c", "b"])
+
+    def test_feeds(self):
+        """Feed records (stamp, next publication date, digest, category) round-trip"""
+        self.store.set_feed_stamp("/out/feed.atom", 4, next_publish="2099-01-01T00:00:00Z", digest="d1")
+        self.store.set_feed_stamp("/out/news.atom", 3, category="news")
+        self.reopen()
+        self.assertEqual(self.store.get_feed_stamp("/out/feed.atom"), 4)
+        self.assertEqual(self.store.get_feed_next_publish("/out/feed.atom"), "2099-01-01T00:00:00Z")
+        self.assertEqual(self.store.get_feed_digest("/out/feed.atom"), "d1")
+        self.assertEqual(self.store.get_feed_category("/out/feed.atom"), None)
+        self.assertEqual(self.store.get_feed_next_publish("/out/news.atom"), None)
+        self.assertEqual(self.store.get_category_feeds(), [("/out/news.atom", "news")])
+        self.store.remove_feed("/out/news.atom")
+        self.assertEqual(self.store.get_feed_stamp("/out/news.atom"), None)
+        self.assertEqual(self.store.get_category_feeds(), [])
+
+    def test_duplicate_ids(self):
+        self.store.write_entry("a2", dict(make_entry("a", "2008-01-02T00:00:00Z"), source_filename="/src/a2.html"))
+        self.assertEqual(self.store.find_duplicate_ids(), [("tag:example.com,2008:a", ["/src/a.html", "/src/a2.html"])])
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:set ts=4 sw=4 sts=4 expandtab:
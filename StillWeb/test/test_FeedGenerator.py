@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+# test_FeedGenerator.py - test cases for FeedGenerator.py
+# Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
+
+import io
+import os
+import shutil
+import time
+import datetime
+import tempfile
+import unittest
+import contextlib
+from xml.dom import minidom
+from xml.etree.ElementTree import canonicalize
+from xml.sax.saxutils import escape
+
+from StillWeb.Framework import Framework
+from StillWeb.FeedGenerator import ATOM_NAMESPACE, FH_NAMESPACE, FGValueError
+from StillWeb.sw_util import TypicalPaths, getChildElementsNS, getChildText
+
+TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml"><head><title>x</title></head><body><div id="PageContent"></div></body></html>
+"""
+
+FEED_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"><title>Test</title><id>tag:example.com,2008:feed</id><author><name>X</name></author></feed>
+"""
+
+PAGE = """<html><head><title>Entry %(n)d</title>
+<atom:entry xmlns:atom="http://www.w3.org/2005/Atom"><atom:id>tag:example.com,2008:e%(n)d</atom:id><atom:published>%(published)s</atom:published>%(categories)s</atom:entry>
+</head><body><p class="%(body_class)s">Entry %(n)d%(padding)s</p></body></html>
+"""
+
+class FeedTestCase(unittest.TestCase):
+
+    PLUGINS = [('StillWeb.ScriptProcessor',), ('vars', 'StillWeb.VarsPlugin'), ('StillWeb.BasicCommands',),
+               ('StillWeb.PageGenerator',), ('StillWeb.Placeholders',), ('StillWeb.MyFilters',),
+               ('StillWeb.FeedGenerator',)]
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tempdir, "src")
+        self.output_dir = os.path.join(self.tempdir, "out")
+        os.mkdir(self.source_dir)
+        self.write(os.path.join(self.tempdir, "template.html"), TEMPLATE)
+        self.write(os.path.join(self.source_dir, "feed.atom"), FEED_TEMPLATE)
+        self.entry_count = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    @staticmethod
+    def write(filename, content):
+        with open(filename, "wt") as f:
+            f.write(content)
+
+    def write_entry(self, n, size=0, categories=(), summary=True, published=None):
+        if published is None:
+            published = "2008-01-01T%02d:%02d:00Z" % divmod(n, 60)
+        self.write(os.path.join(self.source_dir, "e%d.html" % (n,)),
+            PAGE % {'n': n, 'padding': " padding" * (size // 8),
+                'body_class': summary and "feed-summary" or "body",
+                'published': published,
+                'categories': "".join('<atom:category term="%s"/>' % (escape(term, {'"': "&quot;"}),) for term in categories)})
+
+    def add_entries(self, count, size=0, categories=(), summary=True):
+        for i in range(count):
+            self.entry_count += 1
+            self.write_entry(self.entry_count, size, categories, summary)
+
+    def run_script(self, page_size, make_jobs=1, feed_command="make_atom_feed /feed.atom"):
+        """Make every page and the feed, and return the output"""
+        framework = self.load_framework()
+        try:
+            return self.process(framework, self.site_commands(page_size, make_jobs, feed_command))
+        finally:
+            framework.cleanup()
+
+    def site_commands(self, page_size, make_jobs=1, feed_command="make_atom_feed /feed.atom"):
+        """Return the commands that make every page and the feed"""
+        commands = ["set %s %s" % item for item in [
+            ('source_dir', self.source_dir),
+            ('output_dir', self.output_dir),
+            ('intermediate_data_dir', os.path.join(self.tempdir, "im")),
+            ('base_url', "http://example.com/"),
+            ('template', os.path.join(self.tempdir, "template.html")),
+            ('page_content_type', "text/html"),
+            ('make_jobs', make_jobs),
+        ]]
+        if page_size is not None:
+            commands.append("set atom_feed_page_size %d" % (page_size,))
+        commands += ["make /e%d.html" % (n,) for n in range(1, self.entry_count+1)]
+        commands.append(feed_command)
+        return commands
+
+    def load_framework(self):
+        framework = Framework()
+        for args in self.PLUGINS:
+            framework.load_plugin(*args)
+        return framework
+
+    @staticmethod
+    def process(framework, commands):
+        """Run the given script commands, and return the output"""
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            framework.plugins['StillWeb.ScriptProcessor'].process_script("test.sw", io.StringIO("\n".join(commands)))
+        return stdout.getvalue()
+
+    def read_feed(self, filename):
+        """Return (links, entry ids, is_archive) of the given feed document"""
+        document = minidom.parse(os.path.join(self.output_dir, filename))
+        try:
+            feedElement = document.documentElement
+            links = {}
+            ids = []
+            for node in feedElement.childNodes:
+                if node.nodeType != node.ELEMENT_NODE or node.namespaceURI != ATOM_NAMESPACE:
+                    continue
+                if node.localName == 'link':
+                    links[node.getAttribute('rel')] = node.getAttribute('href')
+                elif node.localName == 'entry':
+                    idElement = node.getElementsByTagNameNS(ATOM_NAMESPACE, 'id')[0]
+                    ids.append(idElement.firstChild.data.split(":")[-1])
+            archive = bool(feedElement.getElementsByTagNameNS(FH_NAMESPACE, 'archive'))
+            return (links, ids, archive)
+        finally:
+            document.unlink()
+
+class Test_PagedFeed(FeedTestCase):
+
+    def test_links(self):
+        """Full pages of the oldest entries become archives, linked newest to oldest"""
+        self.add_entries(5)
+        self.run_script(2)
+
+        (links, ids, archive) = self.read_feed("feed.atom")
+        self.assertEqual(ids, ['e5', 'e4'])
+        self.assertEqual(links['prev-archive'], "http://example.com/feed-archive-2.atom")
+        self.assertFalse(archive)
+
+        (links, ids, archive) = self.read_feed("feed-archive-2.atom")
+        self.assertEqual(ids, ['e4', 'e3'])
+        self.assertEqual(links, {
+            'self': "http://example.com/feed-archive-2.atom",
+            'current': "http://example.com/feed.atom",
+            'prev-archive': "http://example.com/feed-archive-1.atom",
+        })
+        self.assertTrue(archive)
+
+        (links, ids, archive) = self.read_feed("feed-archive-1.atom")
+        self.assertEqual(ids, ['e2', 'e1'])
+        self.assertFalse('prev-archive' in links)
+        self.assertFalse('next-archive' in links)
+        self.assertTrue(archive)
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, "feed-archive-3.atom")))
+
+    def test_immutable_archives(self):
+        """Full archives aren't rewritten when newer entries are added"""
+        self.add_entries(4)
+        self.run_script(2)
+        self.add_entries(2)
+        output = self.run_script(2)
+        self.assertFalse("feed-archive-1.atom" in output)
+        self.assertFalse("feed-archive-2.atom" in output)
+        self.assertTrue("making %s" % (os.path.join(self.output_dir, "feed-archive-3.atom"),) in output)
+        self.assertEqual(self.read_feed("feed-archive-3.atom")[1], ['e6', 'e5'])
+        self.assertEqual(self.read_feed("feed.atom")[0]['prev-archive'], "http://example.com/feed-archive-3.atom")
+
+    def test_parallel(self):
+        """Large entries made by parallel workers don't lock the entry store"""
+        self.add_entries(300, size=10000)
+        self.run_script(100, make_jobs=4)
+        (links, ids, archive) = self.read_feed("feed.atom")
+        self.assertEqual(len(ids), 100)
+        self.assertEqual(self.read_feed("feed-archive-2.atom")[1][0], 'e200')
+
+    def test_unpaged(self):
+        """Without a page size, the feed holds every entry and archives are removed"""
+        self.add_entries(3)
+        self.run_script(1)
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, "feed-archive-3.atom")))
+        self.run_script(None)
+        (links, ids, archive) = self.read_feed("feed.atom")
+        self.assertEqual(ids, ['e3', 'e2', 'e1'])
+        self.assertFalse('prev-archive' in links)
+        self.assertEqual(sorted(os.listdir(self.output_dir)), ['e1.html', 'e2.html', 'e3.html', 'feed.atom'])
+
+class Test_CategoryFeeds(FeedTestCase):
+
+    def run_script(self):
+        return FeedTestCase.run_script(self, None, feed_command="make_atom_feeds_by_category /feed.atom /tags/%s.atom")
+
+    def read_title_id(self, filename):
+        """Return the <title> and <id> of the given feed document"""
+        document = minidom.parse(os.path.join(self.output_dir, filename))
+        try:
+            (title, id) = [getChildText(tuple(getChildElementsNS(document.documentElement, ATOM_NAMESPACE, name))[0])
+                for name in ("title", "id")]
+            return (title, id)
+        finally:
+            document.unlink()
+
+    def making(self, filename, output):
+        return ("making %s " % (os.path.join(self.output_dir, filename),)) in output
+
+    def test_feeds(self):
+        """There is one feed per term, with the (quoted) term in its URL, title and id"""
+        self.add_entries(1, categories=["a", "b"])
+        self.add_entries(1, categories=["a"])
+        self.add_entries(1, categories=["x y&z"])
+        self.add_entries(1)
+        self.run_script()
+
+        self.assertEqual(self.read_feed("feed.atom")[1], ['e4', 'e3', 'e2', 'e1'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.output_dir, "tags"))), ['a.atom', 'b.atom', 'x y&z.atom'])
+        self.assertEqual(self.read_feed("tags/a.atom")[1], ['e2', 'e1'])
+        self.assertEqual(self.read_feed("tags/b.atom")[1], ['e1'])
+        (links, ids, archive) = self.read_feed("tags/x y&z.atom")
+        self.assertEqual(ids, ['e3'])
+        self.assertEqual(links['self'], "http://example.com/tags/x%20y%26z.atom")
+        self.assertFalse(archive)
+
+        self.assertEqual(self.read_title_id("feed.atom"), ("Test", "tag:example.com,2008:feed"))
+        self.assertEqual(self.read_title_id("tags/a.atom"), ("Test: a", "tag:example.com,2008:feed/category/a"))
+        self.assertEqual(self.read_title_id("tags/x y&z.atom"),
+            ("Test: x y&z", "tag:example.com,2008:feed/category/x%20y%26z"))
+
+    def test_unchanged(self):
+        """Only the category feeds whose entries have changed are rewritten"""
+        self.add_entries(2, categories=["a"])
+        self.add_entries(1, categories=["b"])
+        output = self.run_script()
+        self.assertTrue(self.making("tags/a.atom", output))
+        self.assertTrue(self.making("tags/b.atom", output))
+
+        output = self.run_script()
+        self.assertFalse(self.making("tags/a.atom", output))
+        self.assertFalse(self.making("tags/b.atom", output))
+        self.assertTrue("skipping %s" % (os.path.join(self.output_dir, "tags", "a.atom"),) in output)
+
+        self.write_entry(3, categories=["b", "c"])
+        output = self.run_script()
+        self.assertFalse(self.making("tags/a.atom", output))
+        self.assertTrue(self.making("tags/b.atom", output))
+        self.assertTrue(self.making("tags/c.atom", output))
+
+    def test_unused(self):
+        """The feeds of terms that are no longer used are deleted"""
+        self.add_entries(1, categories=["a", "b"])
+        self.add_entries(1, categories=["a"])
+        self.run_script()
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, "tags", "b.atom")))
+
+        self.write_entry(1, categories=["a"])
+        output = self.run_script()
+        self.assertTrue("removing %s" % (os.path.join(self.output_dir, "tags", "b.atom"),) in output)
+        self.assertEqual(os.listdir(os.path.join(self.output_dir, "tags")), ['a.atom'])
+        self.assertEqual(self.read_feed("tags/a.atom")[1], ['e2', 'e1'])
+
+    def test_errors(self):
+        """The URL pattern needs exactly one %s, and a term containing "/" can't be used in a file name"""
+        self.add_entries(1, categories=["a/b"])
+        with contextlib.redirect_stderr(io.StringIO()):
+            for pattern in ("/tags.atom", "/%s/%s.atom"):
+                self.assertRaises(FGValueError, FeedTestCase.run_script, self, None,
+                    feed_command="make_atom_feeds_by_category /feed.atom %s" % (pattern,))
+            self.assertRaises(FGValueError, self.run_script)
+
+class LoadedFeedTestCase(FeedTestCase):
+    """Keeps the framework loaded between scripts"""
+
+    def setUp(self):
+        FeedTestCase.setUp(self)
+        self.framework = self.load_framework()
+        self.plugin = self.framework.plugins['StillWeb.FeedGenerator']
+
+    def tearDown(self):
+        self.framework.cleanup()
+        FeedTestCase.tearDown(self)
+
+    def make(self):
+        self.process(self.framework, self.site_commands(None,
+            feed_command="make_atom_feeds_by_category /feed.atom /tags/%s.atom"))
+
+class Test_GetFeedEntries(LoadedFeedTestCase):
+
+    def titles(self, target_url, limit=None):
+        return [entry['title'] for entry in self.plugin.get_feed_entries(target_url, limit)]
+
+    def test_entries(self):
+        """Entries are returned newest first, up to the limit"""
+        self.add_entries(1)
+        self.add_entries(1, summary=False)
+        self.add_entries(1)
+        self.make()
+        entries = self.plugin.get_feed_entries("/feed.atom")
+        self.assertEqual([entry['title'] for entry in entries], ["Entry 3", "Entry 2", "Entry 1"])
+        self.assertEqual(entries[0]['id'], "tag:example.com,2008:e3")
+        self.assertEqual(entries[0]['published'], "2008-01-01T00:03:00Z")
+        self.assertEqual(entries[0]['href'], "http://example.com/e3.html")
+        self.assertEqual(getChildText(entries[0]['summary']), "Entry 3")
+        self.assertEqual(entries[1]['summary'], None)
+        self.assertEqual(self.titles("/feed.atom", 2), ["Entry 3", "Entry 2"])
+        self.assertEqual(self.titles("/feed.atom", 1), ["Entry 3"])
+        self.assertRaises(FGValueError, self.plugin.get_feed_entries, "/e1.html")
+
+    def test_category(self):
+        """Category feeds only return the entries in their category"""
+        self.add_entries(1, categories=["a", "b"])
+        self.add_entries(1, categories=["b"])
+        self.add_entries(1, categories=["a"])
+        self.make()
+        self.assertEqual(self.titles("/tags/a.atom"), ["Entry 3", "Entry 1"])
+        self.assertEqual(self.titles("/tags/b.atom"), ["Entry 2", "Entry 1"])
+        self.assertEqual(self.titles("/tags/b.atom", 1), ["Entry 2"])
+
+    def test_memo(self):
+        """Results are memoized until an entry changes"""
+        self.add_entries(2)
+        self.make()
+        entries = self.plugin.get_feed_entries("/feed.atom")
+        self.assertTrue(self.plugin.get_feed_entries("/feed.atom") is entries)
+        self.assertFalse(self.plugin.get_feed_entries("/feed.atom", 1) is entries)
+
+        # Making the feed again doesn't change anything
+        self.make()
+        self.assertTrue(self.plugin.get_feed_entries("/feed.atom") is entries)
+
+        self.add_entries(1)
+        self.make()
+        self.assertEqual(self.titles("/feed.atom"), ["Entry 3", "Entry 2", "Entry 1"])
+
+class Test_ScanFeedEntries(LoadedFeedTestCase):
+
+    def titles(self):
+        return [entry['title'] for entry in self.plugin.get_feed_entries("/feed.atom")]
+
+    def test_head_only(self):
+        """Only pages whose <head> has an <atom:entry> are loaded, and other pages' entries are cleared"""
+        self.add_entries(3)
+        self.make()
+        self.assertEqual(self.titles(), ["Entry 3", "Entry 2", "Entry 1"])
+
+        # Remove the entry from e2, and scan every page
+        self.write(os.path.join(self.source_dir, "e2.html"),
+            "<html><head><title>No entry</title></head><body><p>" + "<br>" * 1000)
+        pg_plugin = self.framework.plugins['StillWeb.PageGenerator']
+        loaded = []
+        def load_page_content(target_url):
+            loaded.append(target_url)
+            return type(pg_plugin).load_page_content(pg_plugin, target_url)
+        pg_plugin.load_page_content = load_page_content
+        try:
+            self.process(self.framework, ["scan_feed_entries /e1.html /e2.html /e3.html", "make_atom_feed /feed.atom"])
+        finally:
+            del pg_plugin.load_page_content
+        self.assertEqual(loaded, ["/e1.html", "/e3.html"])
+        self.assertEqual(self.titles(), ["Entry 3", "Entry 1"])
+        self.assertEqual(self.read_feed("feed.atom")[1], ['e3', 'e1'])
+
+class Test_EntryStamps(LoadedFeedTestCase):
+
+    def make(self):
+        return self.process(self.framework, self.site_commands(None))
+
+    def test_unchanged(self):
+        """Rebuilding a page whose entry is unchanged keeps the entry's stamp, so the feed isn't remade"""
+        self.add_entries(2)
+        self.make()
+        store = self.plugin._get_entry_store()
+        stamp = store.get_max_stamp()
+        feed_filename = os.path.join(self.output_dir, "feed.atom")
+
+        # A new template rebuilds every page, but doesn't change the entries
+        self.write(os.path.join(self.tempdir, "template.html"), TEMPLATE.replace("<title>x</title>", "<title>y</title>"))
+        output = self.make()
+        self.assertTrue("making %s " % (os.path.join(self.output_dir, "e1.html"),) in output)
+        self.assertTrue("skipping %s" % (feed_filename,) in output)
+        self.assertEqual(store.get_max_stamp(), stamp)
+
+        # Changing an entry's content gives it a new stamp
+        self.write_entry(1, size=8)
+        output = self.make()
+        self.assertTrue("making %s " % (feed_filename,) in output)
+        self.assertEqual(store.get_max_stamp(), stamp + 1)
+
+class Test_ScheduledEntries(FeedTestCase):
+
+    def test_publish(self):
+        """A feed is remade once the publication date of a scheduled entry passes"""
+        published = datetime.datetime.utcnow().replace(microsecond=0) + datetime.timedelta(seconds=2)
+        self.add_entries(1)
+        self.entry_count += 1
+        self.write_entry(self.entry_count, published=published.isoformat() + "Z")
+        feed_filename = os.path.join(self.output_dir, "feed.atom")
+
+        output = self.run_script(None)
+        self.assertTrue("making %s " % (feed_filename,) in output)
+        self.assertTrue("%s: next rebuild due at %sZ (scheduled entry)" % (feed_filename, published.isoformat()) in output)
+        self.assertEqual(self.read_feed("feed.atom")[1], ['e1'])
+
+        # Nothing changes until the publication date
+        output = self.run_script(None)
+        self.assertTrue("skipping %s" % (feed_filename,) in output)
+        self.assertTrue("next rebuild due at" in output)
+
+        # (The current time has fractional seconds, and dates are compared
+        # as strings, so wait until the second after the publication date.)
+        time.sleep(max(0, (published - datetime.datetime.utcnow()).total_seconds()) + 1.1)
+        output = self.run_script(None)
+        self.assertTrue("making %s " % (feed_filename,) in output)
+        self.assertFalse("next rebuild due at" in output)
+        self.assertEqual(self.read_feed("feed.atom")[1], ['e2', 'e1'])
+
+MATH_PAGE = """<html xmlns:m="http://www.w3.org/1998/Math/MathML"><head><title>Math</title>
+<atom:entry xmlns:atom="http://www.w3.org/2005/Atom"><atom:id>tag:example.com,2008:math</atom:id><atom:published>2008-01-02T00:00:00Z</atom:published></atom:entry>
+</head><body><p class="feed-summary">Let <m:math><m:mi>x</m:mi></m:math> be <a href="e1.html">this</a>.</p></body></html>
+"""
+
+class Test_FeedOutput(LoadedFeedTestCase):
+
+    def setUp(self):
+        LoadedFeedTestCase.setUp(self)
+        self.add_entries(3)
+        self.write(os.path.join(self.source_dir, "math.html"), MATH_PAGE)
+
+    def site_commands(self, page_size, make_jobs=1, feed_command="make_atom_feed /feed.atom"):
+        commands = LoadedFeedTestCase.site_commands(self, page_size, make_jobs, feed_command)
+        return commands[:-1] + ["make /math.html", commands[-1]]
+
+    def build_dom_feed(self, target_url):
+        """Return a feed built by adding the stored entries to the feed document as DOM nodes"""
+        plugin = self.framework.plugins['StillWeb.FeedGenerator']
+        tp = TypicalPaths(self.framework, target_url)
+        document = minidom.parse(tp.output_filename)
+        try:
+            (updatedElement,) = getChildElementsNS(document.documentElement, ATOM_NAMESPACE, 'updated')
+            most_recent_update = getChildText(updatedElement)
+        finally:
+            document.unlink()
+
+        feedDocument = plugin._create_feed_document(tp, tp.target_url, most_recent_update)
+        for entry_xml in plugin._get_entry_store().iter_published_entry_xml("9999-12-31T00:00:00Z"):
+            entryElement = minidom.parseString(entry_xml).documentElement
+            feedDocument.documentElement.appendChild(feedDocument.importNode(entryElement, True))
+        result = feedDocument.toxml()
+        feedDocument.unlink()
+        return result
+
+    def test_streamed_feed(self):
+        """The streamed feed parses, and is C14N-equivalent to a feed built with the DOM"""
+        self.make()
+        self.assertEqual(self.read_feed("feed.atom")[1], ['math', 'e3', 'e2', 'e1'])
+        with open(os.path.join(self.output_dir, "feed.atom"), "rb") as f:
+            feed_xml = f.read()
+        self.assertTrue(feed_xml.startswith(b'<?xml version="1.0" encoding="UTF-8"?>'))
+        self.assertEqual(canonicalize(feed_xml.decode('UTF-8')), canonicalize(self.build_dom_feed("/feed.atom")))
+
+    def test_prefixed_summary(self):
+        """Prefixed elements in the summary keep their namespace"""
+        self.make()
+        document = minidom.parse(os.path.join(self.output_dir, "feed.atom"))
+        try:
+            entryElement = document.getElementsByTagNameNS(ATOM_NAMESPACE, 'entry')[0]
+            (summaryElement,) = getChildElementsNS(entryElement, ATOM_NAMESPACE, 'summary')
+            (miElement,) = summaryElement.getElementsByTagNameNS("http://www.w3.org/1998/Math/MathML", 'mi')
+            self.assertEqual(getChildText(miElement), "x")
+            (aElement,) = summaryElement.getElementsByTagNameNS("http://www.w3.org/1999/xhtml", 'a')
+            self.assertEqual(aElement.getAttribute('href'), "http://example.com/e1.html")
+        finally:
+            document.unlink()
+        self.assertEqual(getChildText(self.plugin.get_feed_entries("/feed.atom")[0]['summary'].getElementsByTagNameNS(
+            "http://www.w3.org/1998/Math/MathML", 'mi')[0]), "x")
+
+    def test_write_feed(self):
+        """_write_feed writes the given entries, in order, before the closing </feed> tag"""
+        feedDocument = minidom.parseString(FEED_TEMPLATE)
+        entries_xml = [
+            '<entry xmlns="http://www.w3.org/2005/Atom"><id>tag:example.com,2008:b</id><title>\u00e9</title></entry>'.encode('UTF-8'),
+            b'<a:entry xmlns:a="http://www.w3.org/2005/Atom"><a:id>tag:example.com,2008:a</a:id></a:entry>',
+        ]
+        filename = os.path.join(self.tempdir, "test.atom")
+        self.plugin._write_feed(filename, feedDocument, iter(entries_xml))
+
+        for entry_xml in entries_xml:
+            entryElement = minidom.parseString(entry_xml).documentElement
+            feedDocument.documentElement.appendChild(feedDocument.importNode(entryElement, True))
+        with open(filename, "rb") as f:
+            self.assertEqual(canonicalize(f.read().decode('UTF-8')), canonicalize(feedDocument.toxml()))
+        feedDocument.unlink()
+        self.assertEqual(self.read_feed(filename)[1], ['b', 'a'])
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:set ts=4 sw=4 sts=4 expandtab:
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# test_LinkRewriter.py - test cases for LinkRewriter.py
+# Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
+
+import unittest
+from xml.dom import minidom
+
+from StillWeb.LinkRewriter import LinkRewriter, HTML_CRITERIA, URLResolutionCache, rewrite_links, _get_link_rewriter
+from StillWeb.FeedGenerator import ATOM_CRITERIA
+
+class LinearLinkRewriter(LinkRewriter):
+    """LinkRewriter that checks every criterion against every element (the
+    way LinkRewriter worked before the criteria were indexed)"""
+
+    def match_element(self, node):
+        for criterion in self._criteria:
+            (c_elem, c_attr) = criterion
+            if c_elem is not None:
+                (namespaceURI, localName) = c_elem
+                if namespaceURI is not None and node.namespaceURI != namespaceURI:
+                    continue
+                if node.localName != localName:
+                    continue
+            if c_attr is None:
+                yield (self.MATCHED_ELEMENT, node, criterion)
+            else:
+                (namespaceURI, localName) = c_attr
+                for i in range(node.attributes.length):
+                    a = node.attributes.item(i)
+                    if namespaceURI is not None and a.namespaceURI != namespaceURI:
+                        continue
+                    if a.localName != localName:
+                        continue
+                    yield (self.MATCHED_ATTRIBUTE, (a.namespaceURI, a.localName), criterion)
+
+DOCUMENT = """<html xmlns:x="urn:x" xmlns:a="http://www.w3.org/2005/Atom">
+<body src="b" x:href="c">
+<a href="d" src="e" usemap="f">text</a>
+<form action="g" href="h"/><x:form action="i" x:action="j"/>
+<img src="k" longdesc="l"/><q cite="m"/><blockquote cite="n" x:cite="o"/><p cite="p"/>
+<a:feed><a:link href="q"/><a:icon>r</a:icon><a:uri> s </a:uri><a:category scheme="t" term="u"/>
+<a:content src="v"/><a:generator uri="w"/><a:logo>x</a:logo><link href="y"/><icon>z</icon></a:feed>
+<x:e href="1"/><x:uri>2</x:uri>
+</body></html>"""
+
+# Criteria with element and attribute namespaces, and more than one
+# criterion for the same element
+CUSTOM_CRITERIA = [
+    (("urn:x", "form"),     ("urn:x", "action")),
+    ((None, "form"),        (None, "action")),
+    (None,                  ("urn:x", "href")),
+    (None,                  ("urn:x", "cite")),
+    (("urn:x", "uri"),      None),
+    (None,                  None),
+    ((None, "a"),           (None, "src")),
+]
+
+class Test_Index(unittest.TestCase):
+
+    def matches(self, link_rewriter, document):
+        return [list(link_rewriter.match_element(node)) for node in document.getElementsByTagName("*")]
+
+    def rewrite(self, link_rewriter):
+        document = minidom.parseString(DOCUMENT)
+        calls = []
+        def callback(url, criterion):
+            calls.append((url, criterion))
+            return "[%s]" % (url,)
+        link_rewriter.rewrite_links(document, callback)
+        return (document.toxml(), calls)
+
+    def test_same_matches(self):
+        """The indexed LinkRewriter finds the same matches, in the same order, as a linear scan"""
+        document = minidom.parseString(DOCUMENT)
+        for criteria in (HTML_CRITERIA, ATOM_CRITERIA, CUSTOM_CRITERIA, HTML_CRITERIA + ATOM_CRITERIA, []):
+            self.assertEqual(self.matches(LinkRewriter(criteria), document),
+                self.matches(LinearLinkRewriter(criteria), document))
+
+    def test_same_output(self):
+        """The indexed LinkRewriter rewrites the same links as a linear scan"""
+        for criteria in (HTML_CRITERIA, ATOM_CRITERIA, CUSTOM_CRITERIA):
+            (output, calls) = self.rewrite(LinkRewriter(criteria))
+            self.assertEqual((output, calls), self.rewrite(LinearLinkRewriter(criteria)))
+            self.assertTrue(calls)
+
+    def test_shared(self):
+        """rewrite_links compiles each set of criteria once"""
+        self.assertTrue(_get_link_rewriter(HTML_CRITERIA) is _get_link_rewriter(list(HTML_CRITERIA)))
+        self.assertFalse(_get_link_rewriter(HTML_CRITERIA) is _get_link_rewriter(ATOM_CRITERIA))
+
+class Test_URLResolutionCache(unittest.TestCase):
+
+    def rewrite(self, href, target_url, base_url, always_absolute=False, url_cache=None):
+        """Return the rewritten value of href on the page at target_url"""
+        if url_cache is None:
+            url_cache = URLResolutionCache()
+        document = minidom.parseString('<a href="%s"/>' % (href,))
+        rewrite_links(document, HTML_CRITERIA, target_url, base_url, always_absolute, url_cache)
+        return document.documentElement.getAttribute("href")
+
+    def test_key(self):
+        """The same href resolves differently for different pages, base URLs and always_absolute"""
+        cases = [
+            (("/x/y.html", "/a/b.html", "http://example.com/"), "../x/y.html"),
+            (("/x/y.html", "/a/c.html", "http://example.com/"), "../x/y.html"),
+            (("/x/y.html", "/a/c/d.html", "http://example.com/"), "../../x/y.html"),
+            (("/x/y.html", "/y.html", "http://example.com/"), "x/y.html"),
+            (("/x/y.html", "/a/b.html", "http://example.com/", True), "http://example.com/x/y.html"),
+            (("/x/y.html", "/a/b.html", "http://example.com/site/", True), "http://example.com/site/x/y.html"),
+            (("/x/y.html", "/a/b.html", "http://example.org/", True), "http://example.org/x/y.html"),
+            (("y.html", "/a/b.html", "http://example.com/", True), "http://example.com/a/y.html"),
+            (("y.html", "/a/c/d.html", "http://example.com/", True), "http://example.com/a/c/y.html"),
+        ]
+        for (args, expected) in cases:
+            self.assertEqual(self.rewrite(*args), expected)
+
+        # Sharing one cache between all the pages gives the same results,
+        # and lookups from the same directory are cache hits.
+        url_cache = URLResolutionCache()
+        for i in range(2):
+            for (args, expected) in cases:
+                self.assertEqual(self.rewrite(*args, url_cache=url_cache), expected)
+        self.assertEqual(len(url_cache), len(cases) - 1)
+        self.assertEqual(url_cache.misses, len(cases) - 1)
+        self.assertEqual(url_cache.hits, len(cases) + 1)
+
+    def test_current_page(self):
+        """Links to the current page (or below it) aren't cached"""
+        url_cache = URLResolutionCache()
+        self.assertEqual(self.rewrite("/a/b.html", "/a/b.html", "http://example.com/", url_cache=url_cache), "b.html")
+        self.assertEqual(self.rewrite("/a/b.html", "/a/c.html", "http://example.com/", url_cache=url_cache), "b.html")
+        self.assertEqual(len(url_cache), 1)
+        self.assertEqual(url_cache.hits, 0)
+
+    def test_lru(self):
+        """The least recently used entries are evicted when the cache is full"""
+        url_cache = URLResolutionCache(maxsize=2)
+        resolved = []
+        def lookup(key):
+            def resolve():
+                resolved.append(key)
+                return ("result-" + key, "/" + key)
+            return url_cache.lookup(key, "/page.html", resolve)
+
+        self.assertEqual([lookup(key) for key in ["a", "b", "a", "c"]], ["result-a", "result-b", "result-a", "result-c"])
+        self.assertEqual(resolved, ["a", "b", "c"])
+        self.assertEqual(len(url_cache), 2)
+
+        # "b" was evicted; "a" was used more recently, so it was kept
+        del resolved[:]
+        self.assertEqual(lookup("a"), "result-a")
+        self.assertEqual(resolved, [])
+        self.assertEqual(lookup("b"), "result-b")
+        self.assertEqual(resolved, ["b"])
+        self.assertEqual(len(url_cache), 2)
+
+        url_cache.clear()
+        self.assertEqual((len(url_cache), url_cache.hits, url_cache.misses), (0, 0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:set ts=4 sw=4 sts=4 expandtab:
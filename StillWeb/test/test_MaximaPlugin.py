@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# test_MaximaPlugin.py - test cases for MaximaPlugin.py
+# Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from StillWeb.Framework import Framework
+from StillWeb.MaximaPlugin import MaximaSession, MaximaError, MaximaTimeoutError
+
+# A stand-in for maxima that understands only the requests sent by
+# MaximaSession.  It pads the marker lines with whitespace (like maxima can),
+# and logs each time it is started.
+FAKE_MAXIMA = r'''#!%(python)s
+import os, re, sys, time
+open(%(log)r, "a").write("start\n")
+for line in sys.stdin:
+    m = re.search(r'eval_string\("((?:[^"\\]|\\.)*)"\).*STILLWEB-ERROR (\d+)', line)
+    if not m:
+        continue
+    (expr, n) = (m.group(1).replace('\\"', '"').replace('\\\\', '\\'), m.group(2))
+    if expr == "crash":
+        sys.exit(1)
+    elif expr == "crash-once" and not os.path.exists(%(flag)r):
+        open(%(flag)r, "w").close()
+        sys.exit(1)
+    elif expr == "hang":
+        time.sleep(60)
+    elif expr == "bad":
+        print("incorrect syntax: bad")
+        print(" STILLWEB-ERROR %%s " %% (n,))
+    else:
+        print("a warning")
+        print("STILLWEB-BEGIN %%s " %% (n,))
+        print("x^{%%s}" %% (expr,))
+        print("STILLWEB-END %%s\r" %% (n,))
+    sys.stdout.flush()
+'''
+
+class MaximaTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.log_filename = os.path.join(self.tempdir, "log")
+        self.program = os.path.join(self.tempdir, "maxima")
+        self.write_program()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write_program(self, extra=""):
+        with open(self.program, "wt") as f:
+            f.write(FAKE_MAXIMA % {'python': sys.executable, 'log': self.log_filename,
+                'flag': os.path.join(self.tempdir, "crashed")})
+            f.write(extra)
+        os.chmod(self.program, 0o755)
+
+    def starts(self):
+        if not os.path.exists(self.log_filename):
+            return 0
+        return open(self.log_filename, "rt").read().count("start")
+
+class Test_MaximaSession(MaximaTestCase):
+
+    def setUp(self):
+        MaximaTestCase.setUp(self)
+        self.session = MaximaSession(self.program, timeout=2)
+
+    def tearDown(self):
+        self.session.close()
+        MaximaTestCase.tearDown(self)
+
+    def test_framing(self):
+        """Results are read between the (padded) markers of each request"""
+        self.assertEqual(self.session.tex("2"), "x^{2}")
+        self.assertEqual(self.session.tex("y"), "x^{y}")
+        self.assertEqual(self.starts(), 1)
+
+    def test_error(self):
+        """Output printed before the error marker is used in the error message"""
+        try:
+            self.session.tex("bad")
+        except MaximaError as exc:
+            self.assertTrue("incorrect syntax: bad" in str(exc))
+        else:
+            self.fail("MaximaError not raised")
+        self.assertEqual(self.session.tex("2"), "x^{2}")
+        self.assertEqual(self.starts(), 1)
+
+    def test_timeout(self):
+        """maxima is killed when it times out, and started again afterward"""
+        self.session.timeout = 0.5
+        self.assertRaises(MaximaTimeoutError, self.session.tex, "hang")
+        self.assertEqual(self.session.tex("2"), "x^{2}")
+        self.assertEqual(self.starts(), 2)
+
+    def test_restart(self):
+        """If maxima dies, the request is tried once more with a new process"""
+        self.assertEqual(self.session.tex("crash-once"), "x^{crash-once}")
+        self.assertEqual(self.starts(), 2)
+        self.assertRaises(MaximaError, self.session.tex, "crash")
+        self.assertEqual(self.starts(), 3)
+
+class Test_ResultCache(MaximaTestCase):
+
+    def tex(self, maxima_expression):
+        """Convert an expression using a new MaximaPlugin, and return the TeX code passed to TeXPlugin"""
+        framework = Framework()
+        try:
+            for args in [('StillWeb.ScriptProcessor',), ('vars', 'StillWeb.VarsPlugin'), ('StillWeb.PageGenerator',),
+                         ('StillWeb.Placeholders',), ('StillWeb.TeXPlugin',), ('StillWeb.MaximaPlugin',)]:
+                framework.load_plugin(*args)
+            framework.plugins['vars'].vars.update({
+                'intermediate_data_dir': os.path.join(self.tempdir, "im"),
+                'maxima_program': self.program,
+                'maxima_timeout': "2",
+            })
+            framework.plugins['StillWeb.TeXPlugin'].math_placeholder = lambda tex_code, force_img=False: tex_code
+            return framework.plugins['StillWeb.MaximaPlugin'].maxima_expression_placeholder(maxima_expression)
+        finally:
+            framework.cleanup()
+
+    def test_hit(self):
+        """Cached results are used without starting maxima"""
+        self.assertEqual(self.tex("2"), "x^{2}")
+        self.assertEqual(self.starts(), 1)
+        self.assertEqual(self.tex("2"), "x^{2}")
+        self.assertEqual(self.starts(), 1)
+        self.assertEqual(self.tex("3"), "x^{3}")
+        self.assertEqual(self.starts(), 2)
+
+    def test_fingerprint(self):
+        """Changing the maxima program invalidates the cache"""
+        self.assertEqual(self.tex("2"), "x^{2}")
+        top_dir = os.path.join(self.tempdir, "im", "StillWeb.MaximaPlugin")
+        old_dirs = os.listdir(top_dir)
+        self.write_program("# upgraded\n")
+        self.assertEqual(self.tex("2"), "x^{2}")
+        self.assertEqual(self.starts(), 2)
+        self.assertEqual(len(os.listdir(top_dir)), 1)
+        self.assertNotEqual(os.listdir(top_dir), old_dirs)
+        self.assertEqual(self.tex("2"), "x^{2}")
+        self.assertEqual(self.starts(), 2)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:set ts=4 sw=4 sts=4 expandtab:
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# test_NewsPlugin.py - test cases for NewsPlugin.py
+# Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
+
+import os
+import unittest
+from xml.dom import minidom
+
+from StillWeb.NewsPlugin import NewsTemplate, NEWS_NAMESPACE, _format_date
+from StillWeb.test.test_FeedGenerator import FeedTestCase
+
+TEMPLATE = """<news:template xmlns:news="%s" xmlns="http://www.w3.org/1999/xhtml">
+<h2><news:a class="entry" title="x">[<b><news:title-here/></b>]</news:a></h2>
+<news:summary-here/>
+<p>Posted <news:published-here/> <!-- updated --> (<news:updated-here/>)</p>
+<div><news:summary-here/><news:a><news:title-here/></news:a></div>
+</news:template>""" % (NEWS_NAMESPACE,)
+
+def copy_template_to_result(src, dest, params):
+    """Render a template by walking it (the way NewsPlugin worked before
+    templates were compiled)"""
+    for node in src.childNodes:
+        if node.nodeType == node.ELEMENT_NODE and node.namespaceURI == NEWS_NAMESPACE:
+            if node.localName == 'title-here':
+                new_node = dest.ownerDocument.createTextNode(params['title'])
+            elif node.localName == 'summary-here':
+                if params['summary'] is None:
+                    continue
+                new_node = dest.ownerDocument.importNode(params['summary'], deep=True)
+            elif node.localName == 'published-here':
+                new_node = dest.ownerDocument.createTextNode(_format_date(params['published']))
+            elif node.localName == 'updated-here':
+                new_node = dest.ownerDocument.createTextNode(_format_date(params['updated']))
+            elif node.localName == 'a':
+                new_node = dest.ownerDocument.createElement('a')
+                for i in range(node.attributes.length):
+                    attrNode = node.attributes.item(i)
+                    new_node.setAttributeNode(dest.ownerDocument.importNode(attrNode, deep=True))
+                new_node.setAttribute('href', params['href'])
+            else:
+                raise ValueError("Illegal element name: %r" % (node.tagName,))
+        else:
+            new_node = dest.ownerDocument.importNode(node, deep=False)
+        dest.appendChild(new_node)
+
+        if node.nodeType == node.ELEMENT_NODE:
+            copy_template_to_result(node, new_node, params)
+
+def make_entry(n, summary):
+    if summary is not None:
+        summary = minidom.parseString('<div xmlns="http://www.w3.org/1999/xhtml">%s</div>' % (summary,)).documentElement
+    return {
+        'id': "tag:example.com,2008:e%d" % (n,),
+        'title': "Entry <%d>" % (n,),
+        'published': "2008-01-0%dT00:00:00Z" % (n,),
+        'updated': "2008-01-0%dT12:00:00+01:00" % (n,),
+        'href': "http://example.com/e%d.html" % (n,),
+        'summary': summary,
+    }
+
+class Test_NewsTemplate(unittest.TestCase):
+
+    def setUp(self):
+        self.templateElement = minidom.parseString(TEMPLATE).documentElement
+        self.template = NewsTemplate(self.templateElement)
+        self.entries = [make_entry(1, None), make_entry(2, "Some <i>text</i>"), make_entry(3, "")]
+
+    def old_render(self, document, entry):
+        divElement = document.createElement('div')
+        copy_template_to_result(self.templateElement, divElement, entry)
+        return divElement
+
+    def test_render(self):
+        """Rendering the compiled template gives the same result as walking the template"""
+        document = minidom.parseString("<div/>")
+        for entry in self.entries + self.entries:
+            self.assertEqual(self.template.render(document, entry).toxml(), self.old_render(document, entry).toxml())
+
+    def test_slots(self):
+        """Nested slots are filled, and a missing summary's marker is removed"""
+        document = minidom.parseString("<div/>")
+        divElement = self.template.render(document, self.entries[0])
+        self.assertEqual(divElement.ownerDocument, document)
+        self.assertFalse("-here" in divElement.toxml())
+        (a1, a2) = divElement.getElementsByTagName('a')
+        self.assertEqual((a1.getAttribute('href'), a1.getAttribute('class')), ("http://example.com/e1.html", "entry"))
+        self.assertEqual(a1.toxml(), '<a class="entry" title="x" href="http://example.com/e1.html">[<b>Entry &lt;1&gt;</b>]</a>')
+        self.assertEqual(a2.toxml(), '<a href="http://example.com/e1.html">Entry &lt;1&gt;</a>')
+        self.assertEqual(a2.parentNode.childNodes[0], a2)
+
+    def test_illegal(self):
+        templateElement = minidom.parseString('<news:template xmlns:news="%s"><p><news:foo/></p></news:template>' % (NEWS_NAMESPACE,))
+        self.assertRaises(ValueError, NewsTemplate, templateElement.documentElement)
+
+NEWS_PAGE = """<html xmlns:news="%s"><head><title>News</title></head><body>
+<news:news limit="2"><news:template><h2><news:a><news:title-here/></news:a></h2></news:template></news:news>
+</body></html>
+""" % (NEWS_NAMESPACE,)
+
+class Test_NewsDependencies(FeedTestCase):
+
+    PLUGINS = FeedTestCase.PLUGINS + [('StillWeb.NewsPlugin',)]
+
+    def setUp(self):
+        FeedTestCase.setUp(self)
+        self.write(os.path.join(self.source_dir, "news.html"), NEWS_PAGE)
+        self.write(os.path.join(self.source_dir, "plain.html"), "<html><head><title>Plain</title></head><body><p>x</p></body></html>")
+
+    def run_site(self):
+        return self.run_script(None,
+            feed_command="make_atom_feed /feed.atom\nset_news_feed /feed.atom\nmake /news.html\nmake /plain.html")
+
+    def made(self, output):
+        return sorted(basename for basename in ("news.html", "plain.html")
+            if "making %s " % (os.path.join(self.output_dir, basename),) in output)
+
+    def test_rebuild(self):
+        """Only pages with a news placeholder are rebuilt when the feed changes"""
+        self.add_entries(2)
+        self.assertEqual(self.made(self.run_site()), ["news.html", "plain.html"])
+        self.assertEqual(self.made(self.run_site()), [])
+
+        self.add_entries(1)
+        self.assertEqual(self.made(self.run_site()), ["news.html"])
+        with open(os.path.join(self.output_dir, "news.html"), "rt") as f:
+            news = f.read()
+        self.assertTrue("Entry 3" in news and "Entry 2" in news and "Entry 1" not in news)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:set ts=4 sw=4 sts=4 expandtab:
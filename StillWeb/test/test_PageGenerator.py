@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# test_PageGenerator.py - test cases for PageGenerator.py
+# Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import contextlib
+import types
+from xml.dom import minidom
+
+from StillWeb.Framework import Framework
+from StillWeb.PageGenerator import PageGenerator, TemplateCache
+
+TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml"><head><title>test</title></head><body></body></html>
+"""
+
+FANCY_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
+<?stylesheet x?>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:x="urn:x" xml:lang="en"><head><title>T&amp;T \u00e9</title></head>
+<!-- comment --><body class="b" x:attr="1"><div id="PageContent"><x:e/><![CDATA[<cdata>]]></div></body></html>
+"""
+
+class Test_TemplateCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, "template.html")
+        self.write(FANCY_TEMPLATE)
+        self.cache = TemplateCache()
+
+    def tearDown(self):
+        self.cache.clear()
+        shutil.rmtree(self.tempdir)
+
+    def write(self, content):
+        with open(self.filename, "wt", encoding="UTF-8") as f:
+            f.write(content)
+
+    def assertSameDocument(self, document, expected):
+        self.assertEqual(document.toxml("UTF-8"), expected.toxml("UTF-8"))
+        self.assertEqual(document.doctype.toxml("UTF-8"), expected.doctype.toxml("UTF-8"))
+        self.assertEqual((document.doctype.publicId, document.doctype.systemId),
+            (expected.doctype.publicId, expected.doctype.systemId))
+        self.assertEqual(len(document.getElementsByTagName("*")), len(expected.getElementsByTagName("*")))
+        for (e1, e2) in zip(document.getElementsByTagName("*"), expected.getElementsByTagName("*")):
+            self.assertEqual((e1.namespaceURI, e1.localName, e1.prefix), (e2.namespaceURI, e2.localName, e2.prefix))
+            self.assertEqual(sorted((a.name, a.namespaceURI, a.value) for a in e1.attributes.values()),
+                sorted((a.name, a.namespaceURI, a.value) for a in e2.attributes.values()))
+
+    def test_clone(self):
+        """Each copy of the template is the same as a fresh parse, and independent of the others"""
+        first = self.cache.load(self.filename)
+        self.assertSameDocument(first, minidom.parse(self.filename))
+
+        # Changing one copy doesn't change the next one
+        first.documentElement.appendChild(first.createElement("extra"))
+        first.getElementsByTagName("body")[0].setAttribute("class", "changed")
+        second = self.cache.load(self.filename)
+        self.assertFalse(second is first)
+        self.assertSameDocument(second, minidom.parse(self.filename))
+
+    def test_changed(self):
+        """The template is parsed again when the file changes"""
+        self.cache.load(self.filename)
+        self.write(FANCY_TEMPLATE.replace("T&amp;T", "Changed"))
+        self.assertSameDocument(self.cache.load(self.filename), minidom.parse(self.filename))
+        self.assertTrue(b"Changed" in self.cache.load(self.filename).toxml("UTF-8"))
+
+class Test_XhtmlFastPath(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def load_content(self, source, xhtml_fast_path):
+        filename = os.path.join(self.tempdir, "page.html")
+        with open(filename, "wt", encoding="UTF-8") as f:
+            f.write(source)
+        pg = PageGenerator(types.SimpleNamespace(source_filename=filename), None, None, xhtml_fast_path=xhtml_fast_path)
+        try:
+            pg.load_content()
+            return pg.content.toxml()
+        finally:
+            pg.cleanup()
+
+    def test_same_content(self):
+        """The loaded content is the same with or without the XHTML fast path"""
+        for source in [
+            TEMPLATE,
+            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:m="http://www.w3.org/1998/Math/MathML">\n'
+                '<head><title>x</title></head><body><p class="a">x &amp; <m:mi>y</m:mi><!-- c --></p></body></html>',
+            # Not XHTML: these fall back to TagSoupToXml
+            '<html><head><title>x</title></head><body><p>a&nbsp;b<p>c<br></body></html>',
+            '<p>fragment',
+        ]:
+            self.assertEqual(self.load_content(source, True), self.load_content(source, False))
+
+class Test_ParallelMake(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.template_filename = os.path.join(self.tempdir, "template.html")
+        with open(self.template_filename, "wt") as f:
+            f.write(TEMPLATE)
+        os.mkdir(os.path.join(self.tempdir, "src"))
+        for name in ("a", "b", "c"):
+            with open(os.path.join(self.tempdir, "src", "%s.html" % (name,)), "wt") as f:
+                f.write("<p>%s</p>" % (name,))
+
+        self.framework = Framework()
+        for args in [('StillWeb.ScriptProcessor',), ('vars', 'StillWeb.VarsPlugin'),
+                     ('StillWeb.BasicCommands',), ('StillWeb.PageGenerator',)]:
+            self.framework.load_plugin(*args)
+        pg_plugin = self.framework.plugins['StillWeb.PageGenerator']
+        pg_plugin.register_filter('write_output:after', self._page_made)
+        pg_plugin.register_parallel_state(self._export_made, self._merge_made)
+        self.script_processor = self.framework.plugins['StillWeb.ScriptProcessor']
+        self.script_processor.register_command('check', self.handle_check)
+
+        # Pages made in this process, and pages reported by the workers
+        self.made_here = []
+        self.merged = []
+        self.checks = []
+
+    def tearDown(self):
+        self.framework.cleanup()
+        shutil.rmtree(self.tempdir)
+
+    def _page_made(self, page_generator):
+        self.made_here.append(os.path.basename(page_generator.path_info.output_filename))
+
+    def _export_made(self):
+        (made, self.made_here) = (self.made_here, [])
+        return made
+
+    def _merge_made(self, made):
+        self.merged += made
+
+    def handle_check(self):
+        self.checks.append(sorted(self.merged))
+
+    def run_script(self, commands):
+        script = "".join("set %s %s\n" % item for item in [
+            ('source_dir', os.path.join(self.tempdir, "src")),
+            ('output_dir', os.path.join(self.tempdir, "out")),
+            ('intermediate_data_dir', os.path.join(self.tempdir, "im")),
+            ('base_url', "http://example.com/"),
+            ('template', self.template_filename),
+            ('make_jobs', "2"),
+        ]) + commands
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.script_processor.process_script("test.sw", io.StringIO(script))
+
+    def test_barrier(self):
+        """Queued pages are made, and their state merged, before the next barrier"""
+        self.run_script("make /a.html\nmake /b.html\ncheck\nmake /c.html\n")
+        self.assertEqual(self.checks, [['a.html', 'b.html']])
+        self.assertEqual(sorted(self.merged), ['a.html', 'b.html', 'c.html'])
+        self.assertEqual(self.made_here, [])     # (the pages were made by the workers)
+        for name in ("a", "b", "c"):
+            self.assertTrue(os.path.exists(os.path.join(self.tempdir, "out", "%s.html" % (name,))))
+
+        # The workers' manifest changes were merged too, so nothing is rebuilt.
+        self.merged = []
+        self.run_script("make /a.html\nmake /b.html\nmake /c.html\n")
+        self.assertEqual(self.merged, [])
+
+    def test_error_location(self):
+        """Errors in queued pages are reported against the 'make' command"""
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            self.assertRaises(EnvironmentError, self.run_script, "make /a.html\nmake /missing.html\n")
+        self.assertTrue("Error in test.sw, line 8 (make /missing.html):" in stderr.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:set ts=4 sw=4 sts=4 expandtab:
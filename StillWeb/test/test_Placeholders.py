@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# test_Placeholders.py - test cases for Placeholders.py
+# Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
+
+import unittest
+from xml.dom import minidom
+
+from StillWeb.Framework import Framework
+from StillWeb.Placeholders import PLACEHOLDERS_NAMESPACE, ReplaceWithHTML
+
+PAGE_TEMPLATE = """<html xmlns:p="%s"><body><div>%%s</div></body></html>""" % (PLACEHOLDERS_NAMESPACE,)
+
+class FakePage:
+    """Stands in for a PageGenerator: only the content is used"""
+    def __init__(self, body):
+        self.content = minidom.parseString(PAGE_TEMPLATE % (body,))
+
+class Test_Memoize(unittest.TestCase):
+
+    def setUp(self):
+        self.framework = Framework()
+        for args in [('StillWeb.ScriptProcessor',), ('vars', 'StillWeb.VarsPlugin'),
+                     ('StillWeb.PageGenerator',), ('StillWeb.Placeholders',)]:
+            self.framework.load_plugin(*args)
+        self.plugin = self.framework.plugins['StillWeb.Placeholders']
+        self.calls = []
+        self.dependency = "v1"
+        self.plugin.register_callback(self.callback, PLACEHOLDERS_NAMESPACE, 'test',
+            memoize=lambda page_generator, element: self.dependency)
+
+    def tearDown(self):
+        self.framework.cleanup()
+
+    def callback(self, page_generator, element):
+        text = element.firstChild.data
+        self.calls.append(text)
+        raise ReplaceWithHTML("<b>%s</b> <i>%s</i>" % (text, self.dependency))
+
+    def process(self, body):
+        page = FakePage(body)
+        self.plugin._process_placeholders(page)
+        div = page.content.getElementsByTagName('div')[0]
+        return "".join(node.toxml() for node in div.childNodes)
+
+    def test_hit(self):
+        """A memo hit returns the same fragment without calling the callback"""
+        first = self.process("<p:test>x</p:test>")
+        second = self.process("<p:test>x</p:test><p:test>x</p:test>")
+        self.assertEqual(first, "<b>x</b> <i>v1</i>")
+        self.assertEqual(second, first * 2)
+        self.assertEqual(self.calls, ["x"])
+
+    def test_dependencies(self):
+        """A result is reused only if the placeholder and its dependencies match"""
+        self.process("<p:test>x</p:test>")
+        self.process("<p:test>y</p:test>")
+        self.dependency = "v2"
+        self.assertEqual(self.process("<p:test>x</p:test>"), "<b>x</b> <i>v2</i>")
+        self.assertEqual(self.calls, ["x", "y", "x"])
+
+    def test_lru(self):
+        """The least recently used result is forgotten when the memo is full"""
+        self.plugin.MEMO_SIZE = 2
+        self.process("<p:test>a</p:test><p:test>b</p:test>")
+        self.process("<p:test>a</p:test>")      # 'b' is now the least recently used
+        self.process("<p:test>c</p:test>")      # evicts 'b'
+        self.process("<p:test>a</p:test><p:test>b</p:test>")
+        self.assertEqual(self.calls, ["a", "b", "c", "b"])
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:set ts=4 sw=4 sts=4 expandtab:
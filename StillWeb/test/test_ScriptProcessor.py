@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# test_ScriptProcessor.py - test cases for ScriptProcessor.py
+# Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from StillWeb.Framework import Framework
+
+class Test_Barriers(unittest.TestCase):
+
+    def setUp(self):
+        self.framework = Framework()
+        self.framework.load_plugin('StillWeb.ScriptProcessor')
+        self.script_processor = self.framework.plugins['StillWeb.ScriptProcessor']
+        self.log = []
+        self.script_processor.register_command('defer', self.handle_defer, deferrable=True)
+        self.script_processor.register_command('run', self.handle_run)
+        self.script_processor.register_barrier(self.barrier)
+
+    def tearDown(self):
+        self.framework.cleanup()
+
+    def handle_defer(self, name):
+        self.log.append(('defer', name, self.script_processor.get_location()))
+
+    def handle_run(self, name):
+        self.log.append(('run', name))
+
+    def barrier(self):
+        self.log.append('sync')
+
+    def run_script(self, text, filename="test.sw"):
+        self.script_processor.process_script(filename, io.StringIO(text))
+
+    def test_order(self):
+        """Barriers run before each command that isn't deferrable, and at the end"""
+        self.run_script("defer a\ndefer b\nrun c\n\ndefer d\n")
+        self.assertEqual(self.log, [
+            ('defer', 'a', ("test.sw", 1)),
+            ('defer', 'b', ("test.sw", 2)),
+            'sync',
+            ('run', 'c'),
+            ('defer', 'd', ("test.sw", 5)),
+            'sync',
+        ])
+        self.assertEqual(self.script_processor.get_location(), None)
+
+    def test_execute(self):
+        """Only the top-level script syncs at the end"""
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, "inner.sw")
+            with open(filename, "wt") as f:
+                f.write("# comment\ndefer b\n")
+            self.run_script("defer a\nexecute %s\ndefer c\n" % (filename,))
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(self.log, [
+            ('defer', 'a', ("test.sw", 1)),
+            'sync',
+            ('defer', 'b', (filename, 2)),
+            ('defer', 'c', ("test.sw", 3)),
+            'sync',
+        ])
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:set ts=4 sw=4 sts=4 expandtab:
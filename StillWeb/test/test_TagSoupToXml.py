@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# test_TagSoupToXml.py - test cases for TagSoupToXml.py
+# Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
+
+import unittest
+import xml.parsers.expat
+
+from StillWeb.TagSoupToXml import TagSoupToXml, parse_xhtml
+
+def parse(source, build_tree):
+    p = TagSoupToXml(build_tree=build_tree)
+    p.feed(source)
+    p.close()
+    return p.todocument()
+
+class Test_TreeBuilder(unittest.TestCase):
+
+    def assertSameDocument(self, source):
+        self.assertEqual(parse(source, True).toxml(), parse(source, False).toxml())
+
+    def assertSameError(self, source):
+        errors = []
+        for build_tree in (False, True):
+            try:
+                parse(source, build_tree)
+            except xml.parsers.expat.ExpatError as exc:
+                errors.append(exc.code)
+            else:
+                self.fail("ExpatError not raised for %r (build_tree=%r)" % (source, build_tree))
+        self.assertEqual(errors[0], errors[1])
+
+    def test_documents(self):
+        """The tree builder builds the same DOM as parsing the XML output"""
+        self.assertSameDocument("<p>a<p>b &amp; &#169;<br><!-- c--d -->")
+        self.assertSameDocument("<ul><li>a<li>b</ul><table><tr><td>x<td>y</table>")
+        self.assertSameDocument("<div a='x\ny' b=\"1\r\n2\tz\">a\r\nb\rc</div>")
+        self.assertSameDocument("<html xmlns:f='urn:f'><f:x f:y='1' z='2'>t</f:x></html>")
+        self.assertSameDocument("<p xml:lang='en' lang='en' xmlns=''>x</p>")
+
+    def test_late_declarations(self):
+        """Prefixes declared on <html> apply to content that came before it"""
+        self.assertSameDocument("<x:p x:a='1' y:a='2'><html xmlns:x='urn:x' xmlns:y='urn:y'>")
+        self.assertSameError("<p x:a='1' y:a='2'><html xmlns:x='urn:x' xmlns:y='urn:x'>")
+
+    def test_errors(self):
+        """The tree builder raises the same errors as an XML parser"""
+        self.assertSameError("<p xmlns:x=''>a</p>")
+        self.assertSameError("<html xmlns:x=''><p>a</p>")
+        self.assertSameError("<p a='1' a='2'>a</p>")
+        self.assertSameError("<html a='1' a='2'><p>a</p>")
+        self.assertSameError("<p xmlns:x='urn:x' xmlns:y='urn:x' x:a='1' y:a='2'>a</p>")
+        self.assertSameError("<p xmlns:xml='urn:x'>")
+        self.assertSameError("<p xmlns:xmlns='urn:x'>")
+        self.assertSameError("<p xmlns:x='http://www.w3.org/2000/xmlns/'>")
+        self.assertSameError("<x:p>a</x:p>")
+        self.assertSameError("<p a:b:c='1'>")
+
+XHTML_DOCUMENT = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
+<!-- before -->
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:m="http://www.w3.org/1998/Math/MathML" xml:lang="en" lang="en">
+<head><title>A &amp; B &#169;</title></head>
+<body><p id="x" class="y">a<!-- hidden -->b<br/></p>
+<ul><li>1</li><li>2</li></ul><p><m:math><m:mi>x</m:mi></m:math></p></body>
+</html>
+"""
+
+class Test_ParseXhtml(unittest.TestCase):
+
+    def assertSameAsTagSoup(self, source):
+        p = TagSoupToXml(omit_comments=True, build_tree=True)
+        p.feed(source)
+        p.close()
+        document = parse_xhtml(source)
+        self.assertNotEqual(document, None)
+        self.assertEqual(document.toxml(), p.todocument().toxml())
+
+    def test_documents(self):
+        """Well-formed XHTML is parsed into the same DOM that TagSoupToXml builds"""
+        self.assertSameAsTagSoup(XHTML_DOCUMENT)
+        self.assertSameAsTagSoup("<html><head><title>x</title></head><body><table><tr><td>1</td></tr></table></body></html>")
+        self.assertSameAsTagSoup("<html>\n<head></head>\n<body><p b='2' a='1' xmlns:x='urn:x'>x</p></body>\n</html>\n")
+
+    def test_fallback(self):
+        """Sources that expat can't parse (or that TagSoupToXml would treat differently) aren't parsed"""
+        for body in ("<p>a&nbsp;b</p>", "<p>a<p>b", "<br>", "<p><![CDATA[<x>]]></p>", "<p CLASS='x'>x</p>"):
+            self.assertEqual(parse_xhtml("<html><head><title>x</title></head><body>%s</body></html>" % (body,)), None)
+        self.assertEqual(parse_xhtml("<html><body><p>x</p></body></html>"), None)
+        self.assertEqual(parse_xhtml("<html><head></head><body></body></html> trailing"), None)
+        self.assertEqual(parse_xhtml("<p>fragment</p>"), None)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:set ts=4 sw=4 sts=4 expandtab:
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# test_TeXPlugin.py - test cases for TeXPlugin.py
+# Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+from StillWeb.Framework import Framework
+
+# Stand-ins for texvc_tex (which canonicalizes the code by removing spaces)
+# and texvc (which writes an image, and logs each formula it renders)
+FAKE_TEXVC_TEX = r'''#!%(python)s
+import sys
+sys.stdout.write(sys.argv[1].replace(" ", ""))
+'''
+
+FAKE_TEXVC = r'''#!%(python)s
+import hashlib, sys
+(tmp, out, code) = sys.argv[1:4]
+md5 = hashlib.md5(code.replace(" ", "").encode("UTF-8")).hexdigest()
+open(out + "/" + md5 + ".png", "w").write("png")
+open(%(log)r, "a").write(code + "\n")
+sys.stdout.write("+" + md5)
+'''
+
+PAGE = """<html xmlns:p="tag:dlitz.net,2008:StillWeb.Placeholders"><head><title>x</title></head>
+<body><p>%s</p></body></html>
+"""
+
+class Test_Prefetch(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tempdir, "src")
+        self.program_dir = os.path.join(self.tempdir, "bin")
+        self.log_filename = os.path.join(self.tempdir, "log")
+        for dirname in (self.source_dir, self.program_dir):
+            os.mkdir(dirname)
+        for (name, program) in [("texvc", FAKE_TEXVC), ("texvc_tex", FAKE_TEXVC_TEX)]:
+            filename = os.path.join(self.program_dir, name)
+            with open(filename, "wt") as f:
+                f.write(program % {'python': sys.executable, 'log': self.log_filename})
+            os.chmod(filename, 0o755)
+        self.write("template.html", '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" '
+            '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">\n<html><head><title>t</title></head><body></body></html>')
+        self.write("src/p1.html", PAGE % ("<p:math>x^1</p:math> <p:m>a + b</p:m>",))
+        self.write("src/p2.html", PAGE % ("<p:m>a+b</p:m> <p:m>x^1</p:m> <p:m>y_2</p:m>",))
+        self.write("src/plain.html", PAGE % ("no formulas",))
+
+        self.framework = Framework()
+        for args in [('StillWeb.ScriptProcessor',), ('vars', 'StillWeb.VarsPlugin'), ('StillWeb.BasicCommands',),
+                     ('StillWeb.PageGenerator',), ('StillWeb.Placeholders',), ('StillWeb.TeXPlugin',)]:
+            self.framework.load_plugin(*args)
+        self.framework.plugins['vars'].vars.update({
+            'source_dir': self.source_dir,
+            'output_dir': os.path.join(self.tempdir, "out"),
+            'intermediate_data_dir': os.path.join(self.tempdir, "im"),
+            'base_url': "http://example.com/",
+            'template': os.path.join(self.tempdir, "template.html"),
+            'texvc_program_dir': self.program_dir,
+            'texvc_outdir_url': "/tex/",
+            'make_jobs': "2",
+        })
+        self.plugin = self.framework.plugins['StillWeb.TeXPlugin']
+
+    def tearDown(self):
+        self.framework.cleanup()
+        shutil.rmtree(self.tempdir)
+
+    def write(self, filename, content):
+        with open(os.path.join(self.tempdir, filename), "wt") as f:
+            f.write(content)
+
+    def run_script(self, script):
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            self.framework.plugins['StillWeb.ScriptProcessor'].process_script("test.sw", io.StringIO(script))
+        return stdout.getvalue()
+
+    def rendered(self):
+        """Return the formulas that texvc has rendered"""
+        if not os.path.exists(self.log_filename):
+            return []
+        return sorted(open(self.log_filename, "rt").read().splitlines())
+
+    def test_prefetch(self):
+        """Each distinct formula is rendered once, and pages made afterward only hit the cache"""
+        output = self.run_script("prefetch_tex\n")
+        self.assertTrue("prefetching TeX: 4 formulas, 3 to generate" in output)
+        self.assertEqual(len(self.rendered()), 3)
+        self.assertTrue(set(self.rendered()) in ({"x^1", "a + b", "y_2"}, {"x^1", "a+b", "y_2"}))
+
+        cache = self.plugin._get_cache()
+        for latex_code in ("x^1", "a + b", "a+b", "y_2"):
+            canonical_md5 = cache.get_canonical_md5(self.plugin._get_orig_md5(latex_code))
+            self.assertNotEqual(canonical_md5, None)
+            self.assertTrue(self.plugin._have_result(canonical_md5))
+
+        rendered = self.rendered()
+        # (The pages are made in this process, so that the output is captured.)
+        output = self.run_script("prefetch_tex /p2.html\nset make_jobs 1\nmake /p1.html\nmake /p2.html\n")
+        self.assertTrue("prefetching TeX: 3 formulas, 0 to generate" in output)
+        self.assertEqual(self.rendered(), rendered)
+        self.assertEqual(output.count("skipping TeX"), 5)
+
+class Test_TexGC(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.tempdir, "out")
+        self.tex_dir = os.path.join(self.output_dir, "tex")
+        os.makedirs(self.tex_dir)
+
+        self.framework = Framework()
+        for args in [('StillWeb.ScriptProcessor',), ('vars', 'StillWeb.VarsPlugin'),
+                     ('StillWeb.PageGenerator',), ('StillWeb.Placeholders',), ('StillWeb.TeXPlugin',)]:
+            self.framework.load_plugin(*args)
+        self.framework.plugins['vars'].vars.update({
+            'base_url': "http://example.com/",
+            'output_dir': self.output_dir,
+            'intermediate_data_dir': os.path.join(self.tempdir, "im"),
+            'texvc_outdir_url': "/tex/",
+        })
+        self.plugin = self.framework.plugins['StillWeb.TeXPlugin']
+        self.cache = self.plugin._get_cache()
+
+        # Four formulas with 100-byte images, used least recently to most
+        # recently in the order c, b, a, d
+        self.md5s = {}
+        for (name, last_used) in [('a', 3), ('b', 2), ('c', 1), ('d', 4)]:
+            md5 = self.md5s[name] = name * 32
+            self.cache.set_result(md5, {'md5': md5, 'code': name, 'html': None, 'html_strictness': None, 'mathml': None})
+            self.cache.touch([md5], last_used)
+            with open(os.path.join(self.tex_dir, "%s.png" % (md5,)), "wb") as f:
+                f.write(b"x" * 100)
+
+        # A page that exists (but wasn't made in this run) uses 'a'; a page
+        # that has been deleted used 'b'.
+        self.page = os.path.join(self.output_dir, "page.html")
+        open(self.page, "wb").close()
+        self.cache.set_page_formulas(self.page, [self.md5s['a']])
+        self.cache.set_page_formulas(os.path.join(self.output_dir, "deleted.html"), [self.md5s['b']])
+
+    def tearDown(self):
+        self.framework.cleanup()
+        shutil.rmtree(self.tempdir)
+
+    def tex_gc(self, *args):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.plugin.handle_tex_gc(*args)
+
+    def remaining(self):
+        return sorted(name for (name, md5) in self.md5s.items()
+            if os.path.exists(os.path.join(self.tex_dir, "%s.png" % (md5,))))
+
+    def test_remove_unused(self):
+        """Without a size, every formula not on an existing page is removed"""
+        self.tex_gc()
+        self.assertEqual(self.remaining(), ['a'])
+        self.assertEqual(self.cache.get_results(), [self.md5s['a']])
+        self.assertEqual(self.cache.get_pages(), [self.page])
+
+    def test_max_size(self):
+        """With a size, the least recently used unused formulas are removed"""
+        self.tex_gc("1K")
+        self.assertEqual(self.remaining(), ['a', 'b', 'c', 'd'])
+        self.tex_gc("250")
+        self.assertEqual(self.remaining(), ['a', 'd'])
+        self.assertEqual(sorted(self.cache.get_results()), [self.md5s['a'], self.md5s['d']])
+
+    def test_no_pages(self):
+        """Nothing is removed if no pages have been recorded"""
+        self.cache.remove([], self.cache.get_pages())
+        self.tex_gc()
+        self.assertEqual(self.remaining(), ['a', 'b', 'c', 'd'])
+        self.assertEqual(len(self.cache.get_results()), 4)
+
+    def test_scan(self):
+        """Scanning a page (without building it) doesn't start recording its formulas"""
+        source_dir = os.path.join(self.tempdir, "src")
+        os.mkdir(source_dir)
+        with open(os.path.join(source_dir, "scanned.html"), "wt") as f:
+            f.write("<html><head><title>x</title></head><body><p>x</p></body></html>")
+        self.framework.plugins['vars'].vars.update({'source_dir': source_dir, 'template': self.page})
+        self.framework.plugins['StillWeb.PageGenerator'].load_page_content("/scanned.html")
+        self.assertEqual(self.plugin._page_formulas, None)
+        self.tex_gc()
+        self.assertEqual(self.remaining(), ['a'])
+
+    def test_invalid_size(self):
+        self.assertRaises(ValueError, self.tex_gc, "lots")
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:set ts=4 sw=4 sts=4 expandtab:
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# test_TexCache.py - test cases for TexCache.py
+# Copyright (C) 2008  Darsey Litzenberger <dlitz@dlitz.net>
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from StillWeb.TexCache import TexCache
+
+def make_result(canonical_md5, code):
+    return {'md5': canonical_md5, 'code': code, 'html': "<i>%s</i>" % (code,), 'html_strictness': 1, 'mathml': None}
+
+class Test_TexCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, "texvc-cache.sqlite")
+        self.cache = TexCache(self.filename)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tempdir)
+
+    def reopen(self):
+        self.cache.close()
+        self.cache = TexCache(self.filename)
+
+    def fill(self, cache):
+        cache.set_canonical_md5("o1", "c1")
+        cache.set_canonical_md5("o2", "c1")
+        cache.set_result("c1", make_result("c1", "x"))
+        cache.touch(["c1"], 100)
+        cache.set_page_formulas("/out/page.html", ["c1"])
+
+    def check(self, cache):
+        self.assertEqual(cache.get_canonical_md5s(["o1", "o2", "o3"]), {"o1": "c1", "o2": "c1"})
+        self.assertEqual(cache.get_result("c1"), make_result("c1", "x"))
+        self.assertEqual(cache.get_last_used("c1"), 100)
+        self.assertEqual(cache.get_pages(), ["/out/page.html"])
+        self.assertEqual(cache.get_page_formulas("/out/page.html"), frozenset(["c1"]))
+
+    def test_commit(self):
+        """Changes are written by commit, and read back by a new instance"""
+        self.fill(self.cache)
+        self.cache.commit()
+        self.assertEqual(TexCache(self.filename).get_result("c1"), make_result("c1", "x"))
+        self.reopen()
+        self.check(self.cache)
+
+    def test_uncommitted(self):
+        """Nothing is written until commit() is called"""
+        self.fill(self.cache)
+        self.assertEqual(TexCache(self.filename).get_result("c1"), None)
+
+    def test_export_merge(self):
+        """Changes exported by one instance (e.g. a worker) can be merged into another"""
+        other = TexCache(self.filename)
+        self.fill(other)
+        changes = other.export_changes()
+        self.assertEqual(other.export_changes(), ([], [], {}, {}))
+        other.close()
+        self.assertEqual(TexCache(self.filename).get_result("c1"), None)
+
+        self.cache.merge_changes(changes)
+        self.check(self.cache)
+        self.reopen()
+        self.check(self.cache)
+
+    def test_touch(self):
+        """Last-used times only move forward"""
+        self.fill(self.cache)
+        self.cache.touch(["c1"], 50)
+        self.assertEqual(self.cache.get_last_used("c1"), 100)
+        self.cache.touch(["c1"], 200)
+        self.reopen()
+        self.assertEqual(self.cache.get_last_used("c1"), 200)
+
+    def test_remove(self):
+        """Removing a result removes its originals; removing a page removes its record"""
+        self.fill(self.cache)
+        self.cache.set_result("c2", make_result("c2", "y"))
+        self.cache.remove(["c1"], ["/out/page.html"])
+        self.reopen()
+        self.assertEqual(self.cache.get_results(), ["c2"])
+        self.assertEqual(self.cache.get_canonical_md5("o1"), None)
+        self.assertEqual(self.cache.get_pages(), [])
+
+    def test_version(self):
+        """A cache written by a different version is discarded"""
+        self.fill(self.cache)
+        self.cache.close()
+        conn = sqlite3.connect(self.filename)
+        conn.execute("PRAGMA user_version = %d" % (TexCache.VERSION + 1,))
+        conn.close()
+        self.cache = TexCache(self.filename)
+        self.assertEqual(self.cache.get_results(), [])
+        self.assertEqual(self.cache.get_pages(), [])
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:set ts=4 sw=4 sts=4 expandtab:
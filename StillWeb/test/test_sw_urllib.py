@@ -4,6 +4,8 @@
 
 import unittest
 
+from StillWeb.sw_urllib import ParsedURL
+
 RFC3986_BASE = "http://a/b/c/d;p?q"
 RFC3986_normal_tests = [
     ("g:h",     "g:h"),
@@ -148,6 +150,36 @@ class OtherTests(unittest.TestCase):
         self.assertEqual("http://a/foo", rebase_url("/foo", "http://a/bar/", "http://xyz/new/"))
         self.assertRaises(ValueError, rebase_url, "/foo", "http://a/bar/", "http://xyz/new/", must_rebase=True)
 
+class Test_ParsedURL(unittest.TestCase):
+    def test_components(self):
+        """ParsedURL components"""
+        u = ParsedURL.parse("http://a/b/c/d;p?q#f")
+        self.assertEqual(("http", "a", "/b/c/d", "p", "q", "f"),
+            (u.scheme, u.netloc, u.path, u.params, u.query, u.fragment))
+        self.assertEqual(("", "b", "c", "d"), u.segments)
+        self.assertEqual("http://a/b/c/d;p?q#f", str(u))
+        self.assertEqual(ParsedURL.parse("http://a/b/c/d;p?q#f"), u)
+
+    def test_immutable(self):
+        """ParsedURL objects are immutable"""
+        u = ParsedURL.parse("http://a/b/c")
+        self.assertRaises(AttributeError, setattr, u, "path", "/x")
+        self.assertRaises(AttributeError, setattr, u, "foo", "bar")
+
+    def test_join(self):
+        """ParsedURL.join (RFC 3986 examples)"""
+        base = ParsedURL.parse(RFC3986_BASE)
+        for (url, expected) in RFC3986_normal_tests + RFC3986_abnormal_tests:
+            self.assertEqual(expected, str(base.join(url)))
+            self.assertEqual(expected, str(base.join(ParsedURL.parse(url))))
+
+    def test_relative_to_and_rebase(self):
+        """ParsedURL.relative_to and ParsedURL.rebase"""
+        P = ParsedURL.parse
+        self.assertEqual("../../e/f.html", str(P("http://a/e/f.html").relative_to(P("http://a/b/c/dee.html"))))
+        self.assertEqual("http://a/new/b/c", str(P("http://a/old/b/c").rebase(P("http://a/old/"), P("http://a/new/"))))
+        self.assertRaises(ValueError, P("/foo").rebase, P("http://a/bar/"), P("http://xyz/new/"), must_rebase=True)
+
 if __name__ == '__main__':
     unittest.main()
 